@@ -1,14 +1,78 @@
-import io
 import base64
-from io import BytesIO
-from flask import Flask, request, jsonify
-from PIL import Image
-from settings import DETECT_ENDPOINT, RENDER_ENDPOINT, DEFAULT_HOST, DEFAULT_PORT
-from util.df_to_json import format_detections
-from util.draw_bbox import draw_boxes_on_image
-from model.initialize_model import yolo
+import json
+import logging
+import math
+import time
+from collections import deque
+from concurrent.futures import Future
+from functools import lru_cache
+from flask import Flask, Response, abort, g, request, jsonify, stream_with_context
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from settings import (DETECT_ENDPOINT, DETECT_BATCH_ENDPOINT, RENDER_ENDPOINT, STATS_ENDPOINT, DEFAULT_HOST,
+                      DEFAULT_PORT, MODEL_WARMUP, INFERENCE_WORKERS, DETECT_THRESHOLD, CACHE_ENABLED, CACHE_MAX_BYTES,
+                      CACHE_TTL_SECONDS, CACHE_DIR, RENDER_JPEG_QUALITY, RENDER_WEBP_QUALITY, RENDER_LABELS,
+                      RENDER_CLASS_COLORS, BATCH_STREAM_WINDOW, METRICS_ENDPOINT, METRICS_ENABLED, TIMING_HEADERS,
+                      PROFILE_ENDPOINT, PROFILER_INTERVAL_MS, MAX_UPLOAD_BYTES, REDUCED_DECODE, MAX_DETECTIONS,
+                      NMS_IOU_THRESHOLD, PRIORITY_LANES, ENDPOINT_LANES, TENANT_HEADER, DEADLINE_HEADER,
+                      DEFAULT_DEADLINE_MS)
+from util.batch_io import iter_length_prefixed
+from util.cache import DetectionCache
+from util.df_to_json import (format_detections, detections_to_json, detections_to_columns_json, detections_to_msgpack,
+                             detections_to_packed)
+from util.draw_bbox import draw_boxes
+from util.image_utils import ImageTooLarge, decode_image, decode_image_scaled, encode_image, load_image
+from util.metrics import (REGISTRY, LATENCY_BUCKETS, SIZE_BUCKETS, Counter, Histogram, finish_request_timings,
+                          server_timing, start_request_timings, timed)
+from util.memory import process_memory, worker_memory
+from util.profiler import SamplingProfiler
+from model.admission import Admission, Overloaded, QueueFull, current_admission, finish_admission, start_admission
+from model.batching import BatchingEngine
+from model.nms import DetectionQuery, InvalidQuery, detection_query
+from model.roi import CameraRegions, InvalidRegion, detect_regions, polygon_region, rectangle_region
+from model.tiling import detect_tiled
+from model.worker_pool import WorkerPool
+from model.initialize_model import yolo, warm_up
+
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+engine = BatchingEngine(yolo)
+cache = DetectionCache(CACHE_MAX_BYTES, CACHE_TTL_SECONDS, CACHE_DIR) if CACHE_ENABLED else None
+camera_regions = CameraRegions()
+profiler = SamplingProfiler(PROFILER_INTERVAL_MS / 1000)
+# Process id of the process that forked the server processes, None when the server is not forked
+supervisor_pid = None
+
+REQUESTS = REGISTRY.register(Counter('yolo_requests', 'Handled requests.', ('endpoint', 'method', 'status')))
+ERRORS = REGISTRY.register(Counter('yolo_errors', 'Requests that failed to process an image.', ('endpoint', 'error')))
+REQUEST_SECONDS = REGISTRY.register(Histogram('yolo_request_seconds', 'Latency of the requests.',
+                                              LATENCY_BUCKETS, ('endpoint',)))
+REQUEST_BYTES = REGISTRY.register(Histogram('yolo_request_bytes', 'Size of the request bodies.',
+                                            SIZE_BUCKETS, ('endpoint',)))
+RESPONSE_BYTES = REGISTRY.register(Histogram('yolo_response_bytes', 'Size of the response bodies.',
+                                             SIZE_BUCKETS, ('endpoint',)))
+
+# Query parameters of /detect filtering the detections, in the order of parse_detect_query
+DETECT_QUERY_PARAMS = ('classes', 'max_det', 'iou', 'min_area')
+# Query parameters of /detect selecting the regions of interest, in the order of request_regions
+REGION_PARAMS = ('camera', 'roi', 'polygon')
+
+# Media types of /detect, mapped to their serializers; requests not accepting any of them explicitly
+# get 'application/json'
+DETECT_MEDIA_TYPES = {
+    'application/json': detections_to_json,
+    'application/vnd.yolo.columns+json': detections_to_columns_json,
+    'application/msgpack': detections_to_msgpack,
+    'application/x-msgpack': detections_to_msgpack,
+    'application/vnd.yolo.packed': detections_to_packed,
+}
+
+# Binary media types of /render, mapped to their file format and default encoding quality
+RENDER_MEDIA_TYPES = {
+    'image/jpeg': ('JPEG', RENDER_JPEG_QUALITY),
+    'image/webp': ('WEBP', RENDER_WEBP_QUALITY),
+}
 
 
 def detect(image):
@@ -25,7 +89,7 @@ def detect(image):
     response : dict
         A dictionary containing the detected objects and their properties.
     """
-    detections = yolo.detect(image)
+    detections = infer(image)
     response = format_detections(detections)
     return response
 
@@ -46,13 +110,829 @@ def render(image):
         bounding boxes rendered on it.
     """
 
-    detections = yolo.detect(image)
-    bbox_im = draw_boxes_on_image(image, detections)
+    detections = infer(image)
+    return base64.b64encode(render_detections(image, detections)).decode("utf-8")
+
+
+def infer(image, confidence_threshold=DETECT_THRESHOLD, tiled=False, regions=None):
+    """
+    Runs an image through the inference engine, recording the time spent waiting for
+    and in the model as the 'inference' stage.
+
+    Parameters
+    ----------
+    image : PIL.Image.Image or numpy.ndarray
+        The image to detect objects in.
+    confidence_threshold : float, optional
+        The confidence threshold for object detection (default from settings.py).
+    tiled : bool, optional
+        Whether to detect on overlapping full-resolution tiles (default is False).
+    regions : tuple of Region, optional
+        The regions of interest, only their crops are run through the model (default is None).
+
+    Returns
+    -------
+    detections : Detections
+        The objects detected in the image.
+    """
+    with timed('inference'):
+        if regions is not None:
+            return detect_regions(engine, image, regions, confidence_threshold)
+        if tiled:
+            return detect_tiled(engine, image, confidence_threshold)
+        return engine.detect(image, confidence_threshold)
+
+
+def render_detections(image, detections, format='JPEG', quality=RENDER_JPEG_QUALITY, labels=RENDER_LABELS,
+                      class_colors=RENDER_CLASS_COLORS):
+    """
+    Draws already detected bounding boxes on an image and encodes it.
+    A writeable pixel array is drawn on and encoded in place, without copies.
+
+    Parameters
+    ----------
+    image : PIL.Image.Image or numpy.ndarray
+        The image, or its RGB pixels, to render bounding boxes on.
+    detections : Detections
+        The objects detected in the image.
+    format : str, optional
+        The file format of the encoded image, 'JPEG' or 'WEBP' (default is 'JPEG').
+    quality : int, optional
+        The encoding quality from 1 to 100 (default from settings.py).
+    labels : bool, optional
+        Whether to write the class name and confidence above the boxes (default from settings.py).
+    class_colors : bool, optional
+        Whether to colour the boxes by class instead of in green (default from settings.py).
+
+    Returns
+    -------
+    encoded_image : bytes
+        The encoded image file with the bounding boxes rendered on it.
+    """
+    img = load_image(image)
+    if not img.flags.writeable:
+        img = img.copy()
+    draw_boxes(img, detections, labels=labels, per_class_colors=class_colors)
+    return encode_image(img, format, quality, overwrite=True)
+
+
+def negotiate_media_type(accept_header, media_types):
+    """
+    Picks the media type of a response from the Accept header.
+
+    Parameters
+    ----------
+    accept_header : str or None
+        The Accept header of the request.
+    media_types : Container
+        The media types the endpoint offers.
+
+    Returns
+    -------
+    media_type : str or None
+        The explicitly accepted media type with the highest preference,
+        None when no offered media type is named in the header.
+    """
+    best, best_quality = None, 0
+    for media_type, quality in parse_accept_header(accept_header, MIMEAccept):
+        if media_type in media_types and quality > best_quality:
+            best, best_quality = media_type, quality
+    return best
+
+
+def negotiate_render_type(accept_header):
+    """
+    Picks the binary media type of a /render response from the Accept header.
+
+    Parameters
+    ----------
+    accept_header : str or None
+        The Accept header of the request.
+
+    Returns
+    -------
+    media_type : str or None
+        The explicitly accepted media type with the highest preference,
+        None when the client expects the base64-encoded text response.
+    """
+    return negotiate_media_type(accept_header, RENDER_MEDIA_TYPES)
+
+
+def negotiate_detect_type(accept_header):
+    """
+    Picks the media type of a /detect response from the Accept header.
+
+    Parameters
+    ----------
+    accept_header : str or None
+        The Accept header of the request.
+
+    Returns
+    -------
+    media_type : str
+        The explicitly accepted media type of DETECT_MEDIA_TYPES with the highest preference,
+        'application/json' when the header names none of them.
+    """
+    return negotiate_media_type(accept_header, DETECT_MEDIA_TYPES) or 'application/json'
+
+
+def render_options(media_type, quality=None):
+    """
+    Resolves the file format and encoding quality of a /render response.
+
+    Parameters
+    ----------
+    media_type : str or None
+        The negotiated media type, None for the base64-encoded JPEG text response.
+    quality : str or int, optional
+        The requested encoding quality, clamped to 1..100 (default depends on the format).
+
+    Returns
+    -------
+    format : str
+        The file format of the encoded image.
+    quality : int
+        The encoding quality.
+
+    Raises
+    ------
+    InvalidQuery
+        If the quality is not an integer.
+    """
+    format, default_quality = RENDER_MEDIA_TYPES[media_type or 'image/jpeg']
+    if quality is None or quality == '':
+        return format, default_quality
+    try:
+        quality = int(quality)
+    except ValueError:
+        raise InvalidQuery(f"Invalid quality: {quality}") from None
+    return format, min(100, max(1, quality))
+
 
-    io_buf = BytesIO()
-    bbox_im.save(io_buf, format='JPEG')
-    encoded_image = base64.b64encode(io_buf.getvalue()).decode("utf-8")
-    return encoded_image
+def cached(kind, im_data, compute, *params):
+    """
+    Returns the cached result of an identical request, computing and caching it on a miss.
+
+    Parameters
+    ----------
+    kind : str
+        The kind of result, 'detect' or 'render'.
+    im_data : bytes
+        The raw image file of the request.
+    compute : callable
+        A function without arguments computing the result.
+    *params
+        The request parameters that change the result.
+
+    Returns
+    -------
+    result : object
+        The detections or the encoded image.
+    """
+    if cache is None:
+        return compute()
+    return cache.get_or_compute(DetectionCache.key(kind, im_data, *params), compute)
+
+
+def detect_bytes(im_data, confidence_threshold=DETECT_THRESHOLD, tiled=False, regions=None):
+    """
+    Detects objects in a raw image file, reusing the result of identical requests.
+
+    Parameters
+    ----------
+    im_data : bytes
+        The raw image file.
+    confidence_threshold : float or DetectionQuery, optional
+        The confidence threshold for object detection, or a query with further filters
+        (default from settings.py).
+    tiled : bool, optional
+        Whether to detect on overlapping full-resolution tiles (default is False).
+    regions : tuple of Region, optional
+        The regions of interest in full-size image pixels, the image is then decoded at full
+        resolution and tiled is ignored (default is None).
+
+    Returns
+    -------
+    detections : Detections
+        The objects detected in the image.
+    """
+    if regions is not None:
+        return cached('detect', im_data, lambda: infer(decode_image(im_data), confidence_threshold, regions=regions),
+                      confidence_threshold, regions)
+    if tiled:
+        return cached('detect', im_data, lambda: infer(decode_image(im_data), confidence_threshold, tiled=True),
+                      confidence_threshold, 'tiled')
+
+    def compute():
+        image, scale = decode_for_detection(im_data)
+        return unscale(infer(image, scale_query(confidence_threshold, scale)), scale)
+
+    return cached('detect', im_data, compute, confidence_threshold)
+
+
+def read_upload(max_bytes=MAX_UPLOAD_BYTES):
+    """
+    Reads the body of the current request, rejecting bodies over the size limit with 413.
+    The declared length is checked before anything is read, and a body without a declared
+    length is read no further than the limit.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        The maximum size of the body in bytes (default from settings.py).
+
+    Returns
+    -------
+    im_data : bytes
+        The request body.
+    """
+    too_large = f"Error: Request data is larger than {max_bytes} bytes"
+    if request.content_length is not None and request.content_length > max_bytes:
+        abort(413, description=too_large)
+    im_data = request.stream.read(max_bytes + 1)
+    if len(im_data) > max_bytes:
+        abort(413, description=too_large)
+    return im_data
+
+
+def check_upload_size(im_data, max_bytes=MAX_UPLOAD_BYTES):
+    """
+    Rejects an uploaded image file over the size limit.
+
+    Parameters
+    ----------
+    im_data : bytes
+        The raw image file.
+    max_bytes : int, optional
+        The maximum size of the file in bytes (default from settings.py).
+
+    Returns
+    -------
+    im_data : bytes
+        The same image file.
+    """
+    if len(im_data) > max_bytes:
+        raise ImageTooLarge(f"Image of {len(im_data)} bytes is over the limit of {max_bytes} bytes")
+    return im_data
+
+
+def decode_for_detection(im_data):
+    """
+    Decodes a raw image file for detection, at a reduced resolution close to the model input
+    when REDUCED_DECODE is enabled.
+
+    Parameters
+    ----------
+    im_data : bytes
+        The raw image file.
+
+    Returns
+    -------
+    image : numpy.ndarray
+        The RGB pixels of the image.
+    scale : tuple
+        The x and y factors mapping boxes in the decoded image back to the full-size image.
+    """
+    if not REDUCED_DECODE:
+        return decode_image(im_data), (1.0, 1.0)
+    return decode_image_scaled(im_data)
+
+
+def unscale(detections, scale):
+    """
+    Maps detections in a reduced-resolution image back to the full-size image.
+
+    Parameters
+    ----------
+    detections : Detections
+        The objects detected in the decoded image.
+    scale : tuple
+        The factors returned by decode_for_detection.
+
+    Returns
+    -------
+    detections : Detections
+        The objects in full-size image coordinates.
+    """
+    return detections if scale == (1.0, 1.0) else detections.scale(*scale)
+
+
+def scale_query(query, scale):
+    """
+    Maps the minimum box area of a query from full-size image pixels to the pixels of an image
+    decoded at reduced resolution.
+
+    Parameters
+    ----------
+    query : float or DetectionQuery
+        The confidence threshold or query of the request.
+    scale : tuple
+        The factors returned by decode_for_detection.
+
+    Returns
+    -------
+    query : float or DetectionQuery
+        The query for the decoded image.
+    """
+    if not isinstance(query, DetectionQuery) or not query.min_area or scale == (1.0, 1.0):
+        return query
+    return query._replace(min_area=query.min_area / (scale[0] * scale[1]))
+
+
+@lru_cache(maxsize=1024)
+def parse_detect_query(classes=None, max_det=None, iou=None, min_area=None):
+    """
+    Parses the filter query parameters of /detect. Repeated parameter sets are served from a cache.
+
+    Parameters
+    ----------
+    classes : str or None
+        Comma-separated class names or ids to detect, all classes when missing.
+    max_det : str or None
+        The maximum number of detections.
+    iou : str or None
+        The IoU threshold of the non-maximum suppression.
+    min_area : str or None
+        The minimum box area in image pixels.
+
+    Returns
+    -------
+    query : float or DetectionQuery
+        DETECT_THRESHOLD when no filter is given, the validated query otherwise.
+
+    Raises
+    ------
+    InvalidQuery
+        If a parameter is not a valid number or out of range.
+    """
+    if classes is max_det is iou is min_area is None:
+        return DETECT_THRESHOLD
+    if classes is not None:
+        classes = tuple(name.strip() for name in classes.split(',') if name.strip())
+    try:
+        return detection_query(DETECT_THRESHOLD, classes,
+                               MAX_DETECTIONS if max_det is None else int(max_det),
+                               NMS_IOU_THRESHOLD if iou is None else float(iou),
+                               0.0 if min_area is None else float(min_area))
+    except InvalidQuery:
+        raise
+    except ValueError as exc:
+        raise InvalidQuery(f"Invalid filter: {exc}") from None
+
+
+@lru_cache(maxsize=1024)
+def parse_regions(roi=None, polygon=None):
+    """
+    Parses the regions of interest of a /detect request.
+
+    Parameters
+    ----------
+    roi : str, optional
+        Rectangles separated by ';', each 'xmin,ymin,xmax,ymax' in image pixels.
+    polygon : str, optional
+        Polygons separated by ';', each 'x1,y1,x2,y2,x3,y3,...' in image pixels.
+
+    Returns
+    -------
+    regions : tuple of Region or None
+        The regions, None when the request has none.
+
+    Raises
+    ------
+    InvalidRegion
+        If a rectangle or polygon is malformed.
+    """
+    if roi is None and polygon is None:
+        return None
+    try:
+        regions = [rectangle_region([float(v) for v in box.split(',')]) for box in (roi or '').split(';') if box]
+        for points in (polygon or '').split(';'):
+            if points:
+                values = [float(v) for v in points.split(',')]
+                if len(values) % 2:
+                    raise InvalidRegion("A polygon needs an x and a y coordinate per vertex")
+                regions.append(polygon_region(zip(values[::2], values[1::2])))
+    except InvalidRegion:
+        raise
+    except ValueError as exc:
+        raise InvalidRegion(f"Invalid region: {exc}") from None
+    if not regions:
+        raise InvalidRegion("No region of interest")
+    return tuple(regions)
+
+
+def request_regions(camera=None, roi=None, polygon=None):
+    """
+    Resolves the regions of interest of a /detect request. Regions sent with a camera id are
+    stored for it, so later requests of the camera only send the id.
+
+    Parameters
+    ----------
+    camera : str, optional
+        The camera id.
+    roi : str, optional
+        The rectangles, see parse_regions.
+    polygon : str, optional
+        The polygons, see parse_regions.
+
+    Returns
+    -------
+    regions : tuple of Region or None
+        The regions, None for the whole image.
+
+    Raises
+    ------
+    InvalidRegion
+        If a region is malformed, or the camera sends no regions and has none stored.
+    """
+    regions = parse_regions(roi, polygon)
+    if camera is None:
+        return regions
+    if regions is not None:
+        camera_regions.put(camera, regions)
+        return regions
+    regions = camera_regions.get(camera)
+    if regions is None:
+        raise InvalidRegion(f"Unknown camera {camera!r}, send its regions with 'roi' or 'polygon'")
+    return regions
+
+
+def render_style(labels=None, colors=None):
+    """
+    Resolves the box style of a /render response from its 'labels' and 'colors' query parameters.
+
+    Parameters
+    ----------
+    labels : str or None
+        Whether to label the boxes, RENDER_LABELS when missing.
+    colors : str or None
+        Whether to colour the boxes by class, RENDER_CLASS_COLORS when missing.
+
+    Returns
+    -------
+    labels : bool
+    class_colors : bool
+    """
+    return (RENDER_LABELS if labels is None else query_flag(labels),
+            RENDER_CLASS_COLORS if colors is None else query_flag(colors))
+
+
+def query_flag(value):
+    """
+    Parses a boolean query parameter.
+
+    Parameters
+    ----------
+    value : str or None
+        The value of the query parameter.
+
+    Returns
+    -------
+    flag : bool
+        True for '1', 'true', 'yes' and 'on', False otherwise.
+    """
+    return value is not None and value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def render_bytes(im_data, confidence_threshold=DETECT_THRESHOLD, format='JPEG', quality=RENDER_JPEG_QUALITY,
+                 labels=RENDER_LABELS, class_colors=RENDER_CLASS_COLORS):
+    """
+    Renders bounding boxes on a raw image file, reusing the result of identical requests.
+
+    Parameters
+    ----------
+    im_data : bytes
+        The raw image file.
+    confidence_threshold : float, optional
+        The confidence threshold for object detection (default from settings.py).
+    format : str, optional
+        The file format of the encoded image, 'JPEG' or 'WEBP' (default is 'JPEG').
+    quality : int, optional
+        The encoding quality from 1 to 100 (default from settings.py).
+    labels : bool, optional
+        Whether to write the class name and confidence above the boxes (default from settings.py).
+    class_colors : bool, optional
+        Whether to colour the boxes by class instead of in green (default from settings.py).
+
+    Returns
+    -------
+    encoded_image : bytes
+        The encoded image file with the bounding boxes rendered on it.
+    """
+    def compute():
+        image = decode_image(im_data)
+        detections = cached('detect', im_data, lambda: infer(image, confidence_threshold),
+                            confidence_threshold)
+        return render_detections(image, detections, format, quality, labels, class_colors)
+
+    return cached('render', im_data, compute, confidence_threshold, format, quality, labels, class_colors)
+
+
+def submit_bytes(im_data, confidence_threshold=DETECT_THRESHOLD, lane=None, deadline=None):
+    """
+    Queues a raw image file for detection, reusing the result of identical requests.
+
+    Parameters
+    ----------
+    im_data : bytes
+        The raw image file.
+    confidence_threshold : float, optional
+        The confidence threshold for object detection (default from settings.py).
+    lane : str, optional
+        The priority lane (default is the lane of the current request).
+    deadline : float, optional
+        The time.monotonic() deadline (default is the deadline of the current request).
+
+    Returns
+    -------
+    future : concurrent.futures.Future
+        A future resolved with the objects detected in the image.
+    """
+    if cache is None:
+        return _submit_scaled(im_data, confidence_threshold, lane, deadline)
+    key = DetectionCache.key('detect', im_data, confidence_threshold)
+    detections = cache.get(key)
+    if detections is not None:
+        future = Future()
+        future.set_result(detections)
+        return future
+    future = _submit_scaled(im_data, confidence_threshold, lane, deadline)
+    future.add_done_callback(lambda done: not done.cancelled() and done.exception() is None
+                             and cache.put(key, done.result()))
+    return future
+
+
+def _submit_scaled(im_data, confidence_threshold, lane=None, deadline=None):
+    image, scale = decode_for_detection(check_upload_size(im_data))
+    future = engine.submit(image, scale_query(confidence_threshold, scale), lane, deadline)
+    if scale == (1.0, 1.0):
+        return future
+
+    scaled = Future()
+
+    def done(finished):
+        if finished.cancelled():
+            scaled.cancel()
+        elif scaled.set_running_or_notify_cancel():
+            if finished.exception() is not None:
+                scaled.set_exception(finished.exception())
+            else:
+                scaled.set_result(unscale(finished.result(), scale))
+
+    future.add_done_callback(done)
+    # cancelling the returned future takes the image out of the engine queue
+    scaled.add_done_callback(lambda returned: returned.cancelled() and future.cancel())
+    return scaled
+
+
+def detect_stream(images, confidence_threshold=DETECT_THRESHOLD, window=BATCH_STREAM_WINDOW, admission=None):
+    """
+    Detects objects in a stream of images and yields one NDJSON line per image, in order.
+    At most window images are decoded and waiting for the model at once, so the model
+    gets full batches while memory stays bounded.
+
+    Parameters
+    ----------
+    images : iterable of (str, bytes)
+        The names and raw files of the images.
+    confidence_threshold : float, optional
+        The confidence threshold for object detection (default from settings.py).
+    window : int, optional
+        The maximum number of images in flight (default from settings.py).
+    admission : Admission, optional
+        The priority lane and deadline of the images, the response is streamed after the
+        request context is gone (default is the highest priority lane without deadline).
+
+    Returns
+    -------
+    lines : generator of str
+        Lines with the index, name and detected objects of every image, or its error.
+    """
+    pending = deque()
+    lane, deadline = admission or Admission(None, None)
+
+    def finish(index, name, future):
+        prefix = '{"index": %d, "name": %s, ' % (index, json.dumps(name))
+        try:
+            return prefix + detections_to_json(future.result())[1:] + '\n'
+        except ImageTooLarge as exc:
+            record_error(DETECT_BATCH_ENDPOINT, exc)
+            return prefix + '"error": "Image is too large"}\n'
+        except Overloaded as exc:
+            record_error(DETECT_BATCH_ENDPOINT, exc)
+            return prefix + '"error": %s}\n' % json.dumps(str(exc))
+        except Exception as exc:
+            record_error(DETECT_BATCH_ENDPOINT, exc)
+            return prefix + '"error": "Wrong data type. Make sure, that you use image"}\n'
+
+    index = -1
+    try:
+        for index, (name, im_data) in enumerate(images):
+            try:
+                future = submit_bytes(im_data, confidence_threshold, lane, deadline)
+            except Exception as exc:
+                future = Future()
+                future.set_exception(exc)
+            pending.append((index, name, future))
+            while len(pending) >= window or (pending and pending[0][2].done()):
+                yield finish(*pending.popleft())
+        while pending:
+            yield finish(*pending.popleft())
+    except ValueError as exc:
+        while pending:
+            yield finish(*pending.popleft())
+        yield json.dumps({"index": index + 1, "error": str(exc)}) + '\n'
+    finally:
+        # a client that disconnects closes the generator, its queued images are not worth running
+        for _, _, future in pending:
+            future.cancel()
+
+
+def collect_stats():
+    """
+    Collects the metrics of the inference engine, the model and the memory of the server processes.
+
+    Returns
+    -------
+    metrics : dict
+        A dictionary with the queue depth, batch size and model loading metrics.
+    """
+    metrics = engine.metrics()
+    metrics["model_loaded"] = yolo.loaded
+    metrics["model_load_seconds"] = yolo.load_seconds
+    if cache is not None:
+        metrics["cache"] = cache.metrics()
+    similarity_cache = yolo.similarity_cache if yolo.loaded else None
+    if similarity_cache is not None:
+        metrics["similarity_cache"] = similarity_cache.metrics()
+    metrics["memory"] = process_memory()
+    if supervisor_pid is not None:
+        metrics["server_processes"] = worker_memory(supervisor_pid)
+    return metrics
+
+
+def engine_metrics():
+    """
+    Reports the inference engine and cache counters as Prometheus samples at scrape time.
+
+    Returns
+    -------
+    samples : list of tuple
+        The (name, type, help, value) tuples of the engine and cache metrics.
+    """
+    metrics = engine.metrics()
+    samples = [
+        ('yolo_queue_depth', 'gauge', 'Images waiting for the model.', metrics['queue_depth']),
+        ('yolo_inference_images_total', 'counter', 'Images run through the model.', metrics['images_total']),
+        ('yolo_inference_errors_total', 'counter', 'Images the model failed on.', metrics['errors_total']),
+        ('yolo_mean_batch_size', 'gauge', 'Mean number of images per forward pass.', metrics['mean_batch_size']),
+        ('yolo_rejected_total', 'counter', 'Requests shed before queueing, lane full or deadline out of reach.',
+         sum(metrics.get('rejected_total', {}).values())),
+        ('yolo_expired_total', 'counter', 'Queued images dropped because their deadline passed.',
+         metrics.get('expired_total', 0)),
+        ('yolo_model_loaded', 'gauge', 'Whether the model is loaded.', int(yolo.loaded)),
+    ]
+    memory = process_memory()
+    samples.append(('yolo_process_resident_bytes', 'gauge', 'Resident memory of the process.', memory['rss']))
+    if memory['pss'] is not None:
+        samples.append(('yolo_process_proportional_bytes', 'gauge',
+                        'Proportional set size of the process, shared pages split between their users.',
+                        memory['pss']))
+    if cache is not None:
+        stats = cache.metrics()
+        samples += [('yolo_cache_%s_total' % name, 'counter', 'Result cache %s.' % name.replace('_', ' '), stats[name])
+                    for name in ('hits_memory', 'hits_disk', 'misses', 'evictions') if name in stats]
+    similarity_cache = yolo.similarity_cache if yolo.loaded else None
+    if similarity_cache is not None:
+        stats = similarity_cache.metrics()
+        samples += [('yolo_similarity_cache_%s_total' % name, 'counter',
+                     'Near-duplicate cache %s.' % name.replace('_', ' '), stats[name])
+                    for name in ('hits', 'misses', 'evictions', 'audits', 'false_matches')]
+        samples.append(('yolo_similarity_cache_entries', 'gauge', 'Images in the near-duplicate index.',
+                        stats['entries']))
+    return samples
+
+
+REGISTRY.add_collector(engine_metrics)
+
+
+def request_admission(endpoint, headers, arrived):
+    """
+    Finds the priority lane and deadline of a request. Tenants named in the tenant header with a
+    lane of their own use it, the other requests use the lane of their endpoint.
+
+    Parameters
+    ----------
+    endpoint : str
+        The endpoint of the request.
+    headers : Mapping
+        The request headers.
+    arrived : float
+        The time.monotonic() time the request arrived at, its time budget starts then.
+
+    Returns
+    -------
+    admission : Admission
+        The lane and the time.monotonic() deadline, None without a time budget.
+
+    Raises
+    ------
+    ValueError
+        If the deadline header is not a positive number of milliseconds.
+    """
+    tenant = headers.get(TENANT_HEADER)
+    lane = tenant if tenant in PRIORITY_LANES else ENDPOINT_LANES.get(endpoint)
+    budget = headers.get(DEADLINE_HEADER)
+    if budget is None:
+        budget_ms = DEFAULT_DEADLINE_MS
+    else:
+        try:
+            budget_ms = float(budget)
+        except ValueError:
+            budget_ms = -1.0
+        if not 0 < budget_ms < math.inf:
+            raise ValueError(f"{DEADLINE_HEADER} must be a positive number of milliseconds")
+    return Admission(lane, arrived + budget_ms / 1000 if budget_ms else None)
+
+
+def shed_response(exc):
+    """
+    Builds the response of a request the inference engine shed: 429 when the priority lane of the
+    request is full and 503 when its deadline cannot be met, with the estimated wait as Retry-After.
+
+    Parameters
+    ----------
+    exc : Overloaded
+        The exception the engine shed the request with.
+
+    Returns
+    -------
+    response : tuple
+        The body, status code and headers of the response.
+    """
+    status = 429 if isinstance(exc, QueueFull) else 503
+    return f"Error: {exc}", status, {'Retry-After': str(max(1, math.ceil(exc.retry_after)))}
+
+
+def record_error(endpoint, exc):
+    """
+    Counts a request that failed to process its image and logs the cause.
+
+    Parameters
+    ----------
+    endpoint : str
+        The endpoint of the request.
+    exc : Exception
+        The exception the request failed with.
+    """
+    ERRORS.inc(endpoint, type(exc).__name__)
+    logger.debug("Request to %s failed", endpoint, exc_info=exc)
+
+
+@app.before_request
+def start_request_metrics():
+    g.started = time.perf_counter()
+    g.timings_token = start_request_timings()
+
+
+@app.before_request
+def start_request_admission():
+    rule = request.url_rule.rule if request.url_rule is not None else None
+    try:
+        g.admission_token = start_admission(*request_admission(rule, request.headers, time.monotonic()))
+    except ValueError as exc:
+        return f"Error: {exc}", 400
+
+
+@app.after_request
+def finish_request_admission(response):
+    if 'admission_token' in g:
+        finish_admission(g.admission_token)
+    return response
+
+
+@app.after_request
+def record_request_metrics(response):
+    """
+    Records the count, latency and payload sizes of a request, and adds the Server-Timing
+    header when it is enabled or the request asks for it with 'X-Timing: 1'.
+    """
+    if 'timings_token' not in g:
+        return response
+    elapsed = time.perf_counter() - g.started
+    timings = finish_request_timings(g.timings_token)
+    if not METRICS_ENABLED:
+        return response
+
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    REQUESTS.inc(endpoint, request.method, response.status_code)
+    REQUEST_SECONDS.observe(elapsed, endpoint)
+    REQUEST_BYTES.observe(request.content_length or 0, endpoint)
+    if not response.is_streamed:
+        RESPONSE_BYTES.observe(response.content_length or 0, endpoint)
+    if TIMING_HEADERS or query_flag(request.headers.get('X-Timing')):
+        response.headers['Server-Timing'] = server_timing(timings, elapsed)
+    return response
 
 
 @app.route('/')
@@ -60,28 +940,104 @@ def index():
     return 'Server Works!'
 
 
+@app.route(STATS_ENDPOINT)
+def stats_api():
+    """
+    API endpoint for the batching engine metrics.
+
+    Returns
+    -------
+    flask.Response
+        A Flask response object containing the queue depth and batch size
+        metrics in JSON format.
+    """
+    return jsonify(collect_stats())
+
+
+@app.route(METRICS_ENDPOINT)
+def metrics_api():
+    """
+    API endpoint for the Prometheus metrics: stage latency histograms, request and error
+    counts, payload sizes and the queue depth of the inference engine.
+
+    Returns
+    -------
+    flask.Response
+        A response in the Prometheus text exposition format.
+    """
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route(PROFILE_ENDPOINT, methods=['GET', 'POST'])
+def profile_api():
+    """
+    API endpoint of the sampling profiler. A POST request with '?enabled=1' starts it,
+    '?enabled=0' stops it and '?reset=1' drops the samples taken so far.
+
+    Returns
+    -------
+    flask.Response
+        The sampled stacks in collapsed format, one line per stack with its sample count,
+        and the profiler state in the 'X-Profiler' header.
+    """
+    if request.method == 'POST':
+        if query_flag(request.args.get('reset')):
+            profiler.reset()
+        enabled = request.args.get('enabled')
+        if enabled is not None and query_flag(enabled):
+            profiler.start()
+        elif enabled is not None:
+            profiler.stop()
+    response = Response(profiler.collapsed(), mimetype='text/plain')
+    response.headers['X-Profiler'] = 'running' if profiler.running else 'stopped'
+    response.headers['X-Profiler-Samples'] = str(profiler.samples)
+    return response
+
+
 @app.route(DETECT_ENDPOINT, methods=['POST'])
 def detect_api():
     """
     API endpoint for detecting objects in an image.
 
+    The 'tiled' query parameter runs detection on overlapping full-resolution tiles,
+    for large images with small objects. The 'classes' (comma-separated names or ids),
+    'max_det', 'iou' and 'min_area' query parameters filter the detections inside the
+    non-maximum suppression. The 'roi' and 'polygon' query parameters restrict detection to
+    regions of interest, stored for the 'camera' id. The tenant and deadline headers set the
+    priority lane and the time budget of the request, requests the engine sheds get 429 or 503
+    with a Retry-After header.
+
+    The Accept header selects a compact encoding instead of the JSON object list: columnar
+    JSON, MessagePack or packed binary, see DETECT_MEDIA_TYPES.
+
     Returns
     -------
     flask.Response
         A Flask response object containing the detected objects and their
-        properties in JSON format.
+        properties in the negotiated format.
     """
     if request.method != 'POST':
         return
-    if not request.data:
+    im_data = read_upload()
+    if not im_data:
         return "Error: Request data is empty"
     try:
-        im_data = request.data
-        im = Image.open(io.BytesIO(im_data))
-
-        response = detect(im)
-        return jsonify(response)
-    except Exception:
+        query = parse_detect_query(*(request.args.get(name) for name in DETECT_QUERY_PARAMS))
+        regions = request_regions(*(request.args.get(name) for name in REGION_PARAMS))
+        media_type = negotiate_detect_type(request.headers.get('Accept'))
+        detections = detect_bytes(im_data, query, query_flag(request.args.get('tiled')), regions)
+        return Response(DETECT_MEDIA_TYPES[media_type](detections), mimetype=media_type)
+    except ImageTooLarge as exc:
+        record_error(DETECT_ENDPOINT, exc)
+        return "Error: Image is too large", 413
+    except InvalidQuery as exc:
+        record_error(DETECT_ENDPOINT, exc)
+        return f"Error: {exc}", 400
+    except Overloaded as exc:
+        record_error(DETECT_ENDPOINT, exc)
+        return shed_response(exc)
+    except Exception as exc:
+        record_error(DETECT_ENDPOINT, exc)
         return f"Wrong data type. Make sure, that you use image"
 
 
@@ -90,27 +1046,72 @@ def render_api():
     """
     API endpoint for rendering bounding boxes on an image.
 
+    The response is the raw image file when the Accept header explicitly asks for
+    'image/jpeg' or 'image/webp', and the base64-encoded JPEG text otherwise.
+    The 'quality' query parameter sets the encoding quality, 'labels=1' writes the class name
+    and confidence above the boxes and 'colors=1' colours them by class.
+
     Returns
     -------
-    response : str
+    response : str or flask.Response
         A base64-encoded string representation of the image with the
-        bounding boxes rendered on it.
+        bounding boxes rendered on it, or a response with the encoded image.
     """
     if request.method != 'POST':
         return
-    if not request.data:
+    im_data = read_upload()
+    if not im_data:
         return "Error: Request data is empty"
     try:
-        im_data = request.data
-        im = Image.open(io.BytesIO(im_data))
+        media_type = negotiate_render_type(request.headers.get('Accept'))
+        format, quality = render_options(media_type, request.args.get('quality'))
 
-        response = render(im)
-        return response
-    except Exception:
+        labels, class_colors = render_style(request.args.get('labels'), request.args.get('colors'))
+        encoded_image = render_bytes(im_data, DETECT_THRESHOLD, format, quality, labels, class_colors)
+        if media_type is not None:
+            return Response(encoded_image, mimetype=media_type)
+        return base64.b64encode(encoded_image).decode("utf-8")
+    except ImageTooLarge as exc:
+        record_error(RENDER_ENDPOINT, exc)
+        return "Error: Image is too large", 413
+    except InvalidQuery as exc:
+        record_error(RENDER_ENDPOINT, exc)
+        return f"Error: {exc}", 400
+    except Overloaded as exc:
+        record_error(RENDER_ENDPOINT, exc)
+        return shed_response(exc)
+    except Exception as exc:
+        record_error(RENDER_ENDPOINT, exc)
         return f"Wrong data type. Make sure, that you use image"
 
 
-def run_server_api(port=DEFAULT_PORT):
+@app.route(DETECT_BATCH_ENDPOINT, methods=['POST'])
+def detect_batch_api():
+    """
+    API endpoint for detecting objects in many images with one request.
+
+    The images are sent either as multipart form data, one file per image, or as a
+    length-prefixed stream, every image preceded by its size as a big-endian 32-bit integer.
+    Every image is limited to MAX_UPLOAD_BYTES, not the whole request.
+
+    Returns
+    -------
+    flask.Response
+        A streamed NDJSON response with one line per image, written as soon as the image
+        is processed. Every line contains the index and name of the image and either its
+        detected objects or an error message.
+    """
+    if request.files:
+        images = [(file.filename or field, file.read(MAX_UPLOAD_BYTES + 1))
+                  for field, file in request.files.items(multi=True)]
+    else:
+        images = ((str(index), im_data)
+                  for index, im_data in enumerate(iter_length_prefixed(request.stream, MAX_UPLOAD_BYTES)))
+    return Response(stream_with_context(detect_stream(images, admission=current_admission())),
+                    mimetype='application/x-ndjson')
+
+
+def run_server_api(port=DEFAULT_PORT, workers=INFERENCE_WORKERS):
     """
     Runs the API server.
 
@@ -118,7 +1119,15 @@ def run_server_api(port=DEFAULT_PORT):
     ----------
     port : int, optional
         The port to run the server on (default is 5000).
+    workers : int, optional
+        The number of model worker processes, 0 runs the model in the server
+        process (default from settings.py).
     """
+    global engine
+    if workers > 0:
+        engine = WorkerPool(workers)
+    elif MODEL_WARMUP:
+        warm_up()
     app.run(host=DEFAULT_HOST, port=port, debug=False)
 
 
@@ -0,0 +1,336 @@
+import asyncio
+import base64
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+from settings import (DETECT_ENDPOINT, RENDER_ENDPOINT, STATS_ENDPOINT, METRICS_ENDPOINT, DEFAULT_HOST, DEFAULT_PORT,
+                      MODEL_WARMUP, INFERENCE_WORKERS, ASGI_MAX_CONCURRENCY, ASGI_EXECUTOR_THREADS, DETECT_THRESHOLD,
+                      METRICS_ENABLED, TIMING_HEADERS, MAX_UPLOAD_BYTES)
+from util.cache import DetectionCache
+from util.image_utils import ImageTooLarge, decode_image
+from model.admission import Overloaded, finish_admission, start_admission
+from model.nms import InvalidQuery
+from util.metrics import REGISTRY, finish_request_timings, server_timing, start_request_timings, timed
+import api.app as wsgi
+
+executor = ThreadPoolExecutor(ASGI_EXECUTOR_THREADS, thread_name_prefix="asgi-cpu")
+in_flight = 0
+
+
+def decode(im_data):
+    """
+    Decodes the raw bytes of an uploaded image.
+
+    Parameters
+    ----------
+    im_data : bytes
+        The raw image file.
+
+    Returns
+    -------
+    image : numpy.ndarray
+        The RGB pixels of the image.
+    """
+    return decode_image(im_data)
+
+
+async def read_body(request, max_bytes=MAX_UPLOAD_BYTES):
+    """
+    Reads the body of a request without blocking the event loop, rejecting bodies over the size limit.
+    The declared length is checked before anything is read, and the body is read no further than the limit.
+
+    Parameters
+    ----------
+    request : starlette.requests.Request
+        The request.
+    max_bytes : int, optional
+        The maximum size of the body in bytes (default from settings.py).
+
+    Returns
+    -------
+    im_data : bytes or None
+        The request body, None when it is over the limit.
+
+    Raises
+    ------
+    InvalidQuery
+        If the Content-Length header is not a number.
+    """
+    content_length = request.headers.get('content-length')
+    if content_length is not None:
+        try:
+            content_length = int(content_length)
+        except ValueError:
+            raise InvalidQuery(f"Invalid Content-Length: {content_length}") from None
+        if content_length > max_bytes:
+            return None
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            return None
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def too_large():
+    return PlainTextResponse("Error: Image is too large", status_code=413)
+
+
+async def run_cpu(func, *args):
+    """
+    Runs a CPU-bound function in the executor, keeping the event loop free for socket I/O.
+    The function runs in a copy of the current context, so its stage timings count for the request.
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, context.run, func, *args)
+
+
+async def cached(kind, im_data, compute, *params):
+    """
+    Returns the cached result of an identical request, awaiting compute on a miss.
+
+    Parameters
+    ----------
+    kind : str
+        The kind of result, 'detect' or 'render'.
+    im_data : bytes
+        The raw image file of the request.
+    compute : callable
+        A coroutine function without arguments computing the result.
+    *params
+        The request parameters that change the result.
+
+    Returns
+    -------
+    result : object
+        The detections or the encoded image.
+    """
+    if wsgi.cache is None:
+        return await compute()
+    key = await run_cpu(DetectionCache.key, kind, im_data, *params)
+    value = await run_cpu(wsgi.cache.get, key)
+    if value is None:
+        value = await compute()
+        await run_cpu(wsgi.cache.put, key, value)
+    return value
+
+
+async def detect_image(im_data, image=None, tiled=False, query=DETECT_THRESHOLD, regions=None):
+    """
+    Detects the objects in an uploaded image without blocking the event loop,
+    reusing the result of identical requests.
+
+    Parameters
+    ----------
+    im_data : bytes
+        The raw image file.
+    image : numpy.ndarray, optional
+        The RGB pixels of the image when they are already decoded.
+    tiled : bool, optional
+        Whether to detect on overlapping full-resolution tiles (default is False).
+    query : float or DetectionQuery, optional
+        The confidence threshold, or a query with further filters (default from settings.py).
+    regions : tuple of Region, optional
+        The regions of interest, only their crops are run through the model (default is None).
+
+    Returns
+    -------
+    detections : Detections
+        The objects detected in the image.
+    """
+    async def compute():
+        if tiled or regions is not None:
+            pixels = image if image is not None else await run_cpu(decode, im_data)
+            return await run_cpu(wsgi.infer, pixels, query, tiled, regions)
+        if image is not None:
+            pixels, scale = image, (1.0, 1.0)
+        else:
+            pixels, scale = await run_cpu(wsgi.decode_for_detection, im_data)
+        with timed('inference'):
+            # submit copies the pixels to the model workers of a WorkerPool, off the event loop too
+            future = await run_cpu(wsgi.engine.submit, pixels, wsgi.scale_query(query, scale))
+            detections = await asyncio.wrap_future(future)
+        return wsgi.unscale(detections, scale)
+
+    params = (query, regions) if regions is not None else (query, 'tiled') if tiled else (query,)
+    return await cached('detect', im_data, compute, *params)
+
+
+def bounded(handler):
+    """
+    Limits the number of requests handled at once to ASGI_MAX_CONCURRENCY, rejecting the
+    requests over the limit with 503 instead of queueing them, sets the priority lane and deadline
+    of the request and records the request metrics.
+    """
+    async def wrapper(request):
+        global in_flight
+        started = time.perf_counter()
+        token = start_request_timings()
+        try:
+            admission = wsgi.request_admission(request.url.path, request.headers, time.monotonic())
+        except ValueError as exc:
+            admission, response = None, PlainTextResponse(f"Error: {exc}", status_code=400)
+        if admission is not None and in_flight >= ASGI_MAX_CONCURRENCY:
+            response = PlainTextResponse("Error: Server is overloaded", status_code=503, headers={"Retry-After": "1"})
+        elif admission is not None:
+            in_flight += 1
+            admission_token = start_admission(*admission)
+            try:
+                response = await handler(request)
+            finally:
+                finish_admission(admission_token)
+                in_flight -= 1
+        record_request(request, response, time.perf_counter() - started, finish_request_timings(token))
+        return response
+    return wrapper
+
+
+def record_request(request, response, elapsed, timings):
+    """
+    Records the count, latency and payload sizes of a request in the metrics shared with the Flask
+    app, and adds the Server-Timing header when it is enabled or the request asks for it.
+    """
+    if not METRICS_ENABLED:
+        return
+    endpoint = request.url.path
+    wsgi.REQUESTS.inc(endpoint, request.method, response.status_code)
+    wsgi.REQUEST_SECONDS.observe(elapsed, endpoint)
+    content_length = request.headers.get('content-length', '')
+    wsgi.REQUEST_BYTES.observe(int(content_length) if content_length.isdigit() else 0, endpoint)
+    wsgi.RESPONSE_BYTES.observe(len(response.body), endpoint)
+    if TIMING_HEADERS or wsgi.query_flag(request.headers.get('x-timing')):
+        response.headers['Server-Timing'] = server_timing(timings, elapsed)
+
+
+async def index(request):
+    return PlainTextResponse('Server Works!')
+
+
+async def stats_api(request):
+    """
+    API endpoint for the inference engine metrics.
+    """
+    metrics = wsgi.collect_stats()
+    metrics["in_flight"] = in_flight
+    return JSONResponse(metrics)
+
+
+async def metrics_api(request):
+    """
+    API endpoint for the Prometheus metrics, see the Flask endpoint.
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type='text/plain; version=0.0.4')
+
+
+@bounded
+async def detect_api(request):
+    """
+    API endpoint for detecting objects in an image, with the same contract as the Flask endpoint.
+
+    Returns
+    -------
+    starlette.responses.Response
+        A response containing the detected objects and their properties in the negotiated format.
+    """
+    try:
+        im_data = await read_body(request)
+        if im_data is None:
+            return too_large()
+        if not im_data:
+            return PlainTextResponse("Error: Request data is empty")
+        query = wsgi.parse_detect_query(*(request.query_params.get(name) for name in wsgi.DETECT_QUERY_PARAMS))
+        regions = wsgi.request_regions(*(request.query_params.get(name) for name in wsgi.REGION_PARAMS))
+        media_type = wsgi.negotiate_detect_type(request.headers.get('accept'))
+        detections = await detect_image(im_data, tiled=wsgi.query_flag(request.query_params.get('tiled')),
+                                        query=query, regions=regions)
+        return Response(await run_cpu(wsgi.DETECT_MEDIA_TYPES[media_type], detections), media_type=media_type)
+    except ImageTooLarge as exc:
+        wsgi.record_error(DETECT_ENDPOINT, exc)
+        return too_large()
+    except InvalidQuery as exc:
+        wsgi.record_error(DETECT_ENDPOINT, exc)
+        return PlainTextResponse(f"Error: {exc}", status_code=400)
+    except Overloaded as exc:
+        wsgi.record_error(DETECT_ENDPOINT, exc)
+        return PlainTextResponse(*wsgi.shed_response(exc))
+    except Exception as exc:
+        wsgi.record_error(DETECT_ENDPOINT, exc)
+        return PlainTextResponse("Wrong data type. Make sure, that you use image")
+
+
+@bounded
+async def render_api(request):
+    """
+    API endpoint for rendering bounding boxes on an image, with the same contract as the Flask endpoint.
+
+    Returns
+    -------
+    starlette.responses.Response
+        A response containing a base64-encoded string representation of the image with the
+        bounding boxes rendered on it, or the encoded image when the Accept header asks for it.
+    """
+    try:
+        im_data = await read_body(request)
+        if im_data is None:
+            return too_large()
+        if not im_data:
+            return PlainTextResponse("Error: Request data is empty")
+        media_type = wsgi.negotiate_render_type(request.headers.get('accept'))
+        format, quality = wsgi.render_options(media_type, request.query_params.get('quality'))
+        style = wsgi.render_style(request.query_params.get('labels'), request.query_params.get('colors'))
+
+        async def compute():
+            image = await run_cpu(decode, im_data)
+            detections = await detect_image(im_data, image)
+            return await run_cpu(wsgi.render_detections, image, detections, format, quality, *style)
+
+        encoded_image = await cached('render', im_data, compute, DETECT_THRESHOLD, format, quality, *style)
+        if media_type is not None:
+            return Response(encoded_image, media_type=media_type)
+        return PlainTextResponse(base64.b64encode(encoded_image).decode("utf-8"))
+    except ImageTooLarge as exc:
+        wsgi.record_error(RENDER_ENDPOINT, exc)
+        return too_large()
+    except InvalidQuery as exc:
+        wsgi.record_error(RENDER_ENDPOINT, exc)
+        return PlainTextResponse(f"Error: {exc}", status_code=400)
+    except Overloaded as exc:
+        wsgi.record_error(RENDER_ENDPOINT, exc)
+        return PlainTextResponse(*wsgi.shed_response(exc))
+    except Exception as exc:
+        wsgi.record_error(RENDER_ENDPOINT, exc)
+        return PlainTextResponse("Wrong data type. Make sure, that you use image")
+
+
+app = Starlette(routes=[
+    Route('/', index),
+    Route(STATS_ENDPOINT, stats_api),
+    Route(METRICS_ENDPOINT, metrics_api),
+    Route(DETECT_ENDPOINT, detect_api, methods=['POST']),
+    Route(RENDER_ENDPOINT, render_api, methods=['POST']),
+])
+
+
+def run_server_asgi(port=DEFAULT_PORT, workers=INFERENCE_WORKERS):
+    """
+    Runs the asyncio API server.
+
+    Parameters
+    ----------
+    port : int, optional
+        The port to run the server on (default is 5000).
+    workers : int, optional
+        The number of model worker processes, 0 runs the model in the server
+        process (default from settings.py).
+    """
+    import uvicorn
+
+    if workers > 0:
+        wsgi.engine = wsgi.WorkerPool(workers)
+    elif MODEL_WARMUP:
+        wsgi.warm_up()
+    uvicorn.run(app, host=DEFAULT_HOST, port=port)
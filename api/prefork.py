@@ -0,0 +1,109 @@
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+import torch
+from settings import DEFAULT_HOST, DEFAULT_PORT, SERVER_PROCESSES
+from model.initialize_model import yolo
+from model.preload import freeze_heap, share_model_memory
+import api.app as wsgi
+
+logger = logging.getLogger(__name__)
+
+
+def _exit_with_supervisor(supervisor_pid):
+    # a killed supervisor cannot stop its server processes, they exit once they are orphaned
+    while os.getppid() == supervisor_pid:
+        time.sleep(1)
+    os._exit(0)
+
+
+def _serve(sock, threads):
+    from werkzeug.serving import make_server
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    threading.Thread(target=_exit_with_supervisor, args=(wsgi.supervisor_pid,), daemon=True).start()
+    torch.set_num_threads(threads)
+    wsgi.warm_up()
+    server = make_server(DEFAULT_HOST, sock.getsockname()[1], wsgi.app, threaded=True, fd=sock.fileno())
+    server.serve_forever()
+
+
+def _fork_worker(sock, threads):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            _serve(sock, threads)
+        except BaseException:
+            logger.exception("Server process %d failed", os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def run_server_prefork(port=DEFAULT_PORT, processes=SERVER_PROCESSES, threads_per_process=None):
+    """
+    Loads the model once and forks the API server processes from the loaded process. The weights
+    are moved to shared memory and the Python heap is frozen before forking, so the server
+    processes share the pages of the model instead of loading their own copy. Server processes
+    that exit are restarted.
+
+    Parameters
+    ----------
+    port : int, optional
+        The port to run the server on (default is 5000).
+    processes : int, optional
+        The number of forked server processes (default from settings.py).
+    threads_per_process : int, optional
+        The number of torch intra-op threads of every server process
+        (default is the available cores divided by processes).
+    """
+    if not hasattr(os, 'fork'):
+        raise RuntimeError("Forked server processes need a platform with os.fork")
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    threads = threads_per_process or max(1, cores // processes)
+
+    # no inference before forking, the torch thread pools must not exist in the parent
+    torch.set_num_threads(1)
+    model = yolo.load()
+    shared_bytes = share_model_memory(model)
+    logger.info("Moved %.1f MB of model weights to shared memory", shared_bytes / 2 ** 20)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((DEFAULT_HOST, port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+
+    wsgi.supervisor_pid = os.getpid()
+    freeze_heap()
+    children = {_fork_worker(sock, threads) for _ in range(processes)}
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            logger.warning("Server process %d exited with status %d, restarting it", pid, status)
+            children.add(_fork_worker(sock, threads))
+    sock.close()
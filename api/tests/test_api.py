@@ -2,9 +2,12 @@ import requests
 import pytest
 import base64
 import io
+import json
 from PIL import Image
 
-from settings import DETECT_ENDPOINT, RENDER_ENDPOINT, TEST_IMAGE_PATH, DEFAULT_HOST, DEFAULT_PORT
+from settings import (DETECT_ENDPOINT, DETECT_BATCH_ENDPOINT, RENDER_ENDPOINT, STATS_ENDPOINT, TEST_IMAGE_PATH,
+                      DEFAULT_HOST, DEFAULT_PORT)
+from util.batch_io import encode_length_prefixed
 
 
 @pytest.fixture(scope="module")
@@ -152,3 +155,116 @@ def test_render_api_empty_data():
     response = requests.post(f'http://{DEFAULT_HOST}:{DEFAULT_PORT}'+RENDER_ENDPOINT, data=None)
     assert response.status_code == 200
     assert response.text == 'Error: Request data is empty'
+
+
+def test_stats_api(test_image):
+    """
+    Test the batching engine metrics endpoint.
+
+    This function sends an image to the object detection endpoint and asserts
+    that the metrics endpoint reports at least one processed batch.
+
+    Parameters
+    ----------
+    test_image : bytes
+        A byte string representing an image in JPEG format.
+
+    Raises
+    ------
+    AssertionError
+        If the response status code is not 200 or the metrics do not contain
+        the queue depth and batch size counters.
+    """
+    requests.post(f'http://{DEFAULT_HOST}:{DEFAULT_PORT}'+DETECT_ENDPOINT, data=test_image)
+    response = requests.get(f'http://{DEFAULT_HOST}:{DEFAULT_PORT}'+STATS_ENDPOINT)
+    assert response.status_code == 200
+
+    metrics = response.json()
+    assert metrics["batches_total"] >= 1
+    assert metrics["images_total"] >= metrics["batches_total"]
+    assert "queue_depth" in metrics
+    assert "batch_size_histogram" in metrics
+
+
+@pytest.mark.parametrize("media_type, image_format", [("image/jpeg", "JPEG"), ("image/webp", "WEBP")])
+def test_render_api_binary(test_image, media_type, image_format):
+    """
+    Test the image rendering API endpoint with a binary response.
+
+    This function sends an image to the image rendering endpoint with an Accept header
+    asking for an image file and asserts that the response is the raw encoded image.
+
+    Parameters
+    ----------
+    test_image : bytes
+        A byte string representing an image in JPEG format.
+    media_type : str
+        The media type in the Accept header.
+    image_format : str
+        The expected format of the returned image.
+
+    Raises
+    ------
+    AssertionError
+        If the response status code is not 200, the content type does not match
+        the Accept header or the response data is not an image of the expected format.
+    """
+    response = requests.post(f'http://{DEFAULT_HOST}:{DEFAULT_PORT}'+RENDER_ENDPOINT, data=test_image,
+                             headers={'Accept': media_type}, params={'quality': 60})
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == media_type
+
+    image = Image.open(io.BytesIO(response.content))
+    assert image.format == image_format
+
+
+def test_detect_batch_api(test_image):
+    """
+    Test the batch object detection API endpoint with a length-prefixed stream.
+
+    This function sends two images and a string to the batch detection endpoint and asserts
+    that the response contains one NDJSON line per image, with the error reported inline.
+
+    Parameters
+    ----------
+    test_image : bytes
+        A byte string representing an image in JPEG format.
+
+    Raises
+    ------
+    AssertionError
+        If the response status code is not 200, the number of lines is wrong or
+        the lines do not contain the detected objects or the error message.
+    """
+    payload = encode_length_prefixed([test_image, b"test", test_image])
+    response = requests.post(f'http://{DEFAULT_HOST}:{DEFAULT_PORT}'+DETECT_BATCH_ENDPOINT, data=payload)
+    assert response.status_code == 200
+
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["index"] for line in lines] == [0, 1, 2]
+    assert isinstance(lines[0]["objects"], list)
+    assert lines[1]["error"] == "Wrong data type. Make sure, that you use image"
+    assert lines[2]["objects"] == lines[0]["objects"]
+
+
+def test_detect_batch_api_multipart(test_image):
+    """
+    Test the batch object detection API endpoint with multipart form data.
+
+    Parameters
+    ----------
+    test_image : bytes
+        A byte string representing an image in JPEG format.
+
+    Raises
+    ------
+    AssertionError
+        If the response status code is not 200 or the lines do not carry the file names.
+    """
+    files = [("images", ("first.jpeg", test_image)), ("images", ("second.jpeg", test_image))]
+    response = requests.post(f'http://{DEFAULT_HOST}:{DEFAULT_PORT}'+DETECT_BATCH_ENDPOINT, files=files)
+    assert response.status_code == 200
+
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["name"] for line in lines] == ["first.jpeg", "second.jpeg"]
+    assert all("objects" in line for line in lines)
@@ -0,0 +1,124 @@
+import base64
+import json
+from concurrent.futures import Future
+
+import pytest
+from starlette.testclient import TestClient
+
+import api.app as wsgi
+import api.asgi_app as asgi
+from model.detections import Detections
+from settings import ASGI_MAX_CONCURRENCY, DETECT_ENDPOINT, RENDER_ENDPOINT, TEST_IMAGE_PATH
+
+
+class StubEngine:
+    """
+    An inference engine returning one fixed detection for every image, recording the images it was given.
+    """
+    def __init__(self):
+        self.images = []
+
+    def submit(self, image, confidence_threshold, lane=None, deadline=None):
+        self.images.append(image)
+        future = Future()
+        future.set_result(Detections([[10, 20, 110, 220]], [0.9], [0], ['person']))
+        return future
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    engine = StubEngine()
+    monkeypatch.setattr(wsgi, 'engine', engine)
+    monkeypatch.setattr(wsgi, 'cache', None)
+    return engine
+
+
+@pytest.fixture
+def client(engine):
+    return TestClient(asgi.app)
+
+
+@pytest.fixture(scope="module")
+def test_image():
+    with open(TEST_IMAGE_PATH, "rb") as f:
+        return f.read()
+
+
+def test_detect_returns_the_engine_detections(client, engine, test_image):
+    """
+    Test that /detect runs the uploaded image through the engine and returns its detections.
+
+    Raises
+    ------
+    AssertionError
+        If the response is not the detection of the stub engine.
+    """
+    response = client.post(DETECT_ENDPOINT, content=test_image)
+    assert response.status_code == 200
+    objects = json.loads(response.text)["objects"]
+    assert len(engine.images) == 1 and len(objects) == 1
+    assert objects[0]["class"] == 0 and objects[0]["confidence"] == pytest.approx(0.9)
+
+
+def test_render_returns_an_image_and_validates_quality(client, test_image):
+    """
+    Test that /render returns the rendered image and rejects a quality that is not an integer.
+
+    Raises
+    ------
+    AssertionError
+        If the image is not returned or an invalid quality is accepted.
+    """
+    response = client.post(RENDER_ENDPOINT, content=test_image)
+    assert response.status_code == 200
+    assert base64.b64decode(response.text)[:2] == b'\xff\xd8'
+
+    response = client.post(RENDER_ENDPOINT, params={"quality": "high"}, content=test_image,
+                           headers={"Accept": "image/jpeg"})
+    assert response.status_code == 400
+
+
+def test_upload_limits(client, engine, test_image, monkeypatch):
+    """
+    Test that oversized uploads get 413 and invalid Content-Length headers get 400, without inference.
+
+    Raises
+    ------
+    AssertionError
+        If a rejected upload is run through the engine or gets another status.
+    """
+    monkeypatch.setattr(asgi.read_body, '__defaults__', (100,))
+    assert client.post(DETECT_ENDPOINT, content=test_image).status_code == 413
+    assert client.post(DETECT_ENDPOINT, content=test_image, headers={"Content-Length": "many"}).status_code == 400
+    assert not engine.images
+
+
+def test_requests_over_the_concurrency_limit_are_rejected(client, engine, test_image, monkeypatch):
+    """
+    Test that requests over ASGI_MAX_CONCURRENCY get 503 with a Retry-After header.
+
+    Raises
+    ------
+    AssertionError
+        If a request over the limit is handled.
+    """
+    monkeypatch.setattr(asgi, 'in_flight', ASGI_MAX_CONCURRENCY)
+    response = client.post(DETECT_ENDPOINT, content=test_image)
+    assert response.status_code == 503 and response.headers["Retry-After"] == "1"
+    assert not engine.images
+
+
+def test_render_labels_and_colors_are_opt_in(client, test_image):
+    """
+    Test that /render draws plain boxes unless the request asks for labels and class colours.
+
+    Raises
+    ------
+    AssertionError
+        If the default rendering equals the styled one.
+    """
+    plain = client.post(RENDER_ENDPOINT, content=test_image, headers={"Accept": "image/jpeg"})
+    styled = client.post(RENDER_ENDPOINT, params={"labels": "1", "colors": "1"}, content=test_image,
+                         headers={"Accept": "image/jpeg"})
+    assert plain.status_code == styled.status_code == 200
+    assert plain.content != styled.content
@@ -0,0 +1,49 @@
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+import api.app as wsgi
+from model.detections import Detections
+from settings import TEST_IMAGE_PATH
+
+
+class HoldingEngine:
+    """
+    An inference engine resolving the first image after a short delay and holding the others, recording their futures.
+    """
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, image, confidence_threshold, lane=None, deadline=None):
+        future = Future()
+        if not self.futures:
+            threading.Timer(0.1, future.set_result, [Detections.empty()]).start()
+        self.futures.append(future)
+        return future
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    engine = HoldingEngine()
+    monkeypatch.setattr(wsgi, 'engine', engine)
+    monkeypatch.setattr(wsgi, 'cache', None)
+    return engine
+
+
+def test_closed_stream_cancels_queued_images(engine):
+    """
+    Test that closing the NDJSON stream, as a disconnecting client does, cancels the images still queued.
+
+    Raises
+    ------
+    AssertionError
+        If a queued image is left for the model.
+    """
+    with open(TEST_IMAGE_PATH, "rb") as f:
+        im_data = f.read()
+    lines = wsgi.detect_stream(((str(i), im_data) for i in range(5)), window=3)
+    assert next(lines).startswith('{"index": 0, ')
+    lines.close()
+    assert len(engine.futures) == 3
+    assert [future.cancelled() for future in engine.futures] == [False, True, True]
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("gradio")
+
+import gradio_app
+from model.detections import Detections
+from settings import DEMO_CACHE_SIZE, DEMO_MIN_CONFIDENCE
+
+
+class CountingModel:
+    """
+    A model detecting one low and one high confidence object in every image, counting its calls.
+    """
+    def __init__(self):
+        self.thresholds = []
+
+    def detect(self, image, confidence_threshold):
+        self.thresholds.append(confidence_threshold)
+        return Detections([[1, 1, 5, 5], [10, 10, 20, 20]], [0.3, 0.9], [0, 1], ['low', 'high'])
+
+
+@pytest.fixture
+def model(monkeypatch):
+    model = CountingModel()
+    monkeypatch.setattr(gradio_app, 'yolo', model)
+    return model
+
+
+def test_session_detects_each_image_once(model):
+    """
+    Test that a session runs the model once per image at the lowest slider threshold and evicts
+    the least recently used images beyond DEMO_CACHE_SIZE.
+
+    Raises
+    ------
+    AssertionError
+        If a cached image is run through the model again or the cache grows beyond its size.
+    """
+    session = gradio_app.DemoSession()
+    images = [np.full((32, 32, 3), value, dtype=np.uint8) for value in range(DEMO_CACHE_SIZE + 1)]
+    session.detect(images[0])
+    session.detect(images[0].copy())
+    assert model.thresholds == [DEMO_MIN_CONFIDENCE]
+
+    for image in images[1:]:
+        session.detect(image)
+    assert len(session.images) == DEMO_CACHE_SIZE and len(model.thresholds) == DEMO_CACHE_SIZE + 1
+    session.detect(images[0])
+    assert len(model.thresholds) == DEMO_CACHE_SIZE + 2
+
+
+def test_rethreshold_filters_cached_detections(model, monkeypatch):
+    """
+    Test that moving the slider filters the cached detections of the current image without the model.
+
+    Raises
+    ------
+    AssertionError
+        If the model is run again or the drawn detections are not filtered by the threshold.
+    """
+    drawn = []
+    monkeypatch.setattr(gradio_app, 'draw_boxes', lambda image, detections, **kwargs: drawn.append(detections))
+    session = gradio_app.DemoSession()
+    gradio_app.predict(np.zeros((32, 32, 3), dtype=np.uint8), 0.25, session)
+    gradio_app.rethreshold(0.5, session)
+    assert model.thresholds == [DEMO_MIN_CONFIDENCE]
+    assert [len(detections) for detections in drawn] == [2, 1]
+    assert drawn[1].confidence.tolist() == [pytest.approx(0.9)]
@@ -38,7 +38,8 @@ class APITestUser(HttpUser):
 
         assert response.status_code == 200
         response_json = response.json()
-        assert isinstance(response_json, list)
+        assert isinstance(response_json, dict)
+        assert isinstance(response_json["objects"], list)
 
     @task
     def render(self):
@@ -48,10 +49,7 @@ class APITestUser(HttpUser):
         response = self.client.post(RENDER_ENDPOINT, data=self.image_data)
 
         assert response.status_code == 200
-        assert response.headers["Content-Type"] == "text/plain; charset=utf-8"
-        assert response.headers["Content-Encoding"] == "gzip"
-        assert response.headers["Transfer-Encoding"] == "chunked"
-        assert response.headers["Connection"] == "keep-alive"
+        assert response.headers["Content-Type"] == "text/html; charset=utf-8"
 
         image_data = base64.b64decode(response.text)
         assert isinstance(image_data, bytes)
@@ -0,0 +1,282 @@
+import argparse
+import base64
+import json
+import math
+import platform
+import statistics
+import sys
+import time
+import cv2
+import numpy as np
+import torch
+from torch import nn
+from model.yolov5 import YOLOv5
+from util.df_to_json import (detections_to_json, format_detections, detections_to_columns_json, detections_to_msgpack,
+                             detections_to_packed)
+from util.draw_bbox import draw_boxes
+from util.image_utils import decode_image, encode_image
+from settings import INPUT_SIZE, MODEL_BACKEND, RENDER_JPEG_QUALITY, RENDER_LABELS, RENDER_CLASS_COLORS
+
+STAGES = ('decode', 'preprocess', 'forward', 'postprocess', 'format_detections', 'detections_to_json',
+          'detections_to_columns_json', 'detections_to_msgpack', 'detections_to_packed', 'draw', 'encode')
+IMAGE_SIZES = ((320, 240), (640, 480), (1280, 720), (1920, 1080), (3840, 2160))
+DETECTION_COUNTS = (0, 10, 100)
+BATCH_SIZES = (1, 4, 8)
+
+
+class StubNetwork(nn.Module):
+    """
+    A network without weights returning a fixed number of well separated confident boxes per image,
+    among as many candidate boxes as YOLOv5s predicts for a 640x640 input, so everything except the
+    forward pass costs what it costs with the real model.
+
+    Parameters
+    ----------
+    detections : int
+        the number of boxes per image left after non-maximum suppression
+    candidates : int, optional
+        the number of predicted boxes per image (default is 25200)
+    classes : int, optional
+        the number of classes (default is 80)
+    """
+    def __init__(self, detections, candidates=25200, classes=80):
+        super().__init__()
+        self.names = {i: f'class{i}' for i in range(classes)}
+        prediction = torch.zeros(candidates, 5 + classes)
+        prediction[:, 4] = 0.001
+        side = max(math.ceil(math.sqrt(detections)), 1)
+        cell = INPUT_SIZE / side
+        for i in range(detections):
+            row, col = divmod(i, side)
+            prediction[i, :4] = torch.tensor([(col + 0.5) * cell, (row + 0.5) * cell, 0.8 * cell, 0.8 * cell])
+            prediction[i, 4] = 0.9
+            prediction[i, 5 + i % classes] = 0.9
+        self.register_buffer('prediction', prediction)
+
+    def forward(self, x):
+        return (self.prediction.expand(x.shape[0], -1, -1).contiguous(),)
+
+
+def synthetic_image(width, height, seed=0):
+    """
+    Generates a deterministic test image that compresses like a photo: smooth gradients with noise
+    and a few filled shapes.
+
+    Parameters:
+    width: int. The width of the image.
+    height: int. The height of the image.
+    seed: int. The seed of the noise.
+
+    Returns:
+    image: numpy.ndarray. An RGB uint8 array of shape (height, width, 3).
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    image = np.stack([x * 255 // max(width - 1, 1), y * 255 // max(height - 1, 1),
+                      (x + y) * 255 // max(width + height - 2, 1)], axis=-1).astype(np.int16)
+    image += rng.integers(-12, 13, size=image.shape, dtype=np.int16)
+    image = np.clip(image, 0, 255).astype(np.uint8)
+    for _ in range(8):
+        x1, x2 = sorted(rng.integers(0, width, 2))
+        y1, y2 = sorted(rng.integers(0, height, 2))
+        image[y1:y2, x1:x2] = rng.integers(0, 256, 3)
+    return image
+
+
+def _summary(latencies, batch_size):
+    ordered = sorted(latencies)
+    median = statistics.median(ordered)
+    return {
+        'median_ms': round(median, 4),
+        'p90_ms': round(ordered[min(int(0.9 * len(ordered)), len(ordered) - 1)], 4),
+        'min_ms': round(ordered[0], 4),
+        'mean_ms': round(statistics.fmean(ordered), 4),
+        'per_image_ms': round(median / batch_size, 4),
+    }
+
+
+def _run_pipeline(model, payloads, confidence_threshold):
+    timings = {}
+    started = time.perf_counter()
+
+    def lap(stage):
+        nonlocal started
+        now = time.perf_counter()
+        timings[stage] = (now - started) * 1000
+        started = now
+
+    images = [decode_image(payload) for payload in payloads]
+    lap('decode')
+    batch, letterboxes = model.preprocess(images)
+    lap('preprocess')
+    with torch.no_grad():
+        prediction = model.forward(batch)
+    lap('forward')
+    results = model.postprocess(prediction, letterboxes, [confidence_threshold] * len(images))
+    lap('postprocess')
+    for detections in results:
+        format_detections(detections)
+    lap('format_detections')
+    for detections in results:
+        detections_to_json(detections)
+    lap('detections_to_json')
+    for serializer in (detections_to_columns_json, detections_to_msgpack, detections_to_packed):
+        for detections in results:
+            serializer(detections)
+        lap(serializer.__name__)
+    for image, detections in zip(images, results):
+        draw_boxes(image, detections, labels=RENDER_LABELS, per_class_colors=RENDER_CLASS_COLORS)
+    lap('draw')
+    for image in images:
+        base64.b64encode(encode_image(image, 'JPEG', RENDER_JPEG_QUALITY, overwrite=True))
+    lap('encode')
+    return timings, sum(len(detections) for detections in results)
+
+
+def benchmark_case(model, payloads, repeat, confidence_threshold=0.25):
+    """
+    Runs the detect and render pipeline on a batch of encoded images and times every stage.
+
+    Parameters:
+    model: YOLOv5. The model, with a real or a stub network.
+    payloads: list of bytes. The encoded images of the batch.
+    repeat: int. The number of timed runs, after one warm-up run.
+    confidence_threshold: float. The confidence threshold for object detection.
+
+    Returns:
+    result: dict. Latency statistics per stage and for the whole pipeline, and the number of detections per image.
+    """
+    _run_pipeline(model, payloads, confidence_threshold)
+    stages = {stage: [] for stage in STAGES}
+    totals = []
+    for _ in range(repeat):
+        timings, detected = _run_pipeline(model, payloads, confidence_threshold)
+        for stage, elapsed in timings.items():
+            stages[stage].append(elapsed)
+        totals.append(sum(timings.values()))
+    batch_size = len(payloads)
+    return {
+        'detections_per_image': detected / batch_size,
+        'stages': {stage: _summary(latencies, batch_size) for stage, latencies in stages.items()},
+        'total': _summary(totals, batch_size),
+    }
+
+
+def run_benchmarks(image_sizes=IMAGE_SIZES, detection_counts=DETECTION_COUNTS, batch_sizes=BATCH_SIZES,
+                   repeat=10, weights=None):
+    """
+    Benchmarks every combination of image size, detection count and batch size.
+
+    Parameters:
+    image_sizes: list of (int, int). The widths and heights of the test images.
+    detection_counts: list of int. The numbers of boxes the stub network detects per image,
+    ignored with real weights where the image decides.
+    batch_sizes: list of int. The numbers of images run through the model at once.
+    repeat: int. The number of timed runs of every combination.
+    weights: YOLOv5 or None. The model with real weights, None benchmarks stub networks.
+
+    Returns:
+    results: list of dict. One entry per combination with its parameters and latency statistics.
+    """
+    models = {None: weights} if weights is not None else {
+        count: YOLOv5(device='cpu', backend='torch', network=StubNetwork(count)) for count in detection_counts}
+    results = []
+    for width, height in image_sizes:
+        payloads = [encode_image(synthetic_image(width, height, seed), 'JPEG', 90) for seed in range(max(batch_sizes))]
+        for count, model in models.items():
+            for batch_size in batch_sizes:
+                result = {'image_size': [width, height], 'detections': count, 'batch_size': batch_size}
+                result.update(benchmark_case(model, payloads[:batch_size], repeat))
+                results.append(result)
+    return results
+
+
+def _case_key(result):
+    return tuple(result['image_size']), result['detections'], result['batch_size']
+
+
+def find_regressions(results, baseline, tolerance=0.2, noise_floor_ms=0.05):
+    """
+    Compares benchmark results with the results of an earlier run.
+
+    Parameters:
+    results: list of dict. The results of run_benchmarks.
+    baseline: list of dict. The results of the earlier run.
+    tolerance: float. The allowed relative slowdown of a median latency.
+    noise_floor_ms: float. Slowdowns smaller than this many milliseconds are ignored.
+
+    Returns:
+    regressions: list of dict. The combinations and stages whose median latency got slower than allowed.
+    """
+    previous = {_case_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(_case_key(result))
+        if before is None:
+            continue
+        stages = dict(result['stages'], total=result['total'])
+        stages_before = dict(before['stages'], total=before['total'])
+        for stage, stats in stages.items():
+            if stage not in stages_before:
+                continue
+            old, new = stages_before[stage]['median_ms'], stats['median_ms']
+            if new - old > noise_floor_ms and new > old * (1 + tolerance):
+                regressions.append({'image_size': result['image_size'], 'detections': result['detections'],
+                                    'batch_size': result['batch_size'], 'stage': stage,
+                                    'baseline_ms': old, 'median_ms': new, 'ratio': round(new / old, 2)})
+    return regressions
+
+
+def _environment(threads, weights):
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'threads': threads,
+        'model': MODEL_BACKEND if weights else 'stub',
+        'input_size': INPUT_SIZE,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the detect and render pipeline')
+    parser.add_argument('--sizes', nargs='+', default=[f'{w}x{h}' for w, h in IMAGE_SIZES],
+                        help='Image sizes as WIDTHxHEIGHT')
+    parser.add_argument('--detections', nargs='+', type=int, default=list(DETECTION_COUNTS),
+                        help='Numbers of boxes the stub network detects per image')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=list(BATCH_SIZES), help='Batch sizes')
+    parser.add_argument('--repeat', type=int, default=10, help='Number of timed runs of every combination')
+    parser.add_argument('--threads', type=int, default=1, help='Number of torch and OpenCV threads')
+    parser.add_argument('--weights', action='store_true', default=False,
+                        help='Benchmark the real model from settings.py instead of stub networks')
+    parser.add_argument('--output', type=str, default=None, help='JSON file the results are written to')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='JSON file of an earlier run, exits with an error on slower stages')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative slowdown against the baseline')
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    cv2.setNumThreads(args.threads)
+    weights = YOLOv5(device='cpu') if args.weights else None
+    sizes = [tuple(int(v) for v in size.lower().split('x')) for size in args.sizes]
+
+    report = {
+        'environment': _environment(args.threads, weights),
+        'results': run_benchmarks(sizes, args.detections, args.batch_sizes, args.repeat, weights),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(report['results'], json.load(f)['results'], args.tolerance)
+        for regression in regressions:
+            print(json.dumps(regression), file=sys.stderr)
+        sys.exit(1 if regressions else 0)
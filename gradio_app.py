@@ -1,40 +1,89 @@
+import hashlib
+from collections import OrderedDict
 import gradio as gr
-from util.image_utils import decode_img
-from settings import DEFAULT_HOST, DEFAULT_PORT
-from model.initialize_model import yolo
+import numpy as np
+from settings import (DEFAULT_HOST, DEFAULT_PORT, MODEL_WARMUP, DETECT_THRESHOLD, RENDER_LABELS, RENDER_CLASS_COLORS,
+                      DEMO_MIN_CONFIDENCE, DEMO_CACHE_SIZE, DEMO_CONCURRENCY)
+from model.initialize_model import yolo, warm_up
+from util.draw_bbox import draw_boxes
 
 
-def predict(input_image, confidence):
+class DemoSession:
     """
-    This function takes an input image and a confidence score,
-    and returns an output image with detected objects.
+    The state of one demo session: the detections of the last uploaded images, found once at the
+    lowest threshold of the slider.
+    """
+    def __init__(self):
+        self.images = OrderedDict()
+        self.current = None
+
+    def detect(self, image):
+        """
+        This function selects an uploaded image, running detection on it unless its detections are cached.
+        """
+        key = hashlib.blake2b(np.ascontiguousarray(image), digest_size=16).digest()
+        if key not in self.images:
+            self.images[key] = (image, yolo.detect(image, DEMO_MIN_CONFIDENCE))
+            while len(self.images) > DEMO_CACHE_SIZE:
+                self.images.popitem(last=False)
+        self.images.move_to_end(key)
+        self.current = key
+
+    def render(self, confidence):
+        """
+        This function draws the cached detections of the current image above a confidence threshold.
+        """
+        image, detections = self.images[self.current]
+        return draw_boxes(image.copy(), detections.threshold(confidence), labels=RENDER_LABELS,
+                          per_class_colors=RENDER_CLASS_COLORS)
+
+
+def predict(input_image, confidence, session):
+    """
+    This function takes an uploaded image and a confidence score, detects objects in the image once
+    and returns the image with the detected objects above the confidence score.
     If the input image is not a valid image file, it returns an error message.
     """
+    if input_image is None:
+        session.current = None
+        return None
     try:
-        return decode_img(yolo.render(input_image, confidence))
+        session.detect(input_image)
     except TypeError:
         return "Error: Input image must be a valid image file"
+    return session.render(confidence)
+
+
+def rethreshold(confidence, session):
+    """
+    This function redraws the current image for a new confidence score without running the model.
+    """
+    if session.current is None:
+        return gr.update()
+    return session.render(confidence)
 
 
 def run_server(port=DEFAULT_PORT):
     """
     This function launches the Gradio interface on the specified port.
     """
+    if MODEL_WARMUP:
+        warm_up()
+    iface.queue(concurrency_count=DEMO_CONCURRENCY)
     iface.launch(server_name=DEFAULT_HOST, server_port=port, share=True)
 
 
-iface = gr.Interface(
-    fn=predict,
-    inputs=[gr.Image(type="pil"), gr.inputs.Slider(minimum=0.1,
-                                                   maximum=1,
-                                                   step=0.1,
-                                                   default=0.25)],
-    outputs="image",
-    title="YOLOv5 Object Detection",
-    description="Detect objects in an image using the YOLOv5 model",
-    live=True,
-    layout="vertical"
-)
+with gr.Blocks(title="YOLOv5 Object Detection") as iface:
+    gr.Markdown("# YOLOv5 Object Detection\nDetect objects in an image using the YOLOv5 model")
+    session_state = gr.State(DemoSession())
+    input_image = gr.Image(type="numpy", label="Image")
+    confidence_slider = gr.Slider(minimum=DEMO_MIN_CONFIDENCE, maximum=1, step=0.05, value=DETECT_THRESHOLD,
+                                  label="Confidence")
+    output_image = gr.Image(type="numpy", label="Detections")
+
+    input_image.change(predict, [input_image, confidence_slider, session_state], output_image)
+    # redraws once the slider is released instead of for every intermediate value while it is dragged
+    confidence_slider.release(rethreshold, [confidence_slider, session_state], output_image, show_progress=False)
 
 if __name__ == "__main__":
     run_server(port=5000)
@@ -0,0 +1,182 @@
+import queue
+import threading
+from collections import deque, namedtuple
+from contextvars import ContextVar
+
+Admission = namedtuple('Admission', ['lane', 'deadline'])
+Admission.__doc__ = """
+The scheduling of a request: the name of its priority lane, None for the highest priority lane, and
+the time.monotonic() time its result is useless after, None for no deadline.
+"""
+
+_admission = ContextVar('admission', default=Admission(None, None))
+
+
+class Overloaded(RuntimeError):
+    """
+    Raised when the inference engine sheds a request instead of running it.
+
+    Attributes
+    ----------
+    retry_after : float
+        the estimated time in seconds until the engine has room for the request
+    """
+    def __init__(self, message, retry_after=1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        # keeps retry_after when the exception is sent back from a model worker process
+        return type(self), (self.args[0], self.retry_after)
+
+
+class QueueFull(Overloaded):
+    """
+    Raised when the priority lane of a request already holds the maximum number of images.
+    """
+
+
+class DeadlineExceeded(Overloaded):
+    """
+    Raised when the deadline of a request passed, or passes before the model can run it.
+    """
+
+
+def start_admission(lane=None, deadline=None):
+    """
+    Sets the priority lane and deadline of the inference requests made in the current context.
+
+    Parameters
+    ----------
+    lane : str, optional
+        the priority lane, None for the highest priority lane (default is None)
+    deadline : float, optional
+        the time.monotonic() deadline, None for no deadline (default is None)
+
+    Returns
+    -------
+    token : contextvars.Token
+    the token to pass to finish_admission
+    """
+    return _admission.set(Admission(lane, deadline))
+
+
+def finish_admission(token):
+    """
+    Restores the scheduling of the context before the matching start_admission.
+
+    Parameters
+    ----------
+    token : contextvars.Token
+        the token returned by start_admission
+    """
+    _admission.reset(token)
+
+
+def current_admission():
+    """
+    Returns the scheduling of the inference requests made in the current context.
+
+    Returns
+    -------
+    admission : Admission
+    """
+    return _admission.get()
+
+
+class LaneQueue:
+    """
+    A queue with one FIFO lane per priority. Items are taken from the highest priority lane
+    holding any, every lane holds at most max_depth items.
+
+    Attributes
+    ----------
+    lanes : tuple of str
+        the lane names, highest priority first
+
+    Parameters
+    ----------
+    priorities : dict
+        the priority of every lane, lower values are served first
+    max_depth : int
+        the maximum number of items of a lane, 0 for no limit
+    """
+    def __init__(self, priorities, max_depth):
+        self.lanes = tuple(sorted(priorities, key=priorities.get))
+        self.max_depth = max_depth
+        self._lanes = {lane: deque() for lane in self.lanes}
+        self._size = 0
+        self._not_empty = threading.Condition()
+
+    def lane(self, name):
+        """
+        Resolves a lane name, None being the highest priority lane.
+
+        Raises
+        ------
+        ValueError
+            if there is no such lane
+        """
+        if name is None:
+            return self.lanes[0]
+        if name not in self._lanes:
+            raise ValueError(f"Unknown priority lane {name!r}")
+        return name
+
+    def put(self, item, lane):
+        """
+        Appends an item to a lane.
+
+        Raises
+        ------
+        QueueFull
+            if the lane already holds max_depth items
+        """
+        with self._not_empty:
+            items = self._lanes[lane]
+            if self.max_depth and len(items) >= self.max_depth:
+                raise QueueFull(f"Too many requests waiting in the {lane!r} lane")
+            items.append(item)
+            self._size += 1
+            self._not_empty.notify()
+
+    def get(self, timeout=None):
+        """
+        Removes and returns the oldest item of the highest priority non-empty lane.
+
+        Raises
+        ------
+        queue.Empty
+            if no item arrives within timeout seconds
+        """
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: self._size, timeout):
+                raise queue.Empty
+            self._size -= 1
+            return next(items for items in self._lanes.values() if items).popleft()
+
+    def get_nowait(self):
+        return self.get(timeout=0)
+
+    def qsize(self):
+        return self._size
+
+    def ahead(self, lane):
+        """
+        Returns the number of items taken before a new item of a lane: the items of that lane and
+        of the lanes with a higher priority.
+        """
+        with self._not_empty:
+            count = 0
+            for name in self.lanes:
+                count += len(self._lanes[name])
+                if name == lane:
+                    return count
+        return count
+
+    def depths(self):
+        """
+        Returns the number of items of every lane.
+        """
+        with self._not_empty:
+            return {lane: len(items) for lane, items in self._lanes.items()}
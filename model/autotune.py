@@ -0,0 +1,255 @@
+import json
+import logging
+import os
+import platform
+import statistics
+import time
+from collections import namedtuple
+import torch
+from model.detections import match_detections
+from settings import AUTOTUNE_PROFILE, AUTOTUNE_RUNS, DETECT_THRESHOLD, TEST_IMAGE_PATH
+
+logger = logging.getLogger(__name__)
+
+TuneConfig = namedtuple('TuneConfig', ['intra_threads', 'inter_threads', 'channels_last', 'precision'])
+TuneConfig.__doc__ = """
+A runtime configuration of the model: the number of torch intra-op and inter-op threads, whether
+inputs and weights use the channels-last memory format, and the precision, 'float32' or 'bfloat16'.
+"""
+
+# Backends whose network runs eagerly, the only ones supporting channels-last weights and bf16 autocast
+EAGER_BACKENDS = ('torch',)
+# Backends whose CPU threads are torch threads
+TORCH_THREAD_BACKENDS = ('torch', 'torchscript', 'int8')
+# Minimum speedup of channels-last or bf16 over the current best configuration for them to be picked
+MIN_SPEEDUP = 1.05
+# Minimum fraction of the float32 detections of the test image bf16 has to find
+MIN_BF16_AGREEMENT = 0.95
+
+
+def bf16_supported():
+    """
+    Checks whether the CPU runs bf16 natively, with the AVX-512 BF16 or AMX instructions.
+
+    Returns
+    -------
+    supported : bool
+    """
+    check = getattr(torch.ops.mkldnn, '_is_mkldnn_bf16_supported', None)
+    try:
+        if check is not None and not check():
+            return False
+    except RuntimeError:
+        return False
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = next((line for line in f if line.startswith('flags')), '').split()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+def _cpu_name():
+    try:
+        with open('/proc/cpuinfo') as f:
+            return next((line.split(':', 1)[1].strip() for line in f if line.startswith('model name')),
+                        platform.processor())
+    except OSError:
+        return platform.processor()
+
+
+def profile_key(model, core_budget):
+    """
+    Builds the key of the tuned configuration of a model on the current host.
+
+    Parameters
+    ----------
+    model : YOLOv5
+        the loaded model
+    core_budget : int
+        the number of cores the process may use
+
+    Returns
+    -------
+    key : str
+    """
+    weights = os.path.basename(model.weights_path) if model.weights_path else type(model.model).__name__
+    return '|'.join([_cpu_name(), str(core_budget), torch.__version__, model.backend.name, weights,
+                     'x'.join(map(str, model.input_size))])
+
+
+def apply_config(model, config):
+    """
+    Applies a configuration to the model and the torch thread pools.
+
+    Parameters
+    ----------
+    model : YOLOv5
+        the loaded model
+    config : TuneConfig
+        the configuration
+    """
+    torch.set_num_threads(config.intra_threads)
+    try:
+        torch.set_num_interop_threads(config.inter_threads)
+    except RuntimeError:
+        # the inter-op pool can only be sized before it starts, it keeps its size for the process
+        pass
+    if model.backend.name in EAGER_BACKENDS:
+        # converting weights in shared memory would give every forked server process its own copy of them
+        channels_last = config.channels_last and not _weights_shared(model)
+        model.model.to(memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+        model.channels_last = channels_last
+        model.precision = config.precision
+
+
+def _weights_shared(model):
+    return any(parameter.is_shared() for parameter in model.model.parameters())
+
+
+def _time_forward(model, batch, runs):
+    with torch.no_grad():
+        model.forward(batch)
+        times = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            model.forward(batch)
+            times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def _thread_counts(core_budget):
+    counts = []
+    threads = core_budget
+    while threads >= 1 and len(counts) < 4:
+        counts.append(threads)
+        threads //= 2
+    return counts
+
+
+def _load_profile(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_profile(path, profile):
+    # forked server processes tune at the same time, every one writes its own temporary file
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(profile, f, indent=1)
+    os.replace(temporary, path)
+
+
+def _agreement(model, reference_config, config, image_path=TEST_IMAGE_PATH):
+    batch, letterboxes = model.preprocess([image_path])
+    detections = []
+    for candidate in (reference_config, config):
+        apply_config(model, candidate)
+        with torch.no_grad():
+            detections.append(model.postprocess(model.forward(batch), letterboxes, [DETECT_THRESHOLD])[0])
+    match = match_detections(*detections)
+    return match['matched'] / max(match['reference'], match['candidate']) if len(detections[0]) else 1.0
+
+
+def benchmark_configs(model, core_budget, runs=AUTOTUNE_RUNS, batch_size=1):
+    """
+    Finds the fastest configuration of the model on synthetic batches, in stages: the intra-op thread
+    count first, then channels-last, unless the weights are shared with forked processes, and bf16 on
+    top of the fastest thread count, each kept only when it is at least MIN_SPEEDUP faster. bf16 is
+    also only kept when it finds the float32 detections of the test image.
+
+    The inter-op thread pool can only be sized once per process, before it starts, so its size is not
+    measured: the YOLOv5 forward pass runs its layers one after another and a single inter-op thread
+    keeps the core budget for the intra-op threads.
+
+    Parameters
+    ----------
+    model : YOLOv5
+        the loaded model on the CPU
+    core_budget : int
+        the number of cores the process may use
+    runs : int, optional
+        the number of timed forward passes per configuration (default from settings.py)
+    batch_size : int, optional
+        the number of synthetic images per forward pass (default is 1)
+
+    Returns
+    -------
+    config : TuneConfig
+        the fastest configuration
+    timings : dict
+        the median forward latency in seconds of every measured configuration
+    """
+    batch = torch.rand(batch_size, 3, model.input_size[1], model.input_size[0])
+    timings = {}
+
+    def measure(config):
+        apply_config(model, config)
+        timings[config] = _time_forward(model, batch, runs)
+        return timings[config]
+
+    best = min((TuneConfig(threads, 1, False, 'float32') for threads in _thread_counts(core_budget)), key=measure)
+    if model.backend.name in EAGER_BACKENDS:
+        for option in ({'channels_last': True} if not _weights_shared(model) else None,
+                       {'precision': 'bfloat16'} if bf16_supported() else None):
+            if option is None:
+                continue
+            candidate = best._replace(**option)
+            if measure(candidate) * MIN_SPEEDUP >= timings[best]:
+                continue
+            if candidate.precision != best.precision and _agreement(model, best, candidate) < MIN_BF16_AGREEMENT:
+                logger.info("bf16 changes the detections of the test image, keeping float32")
+                continue
+            best = candidate
+    apply_config(model, best)
+    return best, timings
+
+
+def autotune(model, core_budget=None, profile_path=AUTOTUNE_PROFILE, runs=AUTOTUNE_RUNS):
+    """
+    Applies the fastest configuration of the model for the current host and core budget. The
+    configuration is read from the profile when this host, budget and model were tuned before,
+    otherwise it is measured and added to the profile.
+
+    Parameters
+    ----------
+    model : YOLOv5
+        the loaded model
+    core_budget : int, optional
+        the number of cores the process may use (default is the current torch thread count)
+    profile_path : str, optional
+        the JSON file the tuned configurations are stored in (default from settings.py)
+    runs : int, optional
+        the number of timed forward passes per configuration (default from settings.py)
+
+    Returns
+    -------
+    config : TuneConfig or None
+    the applied configuration, None for models on the GPU and ONNX Runtime backends
+    """
+    if model.device != 'cpu' or model.backend.name not in TORCH_THREAD_BACKENDS:
+        return None
+    core_budget = core_budget or torch.get_num_threads()
+    key = profile_key(model, core_budget)
+    profile = _load_profile(profile_path)
+    if key in profile:
+        config = TuneConfig(**profile[key])
+        apply_config(model, config)
+        logger.info("Applied tuned configuration %s", config)
+        return config
+
+    started = time.perf_counter()
+    config, timings = benchmark_configs(model, core_budget, runs)
+    logger.info("Tuned %s in %.1f s: %s", key, time.perf_counter() - started, ', '.join(
+        '%s=%.1f ms' % (tuple(c), t * 1000) for c, t in timings.items()))
+    profile = _load_profile(profile_path)
+    profile[key] = config._asdict()
+    try:
+        _save_profile(profile_path, profile)
+    except OSError as exc:
+        logger.warning("Could not save the tuned configuration to %s: %s", profile_path, exc)
+    return config
@@ -0,0 +1,315 @@
+import copy
+import inspect
+import json
+import os
+import numpy as np
+import torch
+from torch import nn
+from util.image_utils import letterbox_image, load_image
+from settings import TEST_IMAGE_PATH, QUANT_CALIBRATION_IMAGES, ONNX_OPSET, BACKEND_THREADS
+
+
+def detection_model(model):
+    """
+    Finds the YOLOv5 DetectionModel inside the network returned by load_model.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        the loaded network, a DetectionModel or a torch.hub wrapper around one
+
+    Returns
+    -------
+    model : torch.nn.Module
+    the DetectionModel, with its layers in 'model.model' and the Detect head last
+    """
+    while not isinstance(getattr(model, 'model', None), nn.Sequential):
+        inner = getattr(model, 'model', None)
+        if not isinstance(inner, nn.Module):
+            raise ValueError("the network is not a YOLOv5 DetectionModel, export it from a '.pt' checkpoint")
+        model = inner
+    return model
+
+
+def export_path(weights_path, suffix):
+    """
+    Returns the path of an export stored next to the weights it is made from.
+
+    Parameters
+    ----------
+    weights_path : str
+        the path to the weights
+    suffix : str
+        the file extension of the export, for example '.onnx'
+
+    Returns
+    -------
+    path : str
+    the path of the export
+    """
+    return os.path.splitext(weights_path)[0] + suffix
+
+
+def _raw_prediction(prediction):
+    if isinstance(prediction, (list, tuple)):
+        prediction = prediction[0]
+    return prediction
+
+
+class TorchBackend:
+    """
+    Runs the eager PyTorch network.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        the loaded network
+    """
+    name = 'torch'
+
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, batch):
+        """
+        Runs the network on a batch of letterboxed images.
+
+        Parameters
+        ----------
+        batch : torch.Tensor
+            a float tensor of shape (batch, 3, height, width) with values in [0, 1]
+
+        Returns
+        -------
+        prediction : torch.Tensor
+        the raw predictions of shape (batch, boxes, 5 + classes)
+        """
+        return _raw_prediction(self.model(batch))
+
+
+class TorchScriptBackend(TorchBackend):
+    """
+    Runs a traced and frozen TorchScript graph of the network. The trace is saved next to the
+    weights as a '.torchscript' file that load_model reads as well, so later starts skip tracing.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        the loaded network
+    device : str
+        the device the network runs on
+    input_size : tuple of int
+        the height and width of the model input
+    weights_path : str, optional
+        the path to the weights the trace is stored next to, None does not store it
+    """
+    name = 'torchscript'
+
+    def __init__(self, model, device, input_size, weights_path=None):
+        if isinstance(model, torch.jit.ScriptModule):
+            super().__init__(model)
+            return
+        path = export_path(weights_path, '.torchscript') if weights_path else None
+        if path and os.path.exists(path):
+            super().__init__(torch.jit.load(path, map_location=device))
+            return
+
+        example = torch.zeros(1, 3, *input_size, device=device)
+        with torch.no_grad():
+            # the first call builds the anchor grids, the trace then treats them as constants
+            model(example)
+            traced = torch.jit.trace(model, example, strict=False, check_trace=False)
+        if path:
+            names = model.names if isinstance(model.names, dict) else dict(enumerate(model.names))
+            torch.jit.save(traced, path, _extra_files={'config.txt': json.dumps({'names': names})})
+        super().__init__(torch.jit.freeze(traced))
+
+
+class Features(nn.Module):
+    """
+    The backbone and neck of a DetectionModel, returning the feature maps the Detect head reads.
+    Unlike the DetectionModel its forward pass has no data-dependent control flow, so it can be
+    symbolically traced for static quantization.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        the DetectionModel
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.layers = model.model[:-1]
+        self.sources = [layer.f for layer in self.layers]
+        self.head_sources = model.model[-1].f
+
+    def forward(self, x):
+        y = []
+        for layer, f in zip(self.layers, self.sources):
+            if f != -1:
+                x = y[f] if isinstance(f, int) else [x if j == -1 else y[j] for j in f]
+            x = layer(x)
+            y.append(x)
+        return [y[j] for j in self.head_sources]
+
+
+def calibration_batches(input_size, image_paths=None, batch_size=4):
+    """
+    Letterboxes the calibration images of static quantization into model input batches.
+
+    Parameters
+    ----------
+    input_size : tuple of int
+        the height and width of the model input
+    image_paths : list of str, optional
+        the calibration images (default from settings.py, or the test image)
+    batch_size : int, optional
+        the number of images per batch (default is 4)
+
+    Returns
+    -------
+    batches : list of torch.Tensor
+    the float input batches
+    """
+    image_paths = image_paths or QUANT_CALIBRATION_IMAGES or [TEST_IMAGE_PATH]
+    images = np.empty((len(image_paths), 3, *input_size), dtype=np.float32)
+    for path, out in zip(image_paths, images):
+        letterbox_image(load_image(path), out)
+    return [torch.from_numpy(images[i:i + batch_size]) for i in range(0, len(images), batch_size)]
+
+
+class QuantizedBackend:
+    """
+    Runs the backbone and neck of the network statically quantized to INT8 and the Detect head in
+    float. Dynamic quantization only covers linear and recurrent layers, not the convolutions that
+    make up almost all of YOLOv5, so the convolutions are quantized with observers calibrated on
+    real images.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        the loaded network, on the CPU
+    input_size : tuple of int
+        the height and width of the model input
+    image_paths : list of str, optional
+        the calibration images (default from settings.py, or the test image)
+    """
+    name = 'int8'
+
+    def __init__(self, model, input_size, image_paths=None):
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+        model = detection_model(model)
+        engines = torch.backends.quantized.supported_engines
+        engine = 'x86' if 'x86' in engines else 'qnnpack' if 'qnnpack' in engines else engines[0]
+        torch.backends.quantized.engine = engine
+
+        batches = calibration_batches(input_size, image_paths)
+        prepared = prepare_fx(copy.deepcopy(Features(model)).eval(), get_default_qconfig_mapping(engine),
+                              (batches[0],))
+        with torch.no_grad():
+            for batch in batches:
+                prepared(batch)
+        self.features = convert_fx(prepared)
+        self.head = model.model[-1]
+
+    def __call__(self, batch):
+        """
+        Runs the network on a batch of letterboxed images, see TorchBackend.
+        """
+        return _raw_prediction(self.head(self.features(batch)))
+
+
+class OnnxRuntimeBackend:
+    """
+    Runs an ONNX export of the network with ONNX Runtime on the CPU. The export has a dynamic batch
+    axis and is saved next to the weights, so later starts skip exporting.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        the loaded network
+    input_size : tuple of int
+        the height and width of the model input
+    weights_path : str
+        the path to the weights the export is stored next to
+    quantize : bool, optional
+        whether to run a dynamically INT8-quantized copy of the export (default is False)
+    threads : int, optional
+        the number of threads of an inference, 0 lets ONNX Runtime decide (default from settings.py)
+    """
+    name = 'onnx'
+
+    def __init__(self, model, input_size, weights_path, quantize=False, threads=BACKEND_THREADS):
+        import onnxruntime
+
+        path = export_path(weights_path, '.onnx')
+        if not os.path.exists(path):
+            example = torch.zeros(1, 3, *input_size)
+            # newer torch releases export through dynamo unless told not to, torch 1.13 has no such option
+            legacy = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+            with torch.no_grad():
+                torch.onnx.export(model.cpu(), example, path, input_names=['images'], output_names=['output'],
+                                  dynamic_axes={'images': {0: 'batch'}, 'output': {0: 'batch'}},
+                                  opset_version=ONNX_OPSET, **legacy)
+        if quantize:
+            self.name = 'onnx-int8'
+            quantized_path = export_path(weights_path, '.int8.onnx')
+            if not os.path.exists(quantized_path):
+                from onnxruntime.quantization import QuantType, quantize_dynamic
+                quantize_dynamic(path, quantized_path, weight_type=QuantType.QUInt8)
+            path = quantized_path
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_name = self.session.get_outputs()[0].name
+
+    def __call__(self, batch):
+        """
+        Runs the network on a batch of letterboxed images, see TorchBackend.
+        """
+        prediction = self.session.run([self.output_name], {self.input_name: batch.cpu().numpy()})[0]
+        return torch.from_numpy(prediction).to(batch.device)
+
+
+BACKENDS = ('torch', 'torchscript', 'int8', 'onnx', 'onnx-int8')
+
+
+def create_backend(name, model, device, input_size, weights_path=None):
+    """
+    Builds an inference backend from the loaded network.
+
+    Parameters
+    ----------
+    name : str
+        the backend, one of BACKENDS
+    model : torch.nn.Module
+        the loaded network
+    device : str
+        the device the network runs on
+    input_size : tuple of int
+        the height and width of the model input
+    weights_path : str, optional
+        the path to the weights, exports are stored next to it
+
+    Returns
+    -------
+    backend : callable
+    a function from an input batch tensor to the raw predictions
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"unknown model backend '{name}', expected one of {', '.join(BACKENDS)}")
+    if name in ('int8', 'onnx', 'onnx-int8') and str(device) != 'cpu':
+        raise ValueError(f"the '{name}' backend runs on the CPU only")
+    if name in ('int8', 'onnx', 'onnx-int8') and isinstance(model, torch.jit.ScriptModule):
+        raise ValueError(f"the '{name}' backend is exported from a '.pt' checkpoint, not a TorchScript file")
+
+    if name == 'torch':
+        return TorchBackend(model)
+    if name == 'torchscript':
+        return TorchScriptBackend(model, device, input_size, weights_path)
+    if name == 'int8':
+        return QuantizedBackend(model, input_size)
+    return OnnxRuntimeBackend(model, input_size, weights_path, quantize=name == 'onnx-int8')
@@ -0,0 +1,294 @@
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from model.admission import DeadlineExceeded, LaneQueue, QueueFull, current_admission
+from model.nms import per_image
+from settings import (BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, DETECT_THRESHOLD, PRIORITY_LANES, LANE_MAX_QUEUE,
+                      SERVICE_TIME_SMOOTHING)
+
+
+class BatchingEngine:
+    """
+    Collects concurrent detection requests into micro-batches and runs them
+    through the model with a single forward pass.
+
+    Requests wait in priority lanes and batches are filled from the highest priority lane first.
+    Requests are shed instead of queued when their lane is full, or when the wait estimated from
+    the measured batch service time would miss their deadline, and queued images are dropped
+    before inference when their deadline passes before their batch could finish.
+
+    Attributes
+    ----------
+    model : YOLOv5
+        the model used to run batched detection
+    max_batch_size : int
+        the maximum number of images in one forward pass
+    max_wait : float
+        the maximum time in seconds to wait for a batch to fill up
+
+    Parameters
+    ----------
+    model : YOLOv5
+        the model used to run batched detection
+    max_batch_size : int, optional
+        the maximum number of images in one forward pass (default from settings.py)
+    max_wait_ms : float, optional
+        the maximum time in milliseconds to wait for a batch to fill up (default from settings.py)
+    lanes : dict, optional
+        the priority of every lane, lower values are served first (default from settings.py)
+    max_lane_depth : int, optional
+        the maximum number of images waiting in one lane, 0 for no limit (default from settings.py)
+    """
+    def __init__(self, model, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS, lanes=PRIORITY_LANES,
+                 max_lane_depth=LANE_MAX_QUEUE):
+        self.model = model
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, max_wait_ms / 1000.0)
+
+        self._queue = LaneQueue(lanes, max_lane_depth)
+        self._busy = False
+        self._service_seconds = 0.0
+        self._worker = None
+        self._start_lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._images_total = 0
+        self._batches_total = 0
+        self._errors_total = 0
+        self._max_queue_depth = 0
+        self._wait_seconds_total = 0.0
+        self._inference_seconds_total = 0.0
+        self._rejected = Counter()
+        self._expired_total = 0
+
+    def submit(self, image, confidence_threshold=DETECT_THRESHOLD, lane=None, deadline=None):
+        """
+        Queues an image for detection.
+
+        Parameters
+        ----------
+        image : PIL.Image
+            the image to detect objects in
+        confidence_threshold : float or DetectionQuery, optional
+            the confidence threshold for object detection, or a query with further filters (default from settings.py)
+        lane : str, optional
+            the priority lane (default is the lane of the current request, see model.admission)
+        deadline : float, optional
+            the time.monotonic() time the result is useless after (default is the deadline of the current request)
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+        a future resolved with the detections of the image, or failed with DeadlineExceeded when
+        the deadline passes before the image is run
+
+        Raises
+        ------
+        QueueFull
+            if the lane already holds the maximum number of images
+        DeadlineExceeded
+            if the estimated wait for the model would miss the deadline
+        """
+        admission = current_admission()
+        lane = self._queue.lane(admission.lane if lane is None else lane)
+        deadline = admission.deadline if deadline is None else deadline
+        self._ensure_worker()
+        if deadline is not None:
+            wait = self.estimated_wait(lane)
+            if time.monotonic() + wait > deadline:
+                self._reject('deadline')
+                raise DeadlineExceeded("The request deadline cannot be met", wait)
+        future = Future()
+        try:
+            self._queue.put((image, confidence_threshold, future, time.monotonic(), deadline), lane)
+        except QueueFull as exc:
+            self._reject('queue_full')
+            exc.retry_after = self.estimated_wait(lane)
+            raise
+        depth = self._queue.qsize()
+        with self._stats_lock:
+            self._max_queue_depth = max(self._max_queue_depth, depth)
+        return future
+
+    def detect(self, image, confidence_threshold=DETECT_THRESHOLD):
+        """
+        Detects objects in an image, waiting for the batch it was scheduled in.
+
+        Parameters
+        ----------
+        image : PIL.Image
+            the image to detect objects in
+        confidence_threshold : float or DetectionQuery, optional
+            the confidence threshold for object detection, or a query with further filters (default from settings.py)
+
+        Returns
+        -------
+        result : Detections
+        the detections of the image, as returned by YOLOv5.detect
+        """
+        return self.submit(image, confidence_threshold).result()
+
+    def detect_batch(self, images, confidence_threshold=DETECT_THRESHOLD):
+        """
+        Detects objects in several images, scheduling them all before waiting for the results.
+
+        Parameters
+        ----------
+        images : list of str, PIL.Image or numpy.ndarray
+            the images to detect objects in
+        confidence_threshold : float, DetectionQuery or list, optional
+            the confidence threshold, either shared by all images or one per image (default from settings.py)
+
+        Returns
+        -------
+        results : list of Detections
+        the detections of every image
+
+        Raises
+        ------
+        Overloaded
+            if an image is rejected, the images queued before it are cancelled
+        """
+        thresholds = per_image(confidence_threshold, len(images))
+        futures = []
+        try:
+            for image, threshold in zip(images, thresholds):
+                futures.append(self.submit(image, threshold))
+        except Exception:
+            # the images queued so far are not run when a later one is rejected
+            for future in futures:
+                future.cancel()
+            raise
+        return [future.result() for future in futures]
+
+    def estimated_wait(self, lane=None):
+        """
+        Estimates the time until a new image of a lane is detected, from the images queued before it
+        and the moving average of the batch service time.
+
+        Parameters
+        ----------
+        lane : str, optional
+            the priority lane (default is the highest priority lane)
+
+        Returns
+        -------
+        seconds : float
+        """
+        ahead = self._queue.ahead(self._queue.lane(lane))
+        return (ahead // self.max_batch_size + 1 + self._busy) * self._service_seconds
+
+    def metrics(self):
+        """
+        Returns queue depth and batch size metrics used to tune the batching window.
+
+        Returns
+        -------
+        metrics : dict
+        a dictionary with the current queue depth and cumulative batching counters
+        """
+        with self._stats_lock:
+            batches = self._batches_total
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self._max_queue_depth,
+                "batches_total": batches,
+                "images_total": self._images_total,
+                "errors_total": self._errors_total,
+                "mean_batch_size": self._images_total / batches if batches else 0.0,
+                "batch_size_histogram": {str(size): count for size, count in sorted(self._batch_sizes.items())},
+                "mean_queue_wait_ms": 1000.0 * self._wait_seconds_total / self._images_total
+                if self._images_total else 0.0,
+                "mean_inference_ms": 1000.0 * self._inference_seconds_total / batches if batches else 0.0,
+                "service_ms": 1000.0 * self._service_seconds,
+                "lane_depths": self._queue.depths(),
+                "rejected_total": dict(self._rejected),
+                "expired_total": self._expired_total,
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": 1000.0 * self.max_wait,
+            }
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._start_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="yolo-batching", daemon=True)
+                self._worker.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = []
+            collected = self._collect()
+            # images whose deadline passes before this batch could finish are not worth running
+            finish = time.monotonic() + self._service_seconds
+            for item in collected:
+                deadline = item[4]
+                if not item[2].set_running_or_notify_cancel():
+                    continue
+                if deadline is not None and finish > deadline:
+                    with self._stats_lock:
+                        self._expired_total += 1
+                    item[2].set_exception(DeadlineExceeded("The request deadline passed before inference",
+                                                           self._service_seconds))
+                else:
+                    batch.append(item)
+            if batch:
+                self._busy = True
+                try:
+                    self._process(batch)
+                finally:
+                    self._busy = False
+
+    def _reject(self, reason):
+        with self._stats_lock:
+            self._rejected[reason] += 1
+
+    def _process(self, batch):
+        images = [image for image, _, _, _, _ in batch]
+        thresholds = [threshold for _, threshold, _, _, _ in batch]
+        started = time.monotonic()
+        try:
+            results = self.model.detect_batch(images, thresholds)
+        except Exception as exc:
+            if len(batch) > 1:
+                # isolate the failing image instead of failing every caller in the batch
+                for item in batch:
+                    self._process([item])
+                return
+            with self._stats_lock:
+                self._errors_total += 1
+            batch[0][2].set_exception(exc)
+            return
+        finished = time.monotonic()
+
+        with self._stats_lock:
+            if self._batches_total:
+                self._service_seconds += SERVICE_TIME_SMOOTHING * (finished - started - self._service_seconds)
+            else:
+                self._service_seconds = finished - started
+            self._batches_total += 1
+            self._images_total += len(batch)
+            self._batch_sizes[len(batch)] += 1
+            self._inference_seconds_total += finished - started
+            self._wait_seconds_total += sum(started - enqueued for _, _, _, enqueued, _ in batch)
+
+        for (_, _, future, _, _), result in zip(batch, results):
+            future.set_result(result)
@@ -0,0 +1,399 @@
+import json
+import logging
+import os
+import queue
+import tarfile
+import threading
+import zipfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from util.df_to_json import detections_to_json
+from util.image_utils import decode_image_scaled
+from settings import (DETECT_THRESHOLD, BATCH_MAX_SIZE, BULK_DECODE_THREADS, BULK_PREFETCH, BULK_CHECKPOINT_EVERY,
+                      BULK_IMAGE_EXTENSIONS)
+
+logger = logging.getLogger(__name__)
+
+BulkResult = namedtuple('BulkResult', ['name', 'detections', 'error'])
+BulkResult.__doc__ = """
+The result of one image of an offline batch run: its name within the source, its detections
+in full-size image coordinates, or the error that prevented detecting on it.
+"""
+
+_END = object()
+
+
+def iter_images(source, skip=0):
+    """
+    Walks the images of a directory, tar archive or zip archive in a stable order.
+
+    Files of directories are yielded as paths and read by the caller, so they can be read in
+    parallel. Members of archives are read here, one after another, as archives are read sequentially.
+
+    Parameters
+    ----------
+    source : str
+        the path to a directory, a tar archive (optionally compressed) or a zip archive
+    skip : int, optional
+        the number of images to skip from the start, without reading them (default is 0)
+
+    Returns
+    -------
+    images : generator of (str, str or bytes)
+    the name of every image and its path or raw bytes
+    """
+    def is_image(name):
+        return name.lower().endswith(BULK_IMAGE_EXTENSIONS)
+
+    index = 0
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for file in sorted(filter(is_image, files)):
+                if index >= skip:
+                    path = os.path.join(root, file)
+                    yield os.path.relpath(path, source), path
+                index += 1
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not is_image(info.filename):
+                    continue
+                if index >= skip:
+                    yield info.filename, archive.read(info)
+                index += 1
+    elif tarfile.is_tarfile(source):
+        with tarfile.open(source, 'r:*') as archive:
+            for member in archive:
+                if not member.isfile() or not is_image(member.name):
+                    continue
+                if index >= skip:
+                    yield member.name, archive.extractfile(member).read()
+                index += 1
+                # the member list is only needed for random access, it grows with the archive
+                archive.members = []
+    else:
+        raise ValueError(f"{source!r} is not a directory, tar or zip archive")
+
+
+def _decode(item):
+    name, data = item
+    try:
+        if isinstance(data, str):
+            with open(data, 'rb') as f:
+                data = f.read()
+        image, scale = decode_image_scaled(data)
+        return name, image, scale, None
+    except Exception as exc:
+        return name, None, None, f"{type(exc).__name__}: {exc}"
+
+
+class ImagePrefetcher:
+    """
+    Reads the images of a source on a background thread and decodes them on a thread pool, so
+    reading, decoding and inference overlap. Decoded images are yielded in the order of the source.
+
+    Parameters
+    ----------
+    source : str
+        the path to a directory, tar or zip archive
+    skip : int, optional
+        the number of images to skip from the start (default is 0)
+    threads : int, optional
+        the number of decoding threads (default from settings.py)
+    prefetch : int, optional
+        the maximum number of images read or decoded ahead of the model (default from settings.py)
+    """
+    def __init__(self, source, skip=0, threads=BULK_DECODE_THREADS, prefetch=BULK_PREFETCH):
+        self.source = source
+        self.skip = skip
+        self.threads = threads
+        self._queue = queue.Queue(maxsize=prefetch)
+        self._stopped = threading.Event()
+
+    def __iter__(self):
+        with ThreadPoolExecutor(self.threads, thread_name_prefix='bulk-decode') as executor:
+            reader = threading.Thread(target=self._run, args=(executor,), name='bulk-reader', daemon=True)
+            reader.start()
+            try:
+                while True:
+                    item = self._queue.get()
+                    if item is _END:
+                        return
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item.result()
+            finally:
+                self._stopped.set()
+                reader.join()
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, executor):
+        try:
+            for item in iter_images(self.source, self.skip):
+                if not self._put(executor.submit(_decode, item)):
+                    return
+        except Exception as exc:
+            self._put(exc)
+        self._put(_END)
+
+
+def _detect(model, batch, confidence_threshold):
+    images = [image for _, image, _, _ in batch]
+    try:
+        results = model.detect_batch(images, confidence_threshold)
+    except Exception as exc:
+        if len(batch) > 1:
+            # isolate the failing image instead of failing the whole batch
+            return [result for item in batch for result in _detect(model, [item], confidence_threshold)]
+        return [BulkResult(batch[0][0], None, f"{type(exc).__name__}: {exc}")]
+    return [BulkResult(name, detections if scale == (1.0, 1.0) else detections.scale(*scale), None)
+            for (name, _, scale, _), detections in zip(batch, results)]
+
+
+def detect_images(model, source, confidence_threshold=DETECT_THRESHOLD, batch_size=BATCH_MAX_SIZE, skip=0,
+                  threads=BULK_DECODE_THREADS, prefetch=BULK_PREFETCH):
+    """
+    Detects objects in every image of a directory, tar or zip archive, in batches.
+
+    Parameters
+    ----------
+    model : YOLOv5
+        the model used to run batched detection
+    source : str
+        the path to a directory, tar or zip archive
+    confidence_threshold : float or DetectionQuery, optional
+        the confidence threshold for object detection, or a query with further filters (default from settings.py)
+    batch_size : int, optional
+        the number of images in one forward pass (default from settings.py)
+    skip : int, optional
+        the number of images to skip from the start, to resume an interrupted run (default is 0)
+    threads : int, optional
+        the number of decoding threads (default from settings.py)
+    prefetch : int, optional
+        the maximum number of images read or decoded ahead of the model (default from settings.py)
+
+    Returns
+    -------
+    results : generator of BulkResult
+    the result of every image, in the order of the source
+    """
+    batch = []
+    pending = []
+    for name, image, scale, error in ImagePrefetcher(source, skip, threads, prefetch):
+        if error is not None:
+            pending.append(BulkResult(name, None, error))
+        else:
+            batch.append((name, image, scale, len(pending)))
+            pending.append(None)
+        # failed images count too, so a long run of them is written and checkpointed without waiting for a full batch
+        if len(pending) >= batch_size:
+            yield from _flush(model, batch, pending, confidence_threshold)
+    yield from _flush(model, batch, pending, confidence_threshold)
+
+
+def _flush(model, batch, pending, confidence_threshold):
+    if batch:
+        for (_, _, _, position), result in zip(batch, _detect(model, batch, confidence_threshold)):
+            pending[position] = result
+    yield from pending
+    batch.clear()
+    pending.clear()
+
+
+def result_to_json(result):
+    """
+    Serializes the result of an image of an offline batch run into one JSON line.
+
+    Parameters
+    ----------
+    result : BulkResult
+        the result of the image
+
+    Returns
+    -------
+    json_text : str
+    """
+    if result.error is not None:
+        return json.dumps({"image": result.name, "error": result.error})
+    return '{"image": %s, ' % json.dumps(result.name) + detections_to_json(result.detections)[1:]
+
+
+class JsonlWriter:
+    """
+    Appends results to a JSON Lines file, one line per image.
+
+    Parameters
+    ----------
+    path : str
+        the output file
+    state : dict, optional
+        the state of a checkpoint to resume from, the file is truncated to it (default starts a new file)
+    """
+    def __init__(self, path, state=None):
+        self._file = open(path, 'r+b' if state else 'wb')
+        if state:
+            self._file.truncate(state['offset'])
+            self._file.seek(state['offset'])
+
+    def write(self, result):
+        self._file.write(result_to_json(result).encode() + b'\n')
+
+    def checkpoint(self):
+        """
+        Flushes the written results to disk.
+
+        Returns
+        -------
+        state : dict
+        the state to resume from
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return {'offset': self._file.tell()}
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    """
+    Writes results to a directory of Parquet files, one file per checkpoint, with one row per image
+    and list columns holding its detections. Needs pyarrow.
+
+    Parameters
+    ----------
+    path : str
+        the output directory
+    state : dict, optional
+        the state of a checkpoint to resume from, later files are removed (default starts a new directory)
+    """
+    def __init__(self, path, state=None):
+        import pyarrow
+        import pyarrow.parquet
+
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.path = path
+        self._part = state['parts'] if state else 0
+        self._rows = []
+        os.makedirs(path, exist_ok=True)
+        for file in os.listdir(path):
+            if file.startswith('part-') and file.endswith('.parquet') and int(file[5:10]) >= self._part:
+                os.remove(os.path.join(path, file))
+
+    def write(self, result):
+        self._rows.append(result)
+
+    def checkpoint(self):
+        """
+        Writes the results since the last checkpoint to a new Parquet file.
+
+        Returns
+        -------
+        state : dict
+        the state to resume from
+        """
+        if self._rows:
+            columns = {'image': [r.name for r in self._rows], 'error': [r.error for r in self._rows]}
+            for name in ('class', 'confidence', 'xmin', 'ymin', 'xmax', 'ymax'):
+                columns[name] = []
+            for r in self._rows:
+                d = r.detections
+                columns['class'].append(None if d is None else d.class_ids.tolist())
+                columns['confidence'].append(None if d is None else d.confidence.tolist())
+                for i, name in enumerate(('xmin', 'ymin', 'xmax', 'ymax')):
+                    columns[name].append(None if d is None else d.boxes[:, i].tolist())
+            schema = self._pa.schema([('image', self._pa.string()), ('error', self._pa.string()),
+                                      ('class', self._pa.list_(self._pa.int32()))] +
+                                     [(name, self._pa.list_(self._pa.float32()))
+                                      for name in ('confidence', 'xmin', 'ymin', 'xmax', 'ymax')])
+            path = os.path.join(self.path, f'part-{self._part:05d}.parquet')
+            self._pq.write_table(self._pa.table(columns, schema=schema), path + '.tmp', compression='zstd')
+            os.replace(path + '.tmp', path)
+            self._part += 1
+            self._rows = []
+        return {'parts': self._part}
+
+    def close(self):
+        pass
+
+
+# Writers of the output formats of offline batch runs
+WRITERS = {'jsonl': JsonlWriter, 'parquet': ParquetWriter}
+
+
+def _save_checkpoint(path, state):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def run_bulk(model, source, output, format='jsonl', confidence_threshold=DETECT_THRESHOLD,
+             batch_size=BATCH_MAX_SIZE, threads=BULK_DECODE_THREADS, checkpoint_every=BULK_CHECKPOINT_EVERY):
+    """
+    Detects objects in every image of a directory, tar or zip archive and writes the results
+    incrementally. Progress is checkpointed next to the output, so a run interrupted at any
+    point resumes after the last checkpoint; the checkpoint is removed when the run completes.
+
+    Parameters
+    ----------
+    model : YOLOv5
+        the model used to run batched detection
+    source : str
+        the path to a directory, tar or zip archive
+    output : str
+        the output JSON Lines file, or the output directory of Parquet files
+    format : str, optional
+        'jsonl' or 'parquet' (default is 'jsonl')
+    confidence_threshold : float or DetectionQuery, optional
+        the confidence threshold for object detection, or a query with further filters (default from settings.py)
+    batch_size : int, optional
+        the number of images in one forward pass (default from settings.py)
+    threads : int, optional
+        the number of decoding threads (default from settings.py)
+    checkpoint_every : int, optional
+        the number of images between two checkpoints (default from settings.py)
+
+    Returns
+    -------
+    counts : dict
+    the number of images processed by this run, the number of failed images among them,
+    and the number of images skipped because an earlier run processed them
+    """
+    checkpoint_path = output + '.checkpoint'
+    state = None
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            state = json.load(f)
+        if state['source'] != os.path.abspath(source) or state['format'] != format:
+            raise ValueError(f"{checkpoint_path} belongs to a run over {state['source']!r} as {state['format']}")
+        logger.info("Resuming after %d images", state['done'])
+
+    writer = WRITERS[format](output, state and state['writer'])
+    done = state['done'] if state else 0
+    counts = {'images': 0, 'errors': 0, 'skipped': done}
+    try:
+        for result in detect_images(model, source, confidence_threshold, batch_size, skip=done, threads=threads):
+            writer.write(result)
+            done += 1
+            counts['images'] += 1
+            counts['errors'] += result.error is not None
+            if done % checkpoint_every == 0:
+                _save_checkpoint(checkpoint_path, {'source': os.path.abspath(source), 'format': format,
+                                                   'done': done, 'writer': writer.checkpoint()})
+                logger.info("Processed %d images", done)
+        writer.checkpoint()
+    finally:
+        writer.close()
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return counts
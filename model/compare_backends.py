@@ -0,0 +1,99 @@
+import argparse
+import json
+import statistics
+import sys
+import time
+from model.backends import BACKENDS, create_backend
+from model.detections import match_detections
+from settings import DETECT_THRESHOLD, TEST_IMAGE_PATH
+
+
+def _fraction(matched, total):
+    return matched / total if total else 1.0
+
+
+def _time_batch(model, images, confidence_threshold, runs):
+    model.detect_batch(images, confidence_threshold)
+    latencies = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        detections = model.detect_batch(images, confidence_threshold)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return statistics.median(latencies), detections
+
+
+def compare_backends(model, backends, images, confidence_threshold=DETECT_THRESHOLD, runs=5,
+                     min_agreement=0.95, max_confidence_error=0.05):
+    """
+    Measures the latency of inference backends and checks their detections against the eager
+    torch backend, exporting every backend from the weights of the model.
+
+    Parameters
+    ----------
+    model : YOLOv5
+        the loaded model
+    backends : list of str
+        the compared backends, see model.backends.BACKENDS
+    images : list of str, PIL.Image or numpy.ndarray
+        the images, run through the model as one batch
+    confidence_threshold : float, optional
+        the confidence threshold for object detection (default from settings.py)
+    runs : int, optional
+        the number of timed runs of every backend (default is 5)
+    min_agreement : float, optional
+        the minimum fraction of reference boxes, and of backend boxes, that have to match (default is 0.95)
+    max_confidence_error : float, optional
+        the maximum confidence difference of matched boxes (default is 0.05)
+
+    Returns
+    -------
+    results : dict
+    per backend, the median batch latency, the speedup over torch, the recall and precision
+    against torch, the largest confidence difference and whether it is within tolerance
+    """
+    original_backend = model.backend
+    results = {}
+    try:
+        model.backend = create_backend('torch', model.model, model.device, model.input_size)
+        reference_ms, reference = _time_batch(model, images, confidence_threshold, runs)
+
+        for name in backends:
+            model.backend = create_backend(name, model.model, model.device, model.input_size, model.weights_path)
+            latency_ms, detections = _time_batch(model, images, confidence_threshold, runs)
+
+            matches = [match_detections(ref, det) for ref, det in zip(reference, detections)]
+            matched = sum(m['matched'] for m in matches)
+            recall = _fraction(matched, sum(m['reference'] for m in matches))
+            precision = _fraction(matched, sum(m['candidate'] for m in matches))
+            confidence_error = max(m['max_confidence_error'] for m in matches)
+            results[name] = {
+                'median_ms': round(latency_ms, 2),
+                'speedup': round(reference_ms / latency_ms, 2),
+                'recall': round(recall, 4),
+                'precision': round(precision, 4),
+                'max_confidence_error': round(confidence_error, 4),
+                'within_tolerance': (recall >= min_agreement and precision >= min_agreement
+                                     and confidence_error <= max_confidence_error),
+            }
+    finally:
+        model.backend = original_backend
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the latency and accuracy of the inference backends')
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=BACKENDS,
+                        help='Backends to compare against the eager torch backend')
+    parser.add_argument('--images', nargs='+', default=[TEST_IMAGE_PATH], help='Images to run as one batch')
+    parser.add_argument('--runs', type=int, default=5, help='Number of timed runs of every backend')
+    parser.add_argument('--min-agreement', type=float, default=0.95,
+                        help='Minimum fraction of boxes matching the torch backend')
+    parser.add_argument('--max-confidence-error', type=float, default=0.05,
+                        help='Maximum confidence difference of matching boxes')
+    args = parser.parse_args()
+
+    from model.yolov5 import YOLOv5
+    results = compare_backends(YOLOv5(device='cpu', backend='torch'), args.backends, args.images, runs=args.runs,
+                               min_agreement=args.min_agreement, max_confidence_error=args.max_confidence_error)
+    print(json.dumps(results, indent=2))
+    sys.exit(0 if all(result['within_tolerance'] for result in results.values()) else 1)
@@ -14,8 +14,7 @@ def detect_from_local(image_path):
     """
     detections = yolo.detect(image_path)
     img = cv2.imread(image_path)
-    for _, row in detections.iterrows():
-        x1, y1, x2, y2 = row[['xmin', 'ymin', 'xmax', 'ymax']].astype(int)
+    for x1, y1, x2, y2 in detections.boxes.astype(int).tolist():
         img = cv2.rectangle(img, (x1, y1), (x2, y2), (0, 255, 0), 2)
 
     cv2.imshow('image', img)
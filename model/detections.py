@@ -0,0 +1,186 @@
+import numpy as np
+
+
+class Detections:
+    """
+    Object detection results backed by NumPy arrays.
+
+    Attributes
+    ----------
+    boxes : numpy.ndarray
+        an Nx4 float32 array of 'xmin', 'ymin', 'xmax', 'ymax' box coordinates
+    confidence : numpy.ndarray
+        an N float32 array of detection confidences
+    class_ids : numpy.ndarray
+        an N int64 array of class ids
+    names : list of str
+        the class names indexed by class id
+
+    Parameters
+    ----------
+    boxes : array_like
+        the Nx4 box coordinates in 'xmin', 'ymin', 'xmax', 'ymax' order
+    confidence : array_like
+        the N detection confidences
+    class_ids : array_like
+        the N class ids
+    names : list or dict, optional
+        the class names, either a list or a dict mapping class id to name
+    """
+    def __init__(self, boxes, confidence, class_ids, names=None):
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.confidence = np.asarray(confidence, dtype=np.float32).reshape(-1)
+        self.class_ids = np.asarray(class_ids, dtype=np.int64).reshape(-1)
+        if isinstance(names, dict):
+            names = [names[i] for i in sorted(names)]
+        self.names = list(names) if names is not None else []
+
+    @classmethod
+    def from_xyxy(cls, xyxy, names=None):
+        """
+        Creates detections from an Nx6 array of 'xmin', 'ymin', 'xmax', 'ymax', 'confidence', 'class' rows,
+        the layout produced by the YOLOv5 non-maximum suppression.
+
+        Parameters
+        ----------
+        xyxy : array_like
+            the Nx6 detection array
+        names : list or dict, optional
+            the class names
+
+        Returns
+        -------
+        detections : Detections
+        """
+        xyxy = np.asarray(xyxy, dtype=np.float32).reshape(-1, 6)
+        return cls(xyxy[:, :4], xyxy[:, 4], xyxy[:, 5], names)
+
+    @classmethod
+    def empty(cls, names=None):
+        """
+        Creates detections with no objects.
+
+        Parameters
+        ----------
+        names : list or dict, optional
+            the class names
+
+        Returns
+        -------
+        detections : Detections
+        """
+        return cls(np.empty((0, 4)), np.empty(0), np.empty(0), names)
+
+    def __len__(self):
+        return len(self.confidence)
+
+    def __getitem__(self, index):
+        return Detections(self.boxes[index], self.confidence[index], self.class_ids[index], self.names)
+
+    def __repr__(self):
+        return f"Detections(n={len(self)})"
+
+    @property
+    def class_names(self):
+        """
+        numpy.ndarray: the class name of every detection
+        """
+        if not self.names:
+            return self.class_ids.astype(str)
+        return np.asarray(self.names, dtype=object)[self.class_ids]
+
+    def threshold(self, confidence_threshold):
+        """
+        Keeps only the detections with a confidence above the threshold.
+
+        Parameters
+        ----------
+        confidence_threshold : float
+            the confidence threshold
+
+        Returns
+        -------
+        detections : Detections
+        """
+        return self[self.confidence > confidence_threshold]
+
+    def scale(self, scale_x, scale_y):
+        """
+        Scales the box coordinates along the x and y axes.
+
+        Parameters
+        ----------
+        scale_x : float
+            the scaling factor along the x-axis
+        scale_y : float
+            the scaling factor along the y-axis
+
+        Returns
+        -------
+        detections : Detections
+        """
+        factors = np.array([scale_x, scale_y, scale_x, scale_y], dtype=np.float32)
+        return Detections(self.boxes * factors, self.confidence, self.class_ids, self.names)
+
+    def to_pandas(self):
+        """
+        Builds a DataFrame with columns 'xmin', 'ymin', 'xmax', 'ymax', 'confidence', 'class', 'name',
+        the layout of the YOLOv5 pandas results.
+
+        Returns
+        -------
+        result : pandas.DataFrame
+        """
+        import pandas as pd
+
+        return pd.DataFrame({
+            "xmin": self.boxes[:, 0],
+            "ymin": self.boxes[:, 1],
+            "xmax": self.boxes[:, 2],
+            "ymax": self.boxes[:, 3],
+            "confidence": self.confidence,
+            "class": self.class_ids,
+            "name": self.class_names,
+        })
+
+
+def match_detections(reference, candidate, iou_threshold=0.5):
+    """
+    Matches the detections of a backend to the reference detections of the same image. Every
+    reference box is matched, in order of confidence, to the unmatched box of the same class
+    it overlaps most, if they overlap by at least iou_threshold.
+
+    Parameters
+    ----------
+    reference : Detections
+        the detections of the reference backend
+    candidate : Detections
+        the detections of the compared backend
+    iou_threshold : float, optional
+        the minimum IoU of matching boxes (default is 0.5)
+
+    Returns
+    -------
+    result : dict
+    the number of reference, candidate and matched boxes and the largest confidence
+    difference of matched boxes
+    """
+    import torch
+    import torchvision
+
+    result = {'reference': len(reference), 'candidate': len(candidate), 'matched': 0,
+              'max_confidence_error': 0.0}
+    if not len(reference) or not len(candidate):
+        return result
+
+    iou = torchvision.ops.box_iou(torch.from_numpy(reference.boxes), torch.from_numpy(candidate.boxes))
+    iou[torch.from_numpy(reference.class_ids[:, None] != candidate.class_ids[None, :])] = 0
+    for i in reference.confidence.argsort()[::-1]:
+        j = int(iou[i].argmax())
+        if iou[i, j] < iou_threshold:
+            continue
+        iou[:, j] = 0
+        result['matched'] += 1
+        error = abs(float(reference.confidence[i]) - float(candidate.confidence[j]))
+        result['max_confidence_error'] = max(result['max_confidence_error'], error)
+    return result
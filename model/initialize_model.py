@@ -1,5 +1,91 @@
-import torch
-from model.yolov5 import YOLOv5
+import logging
+import threading
+import time
+import numpy as np
+from util.cache import SimilarityCache
+from settings import (INPUT_SIZE, MODEL_BACKEND, SIMILARITY_CACHE_ENABLED, SIMILARITY_CACHE_SIZE, SIMILARITY_MAX_DISTANCE,
+                      SIMILARITY_AUDIT_RATE, AUTOTUNE)
 
-device = 'cuda' if torch.cuda.is_available() else 'cpu'
-yolo = YOLOv5(device=device)
+logger = logging.getLogger(__name__)
+
+
+class LazyModel:
+    """
+    A proxy that loads the YOLOv5 model on first use, so importing this module does not load
+    torch or the weights.
+
+    Attributes
+    ----------
+    load_seconds : float or None
+        the time it took to load the model, None until it is loaded
+
+    Parameters
+    ----------
+    loader : callable
+        a function without arguments returning the loaded model
+    """
+    def __init__(self, loader):
+        self._loader = loader
+        self._model = None
+        self._lock = threading.Lock()
+        self.load_seconds = None
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    def load(self):
+        """
+        Loads the model if it is not loaded yet.
+
+        Returns
+        -------
+        model : YOLOv5
+        the loaded model
+        """
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    started = time.perf_counter()
+                    model = self._loader()
+                    self.load_seconds = time.perf_counter() - started
+                    logger.info("Loaded model in %.2f s", self.load_seconds)
+                    self._model = model
+        return self._model
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+
+def _load_yolo():
+    import torch
+    from model.yolov5 import YOLOv5
+
+    # the quantized and ONNX Runtime backends are CPU backends
+    gpu_backend = MODEL_BACKEND in ('torch', 'torchscript')
+    device = 'cuda' if gpu_backend and torch.cuda.is_available() else 'cpu'
+    model = YOLOv5(device=device)
+    if SIMILARITY_CACHE_ENABLED:
+        model.similarity_cache = SimilarityCache(SIMILARITY_CACHE_SIZE, SIMILARITY_MAX_DISTANCE, SIMILARITY_AUDIT_RATE)
+    return model
+
+
+def warm_up():
+    """
+    Loads the model, tunes its threads and precision for the host when AUTOTUNE is enabled,
+    and runs one inference on a blank image, so the first request does not pay for the model loading.
+
+    Returns
+    -------
+    model : YOLOv5
+    the loaded model
+    """
+    model = yolo.load()
+    if AUTOTUNE:
+        from model.autotune import autotune
+        autotune(model)
+    model.detect(np.zeros((INPUT_SIZE, INPUT_SIZE, 3), dtype=np.uint8))
+    return model
+
+
+yolo = LazyModel(_load_yolo)
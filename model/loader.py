@@ -0,0 +1,83 @@
+import json
+import os
+import sys
+import torch
+from settings import YOLOV5_DIR, MODEL_HUB_FALLBACK
+
+
+def load_torchscript(weights_path, device):
+    """
+    Loads a self-contained TorchScript export of the network.
+
+    Parameters
+    ----------
+    weights_path : str
+        the path to the '.torchscript' file
+    device : str
+        the device the network is loaded on
+
+    Returns
+    -------
+    model : torch.jit.ScriptModule
+    the network, with the class names of the export in its 'names' attribute
+    """
+    extra_files = {'config.txt': ''}
+    model = torch.jit.load(weights_path, map_location=device, _extra_files=extra_files)
+    names = json.loads(extra_files['config.txt'] or '{}').get('names', {})
+    if isinstance(names, dict):
+        names = {int(k): v for k, v in names.items()}
+    model.names = names
+    return model
+
+
+def load_checkpoint(weights_path, device, repo_dir=YOLOV5_DIR):
+    """
+    Builds the network from a local copy of the YOLOv5 model definitions and loads the weights
+    of a checkpoint, without going through torch.hub.
+
+    Parameters
+    ----------
+    weights_path : str
+        the path to the '.pt' checkpoint
+    device : str
+        the device the network is loaded on
+    repo_dir : str, optional
+        the directory with the YOLOv5 sources, a checkout or the torch.hub cache (default from settings.py)
+
+    Returns
+    -------
+    model : torch.nn.Module
+    the fused network in evaluation mode
+    """
+    if repo_dir not in sys.path:
+        sys.path.insert(0, repo_dir)
+    from models.experimental import attempt_load
+
+    return attempt_load(weights_path, device=device, inplace=True, fuse=True)
+
+
+def load_model(weights_path, device):
+    """
+    Loads the YOLOv5 network from local files, falling back to a one-off torch.hub download of the
+    model definitions when there is no local copy of them.
+
+    Parameters
+    ----------
+    weights_path : str
+        the path to the weights, a '.pt' checkpoint or a '.torchscript' export
+    device : str
+        the device the network is loaded on
+
+    Returns
+    -------
+    model : torch.nn.Module
+    the network in evaluation mode, returning raw predictions for a batch tensor
+    """
+    if weights_path.endswith('.torchscript'):
+        return load_torchscript(weights_path, device)
+    if os.path.isdir(os.path.join(YOLOV5_DIR, 'models')):
+        return load_checkpoint(weights_path, device)
+    if not MODEL_HUB_FALLBACK:
+        raise FileNotFoundError(f"YOLOv5 model definitions not found in {YOLOV5_DIR}")
+    # populates the torch.hub cache, later starts load the definitions from YOLOV5_DIR
+    return torch.hub.load('ultralytics/yolov5', 'custom', path=weights_path, trust_repo=True)
@@ -0,0 +1,184 @@
+from collections import namedtuple
+from functools import lru_cache
+import numpy as np
+import torch
+import torchvision
+from settings import DETECT_THRESHOLD, NMS_IOU_THRESHOLD, MAX_DETECTIONS
+
+# Maximum number of boxes passed into torchvision NMS per image
+MAX_NMS_BOXES = 30000
+
+DetectionQuery = namedtuple('DetectionQuery', ['confidence', 'classes', 'max_det', 'iou', 'min_area'])
+DetectionQuery.__doc__ = """
+The filters applied while detections are selected: the confidence threshold, the allowed class ids
+or names (None allows every class), the maximum number of detections, the IoU threshold of the
+suppression and the minimum box area in image pixels.
+"""
+
+
+class InvalidQuery(ValueError):
+    """
+    Raised for detection queries with invalid filters.
+    """
+
+
+@lru_cache(maxsize=1024)
+def detection_query(confidence=DETECT_THRESHOLD, classes=None, max_det=MAX_DETECTIONS, iou=NMS_IOU_THRESHOLD,
+                    min_area=0.0):
+    """
+    Validates the filters of a detection query. Repeated parameter sets are served from a cache.
+
+    Parameters
+    ----------
+    confidence : float, optional
+        the confidence threshold from 0 to 1 (default from settings.py)
+    classes : tuple of int or str, optional
+        the allowed class ids or names, None allows every class (default is None)
+    max_det : int, optional
+        the maximum number of detections per image (default from settings.py)
+    iou : float, optional
+        the IoU threshold of the suppression from 0 to 1 (default from settings.py)
+    min_area : float, optional
+        the minimum box area in image pixels (default is 0)
+
+    Returns
+    -------
+    query : DetectionQuery
+    """
+    confidence, iou, min_area, max_det = float(confidence), float(iou), float(min_area), int(max_det)
+    if not 0 <= confidence <= 1:
+        raise InvalidQuery("confidence must be between 0 and 1")
+    if not 0 < iou <= 1:
+        raise InvalidQuery("iou must be greater than 0 and at most 1")
+    if max_det < 1:
+        raise InvalidQuery("max_det must be at least 1")
+    if min_area < 0:
+        raise InvalidQuery("min_area must not be negative")
+    if classes is not None:
+        classes = tuple(dict.fromkeys(int(c) if isinstance(c, str) and c.isdigit() else c for c in classes))
+        if not classes:
+            raise InvalidQuery("classes must not be empty")
+    return DetectionQuery(confidence, classes, max_det, iou, min_area)
+
+
+def per_image(value, n):
+    """
+    Expands a confidence threshold or query shared by all images of a batch into one per image.
+
+    Parameters
+    ----------
+    value : float, DetectionQuery or list
+        the value shared by all images, or a list or tuple with one value per image
+    n : int
+        the number of images
+
+    Returns
+    -------
+    values : list
+    """
+    if isinstance(value, list) or (isinstance(value, tuple) and not isinstance(value, DetectionQuery)):
+        return list(value)
+    return [value] * n
+
+
+@lru_cache(maxsize=256)
+def _class_tensor(classes):
+    return torch.tensor(classes, dtype=torch.long)
+
+
+def xywh2xyxy(x):
+    """
+    Converts Nx4 boxes from center x, center y, width, height to xmin, ymin, xmax, ymax.
+
+    Parameters
+    ----------
+    x : torch.Tensor
+        the boxes in xywh format
+
+    Returns
+    -------
+    y : torch.Tensor
+    the boxes in xyxy format
+    """
+    y = torch.empty_like(x)
+    half_w = x[:, 2] / 2
+    half_h = x[:, 3] / 2
+    y[:, 0] = x[:, 0] - half_w
+    y[:, 1] = x[:, 1] - half_h
+    y[:, 2] = x[:, 0] + half_w
+    y[:, 3] = x[:, 1] + half_h
+    return y
+
+
+def non_max_suppression(prediction, conf_thres, iou_thres=NMS_IOU_THRESHOLD, max_det=MAX_DETECTIONS):
+    """
+    Runs class-aware non-maximum suppression on raw YOLOv5 predictions. The filters of a query are
+    applied before the suppression, so boxes of other classes and small boxes are never compared.
+
+    Parameters
+    ----------
+    prediction : torch.Tensor
+        the raw model output of shape (batch, boxes, 5 + classes) with xywh boxes,
+        objectness and per-class scores
+    conf_thres : float, DetectionQuery or list
+        the confidence threshold or query, either shared by all images or one per image;
+        query classes are class ids and min_area is in model input pixels
+    iou_thres : float, optional
+        the IoU threshold of the suppression for plain thresholds (default from settings.py)
+    max_det : int, optional
+        the maximum number of detections kept per image for plain thresholds (default from settings.py)
+
+    Returns
+    -------
+    output : list of torch.Tensor
+    one Nx6 tensor per image with 'xmin', 'ymin', 'xmax', 'ymax', 'confidence', 'class' rows
+    """
+    output = []
+    for x, query in zip(prediction, per_image(conf_thres, len(prediction))):
+        if not isinstance(query, DetectionQuery):
+            query = DetectionQuery(query, None, max_det, iou_thres, 0.0)
+        x = x[x[:, 4] > query.confidence]
+        if query.min_area:
+            x = x[x[:, 2] * x[:, 3] >= query.min_area]
+
+        scores = x[:, 5:] * x[:, 4:5]
+        conf, class_ids = scores.max(1)
+        keep = conf > query.confidence
+        if query.classes is not None:
+            keep &= torch.isin(class_ids, _class_tensor(query.classes).to(x.device))
+        boxes, conf, class_ids = xywh2xyxy(x[keep, :4]), conf[keep], class_ids[keep]
+
+        if len(conf) > MAX_NMS_BOXES:
+            top = conf.topk(MAX_NMS_BOXES).indices
+            boxes, conf, class_ids = boxes[top], conf[top], class_ids[top]
+
+        i = torchvision.ops.batched_nms(boxes, conf, class_ids, query.iou)[:query.max_det]
+        output.append(torch.cat((boxes[i], conf[i, None], class_ids[i, None].to(boxes.dtype)), 1))
+    return output
+
+
+def merge_detections(detections, iou_thres=NMS_IOU_THRESHOLD, max_det=MAX_DETECTIONS):
+    """
+    Merges detections of overlapping regions of the same image with class-aware non-maximum suppression.
+
+    Parameters
+    ----------
+    detections : list of Detections
+        the detections of the regions, in image coordinates
+    iou_thres : float, optional
+        the IoU threshold of the suppression (default from settings.py)
+    max_det : int, optional
+        the maximum number of detections kept (default from settings.py)
+
+    Returns
+    -------
+    merged : Detections
+    """
+    from model.detections import Detections
+
+    names = detections[0].names if detections else []
+    boxes = torch.from_numpy(np.concatenate([d.boxes for d in detections] or [np.empty((0, 4), np.float32)]))
+    conf = torch.from_numpy(np.concatenate([d.confidence for d in detections] or [np.empty(0, np.float32)]))
+    class_ids = torch.from_numpy(np.concatenate([d.class_ids for d in detections] or [np.empty(0, np.int64)]))
+    keep = torchvision.ops.batched_nms(boxes, conf, class_ids, iou_thres)[:max_det].numpy()
+    return Detections(boxes.numpy()[keep], conf.numpy()[keep], class_ids.numpy()[keep], names)
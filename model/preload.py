@@ -0,0 +1,40 @@
+import gc
+import torch
+
+
+def share_model_memory(model):
+    """
+    Moves the weights of a loaded model into shared memory, so processes forked after loading
+    read the same physical pages instead of copying them on first write.
+
+    Parameters
+    ----------
+    model : YOLOv5
+        the loaded model
+
+    Returns
+    -------
+    shared_bytes : int
+    the size of the tensors moved to shared memory
+    """
+    modules = [model.model]
+    backend_model = getattr(model.backend, 'model', None)
+    if isinstance(backend_model, torch.nn.Module) and backend_model is not model.model:
+        modules.append(backend_model)
+
+    shared_bytes = 0
+    for module in modules:
+        module.share_memory()
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            shared_bytes += tensor.numel() * tensor.element_size()
+    return shared_bytes
+
+
+def freeze_heap():
+    """
+    Moves every Python object allocated so far into the permanent generation of the garbage
+    collector. Forked processes then never run collections over the objects of the parent, which
+    would write to their pages and duplicate them.
+    """
+    gc.collect()
+    gc.freeze()
@@ -0,0 +1,235 @@
+import threading
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+import cv2
+import numpy as np
+from model.detections import Detections
+from model.nms import DetectionQuery, InvalidQuery, merge_detections
+from util.image_utils import load_image
+from settings import DETECT_THRESHOLD, ROI_CACHE_SIZE, CAMERA_REGIONS
+
+Region = namedtuple('Region', ['box', 'polygon'])
+Region.__doc__ = """
+A region of interest of an image: the 'xmin', 'ymin', 'xmax', 'ymax' pixel bounds of its crop, and the
+polygon constraining it as a tuple of (x, y) vertices, None for a rectangular region.
+"""
+
+# Pixel value filling the parts of a region crop outside its polygon, the padding value of the letterbox
+MASK_FILL = 114
+
+
+class InvalidRegion(InvalidQuery):
+    """
+    Raised for regions of interest that are not a valid rectangle or polygon.
+    """
+
+
+def rectangle_region(box):
+    """
+    Creates a rectangular region of interest.
+
+    Parameters
+    ----------
+    box : sequence of float
+        the 'xmin', 'ymin', 'xmax', 'ymax' bounds in image pixels
+
+    Returns
+    -------
+    region : Region
+
+    Raises
+    ------
+    InvalidRegion
+        if the bounds are not four numbers enclosing a positive area
+    """
+    if len(box) != 4:
+        raise InvalidRegion("A rectangle needs 4 coordinates: xmin, ymin, xmax, ymax")
+    xmin, ymin, xmax, ymax = (int(round(float(v))) for v in box)
+    if xmax <= xmin or ymax <= ymin or xmax <= 0 or ymax <= 0:
+        raise InvalidRegion(f"Empty region {tuple(box)}")
+    return Region((max(0, xmin), max(0, ymin), xmax, ymax), None)
+
+
+def polygon_region(points):
+    """
+    Creates a region of interest constrained to a polygon, cropped to the bounding box of the polygon.
+
+    Parameters
+    ----------
+    points : sequence of (float, float)
+        the vertices of the polygon in image pixels
+
+    Returns
+    -------
+    region : Region
+
+    Raises
+    ------
+    InvalidRegion
+        if the polygon has less than 3 vertices or no area
+    """
+    polygon = tuple((float(x), float(y)) for x, y in points)
+    if len(polygon) < 3:
+        raise InvalidRegion("A polygon needs at least 3 vertices")
+    xs, ys = zip(*polygon)
+    region = rectangle_region((np.floor(min(xs)), np.floor(min(ys)), np.ceil(max(xs)), np.ceil(max(ys))))
+    if not cv2.contourArea(np.float32(polygon)):
+        raise InvalidRegion("Polygon without area")
+    return region._replace(polygon=polygon)
+
+
+def as_regions(regions):
+    """
+    Converts regions of interest given as rectangles or polygons to a tuple of Region.
+
+    Parameters
+    ----------
+    regions : sequence
+        Region objects, 'xmin', 'ymin', 'xmax', 'ymax' rectangles and lists of (x, y) polygon vertices
+
+    Returns
+    -------
+    regions : tuple of Region
+
+    Raises
+    ------
+    InvalidRegion
+        if a region is not a valid rectangle or polygon
+    """
+    converted = []
+    for region in regions:
+        if isinstance(region, Region):
+            converted.append(region)
+        elif len(region) and np.ndim(region[0]) == 0:
+            converted.append(rectangle_region(region))
+        else:
+            converted.append(polygon_region(region))
+    if not converted:
+        raise InvalidRegion("No region of interest")
+    return tuple(converted)
+
+
+@lru_cache(maxsize=256)
+def _polygon_mask(polygon, x, y, width, height):
+    mask = np.zeros((height, width), dtype=np.uint8)
+    vertices = np.round((np.float32(polygon) - [x, y]) * 16).astype(np.int32)
+    cv2.fillPoly(mask, [vertices], 1, lineType=cv2.LINE_8, shift=4)
+    mask = mask.astype(bool)
+    mask.flags.writeable = False
+    return mask
+
+
+def _crop(img, region):
+    height, width = img.shape[:2]
+    xmin, ymin, xmax, ymax = region.box
+    xmax, ymax = min(xmax, width), min(ymax, height)
+    if xmax <= xmin or ymax <= ymin:
+        return None, None
+    crop = img[ymin:ymax, xmin:xmax]
+    if region.polygon is None:
+        return crop, None
+    mask = _polygon_mask(region.polygon, xmin, ymin, xmax - xmin, ymax - ymin)
+    return np.where(mask[..., None], crop, np.uint8(MASK_FILL)), mask
+
+
+def _to_image(detections, region, crop, mask):
+    xmin, ymin = region.box[:2]
+    height, width = crop.shape[:2]
+    boxes = np.clip(detections.boxes, 0, [width, height, width, height])
+    if mask is not None:
+        # keeps the objects whose box centre lies inside the polygon
+        cx = np.clip(((boxes[:, 0] + boxes[:, 2]) / 2).astype(np.int64), 0, width - 1)
+        cy = np.clip(((boxes[:, 1] + boxes[:, 3]) / 2).astype(np.int64), 0, height - 1)
+        inside = mask[cy, cx]
+        boxes, detections = boxes[inside], detections[inside]
+    return Detections(boxes + np.float32([xmin, ymin, xmin, ymin]), detections.confidence, detections.class_ids,
+                      detections.names)
+
+
+def _class_names(detector):
+    # a YOLOv5 model keeps the class names on its network, an inference engine on the model it runs
+    model = detector
+    while model is not None and not hasattr(model, 'names'):
+        model = getattr(model, 'model', None)
+    return getattr(model, 'names', None)
+
+
+def detect_regions(detector, image, regions, confidence_threshold=DETECT_THRESHOLD):
+    """
+    Detects objects in regions of interest of an image only. The region crops are run through the
+    model as one batch, each letterboxed to the full model input, so small regions are detected at a
+    higher resolution than in the whole frame. Polygon regions hide the pixels outside the polygon
+    from the model and keep only the objects centred inside it.
+
+    Parameters
+    ----------
+    detector : object
+        a YOLOv5 model or inference engine with a detect_batch method
+    image : str, PIL.Image or numpy.ndarray
+        the image to detect objects in
+    regions : sequence
+        the regions of interest, see as_regions
+    confidence_threshold : float or DetectionQuery, optional
+        the confidence threshold for object detection, or a query with further filters (default from settings.py)
+
+    Returns
+    -------
+    result : Detections
+    the detections in image coordinates, clipped to their region, merged across overlapping regions
+    """
+    img = load_image(image)
+    crops = [(region, *_crop(img, region)) for region in as_regions(regions)]
+    crops = [(region, crop, mask) for region, crop, mask in crops if crop is not None]
+    if not crops:
+        return Detections.empty(_class_names(detector))
+    results = detector.detect_batch([crop for _, crop, _ in crops], confidence_threshold)
+    detections = [_to_image(dets, region, crop, mask) for (region, crop, mask), dets in zip(crops, results)]
+    if len(detections) == 1:
+        return detections[0]
+    if isinstance(confidence_threshold, DetectionQuery):
+        return merge_detections(detections, confidence_threshold.iou, confidence_threshold.max_det)
+    return merge_detections(detections)
+
+
+class CameraRegions:
+    """
+    The regions of interest of fixed cameras, kept by camera id for the requests sending only the id.
+    The least recently used cameras are evicted beyond capacity, the cameras configured in settings.py
+    are always kept.
+
+    Parameters
+    ----------
+    capacity : int, optional
+        the maximum number of cameras registered by requests (default from settings.py)
+    configured : dict, optional
+        the regions of the configured cameras, see as_regions (default from settings.py)
+    """
+    def __init__(self, capacity=ROI_CACHE_SIZE, configured=CAMERA_REGIONS):
+        self.capacity = capacity
+        self._configured = {str(camera): as_regions(regions) for camera, regions in configured.items()}
+        self._cameras = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, camera):
+        """
+        Returns the regions of a camera, None for unknown cameras.
+        """
+        with self._lock:
+            regions = self._cameras.get(camera)
+            if regions is not None:
+                self._cameras.move_to_end(camera)
+                return regions
+        return self._configured.get(camera)
+
+    def put(self, camera, regions):
+        """
+        Stores the regions of a camera, replacing the previous ones.
+        """
+        with self._lock:
+            self._cameras[camera] = regions
+            self._cameras.move_to_end(camera)
+            while len(self._cameras) > self.capacity:
+                self._cameras.popitem(last=False)
+
+    def __len__(self):
+        return len(self._cameras)
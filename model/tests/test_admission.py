@@ -0,0 +1,128 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from model.admission import DeadlineExceeded, LaneQueue, QueueFull, finish_admission, start_admission
+from model.batching import BatchingEngine
+from model.detections import Detections
+
+LANES = {'detect': 0, 'render': 1, 'batch': 2}
+
+
+class BlockingDetector:
+    """
+    A detector that waits for a release before returning, recording the images it was given.
+    """
+    def __init__(self):
+        self.release = threading.Event()
+        self.images = []
+
+    def detect_batch(self, images, confidence_threshold):
+        self.release.wait(5)
+        self.images += images
+        return [Detections([], [], []) for _ in images]
+
+
+def test_lane_queue_serves_priority_lanes_first():
+    """
+    Test that items are taken from the highest priority lane first and full lanes reject items.
+
+    Raises
+    ------
+    AssertionError
+        If the order is wrong or a full lane accepts an item.
+    """
+    lanes = LaneQueue(LANES, max_depth=2)
+    lanes.put('b1', 'batch')
+    lanes.put('r1', 'render')
+    lanes.put('d1', 'detect')
+    lanes.put('r2', 'render')
+    with pytest.raises(QueueFull):
+        lanes.put('r3', 'render')
+    assert lanes.ahead('render') == 3
+    assert [lanes.get_nowait() for _ in range(4)] == ['d1', 'r1', 'r2', 'b1']
+
+
+def test_engine_sheds_and_drops_work_past_its_deadline():
+    """
+    Test that the engine rejects requests whose estimated wait misses their deadline and drops
+    queued images whose deadline passed before they reach the model.
+
+    Raises
+    ------
+    AssertionError
+        If a request is not shed or an expired image is run through the model.
+    """
+    detector = BlockingDetector()
+    engine = BatchingEngine(detector, max_batch_size=1, max_wait_ms=0, lanes=LANES)
+    running = engine.submit('running')
+    while not engine._busy:
+        time.sleep(0.001)
+
+    token = start_admission('render', time.monotonic() + 0.05)
+    try:
+        expiring = engine.submit('expiring')
+    finally:
+        finish_admission(token)
+    time.sleep(0.1)
+    detector.release.set()
+    running.result(5)
+    with pytest.raises(DeadlineExceeded):
+        expiring.result(5)
+    assert detector.images == ['running']
+
+    engine._service_seconds = 1.0
+    with pytest.raises(DeadlineExceeded) as shed:
+        engine.submit('late', deadline=time.monotonic() + 0.5)
+    assert shed.value.retry_after >= 1.0
+    metrics = engine.metrics()
+    assert metrics['expired_total'] == 1 and metrics['rejected_total'] == {'deadline': 1}
+
+
+def test_engine_drops_expired_work_after_idling():
+    """
+    Test that an image whose deadline passed is dropped when it arrives after the engine idled.
+
+    Raises
+    ------
+    AssertionError
+        If the expired image is run through the model.
+    """
+    detector = BlockingDetector()
+    detector.release.set()
+    engine = BatchingEngine(detector, max_batch_size=1, max_wait_ms=0, lanes=LANES)
+    engine.submit('warm-up').result(5)
+    time.sleep(0.2)
+
+    # queued directly, past the admission check of submit, as if it expired while waiting
+    expired = Future()
+    now = time.monotonic()
+    engine._queue.put(('expired', 0.25, expired, now, now - 0.01), 'detect')
+    with pytest.raises(DeadlineExceeded):
+        expired.result(5)
+    assert detector.images == ['warm-up']
+
+
+def test_detect_batch_cancels_queued_images_on_rejection():
+    """
+    Test that the images of a batch queued before a rejected one are cancelled instead of run.
+
+    Raises
+    ------
+    AssertionError
+        If the batch is not rejected or its queued images reach the model.
+    """
+    detector = BlockingDetector()
+    engine = BatchingEngine(detector, max_batch_size=1, max_wait_ms=0, lanes=LANES, max_lane_depth=2)
+    running = engine.submit('running')
+    while not engine._busy:
+        time.sleep(0.001)
+
+    with pytest.raises(QueueFull):
+        engine.detect_batch(['a', 'b', 'c'])
+    detector.release.set()
+    running.result(5)
+    engine.submit('after').result(5)
+    assert detector.images == ['running', 'after']
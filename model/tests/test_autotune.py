@@ -0,0 +1,38 @@
+import json
+
+import torch
+
+import model.autotune as autotune_module
+from benchmark import StubNetwork
+from model.autotune import TuneConfig, autotune
+from model.yolov5 import YOLOv5
+
+
+def test_autotune_persists_and_reuses_profile(tmp_path, monkeypatch):
+    """
+    Test that the tuned configuration is applied, stored in the profile and reused without benchmarking.
+
+    Raises
+    ------
+    AssertionError
+        If the configuration is not applied, not stored, or measured again.
+    """
+    threads = torch.get_num_threads()
+    model = YOLOv5(device='cpu', backend='torch', network=StubNetwork(3))
+    path = str(tmp_path / 'profile.json')
+    try:
+        config = autotune(model, core_budget=2, profile_path=path, runs=1)
+        assert config.intra_threads in (1, 2)
+        assert torch.get_num_threads() == config.intra_threads
+        with open(path) as f:
+            assert list(json.load(f).values()) == [config._asdict()]
+
+        def benchmark_configs(*args, **kwargs):
+            raise AssertionError("the stored configuration was measured again")
+
+        monkeypatch.setattr(autotune_module, 'benchmark_configs', benchmark_configs)
+        assert autotune(model, core_budget=2, profile_path=path) == config
+        assert isinstance(config, TuneConfig)
+        assert len(model.detect(torch.zeros(640, 640, 3, dtype=torch.uint8).numpy())) == 3
+    finally:
+        torch.set_num_threads(threads)
@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from model.backends import TorchBackend, create_backend
+from model.detections import Detections, match_detections
+
+
+def test_match_detections_requires_class_and_overlap():
+    """
+    Test that boxes only match boxes of the same class that overlap enough, each at most once.
+
+    Raises
+    ------
+    AssertionError
+        If the match counts or the confidence error are wrong.
+    """
+    reference = Detections([[0, 0, 100, 100], [200, 200, 300, 300], [0, 0, 100, 100]], [0.9, 0.8, 0.7], [0, 1, 0])
+    candidate = Detections([[2, 2, 100, 100], [200, 200, 300, 300], [400, 400, 500, 500]], [0.88, 0.8, 0.6], [0, 2, 0])
+
+    result = match_detections(reference, candidate)
+
+    assert result['reference'] == 3 and result['candidate'] == 3
+    assert result['matched'] == 1
+    assert result['max_confidence_error'] == pytest.approx(0.02, abs=1e-6)
+
+
+def test_create_backend_rejects_unknown_and_gpu_only_backends():
+    """
+    Test that unknown backends and the CPU-only backends on a GPU device are rejected.
+
+    Raises
+    ------
+    AssertionError
+        If an invalid backend is created.
+    """
+    model = torch.nn.Identity()
+
+    assert isinstance(create_backend('torch', model, 'cpu', (640, 640)), TorchBackend)
+    with pytest.raises(ValueError):
+        create_backend('tensorrt', model, 'cpu', (640, 640))
+    with pytest.raises(ValueError):
+        create_backend('int8', model, 'cuda', (640, 640))
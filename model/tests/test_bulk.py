@@ -0,0 +1,111 @@
+import json
+import os
+import zipfile
+
+import cv2
+import numpy as np
+import pytest
+
+import model.bulk as bulk
+from model.bulk import run_bulk
+from model.detections import Detections
+
+
+class CountingModel:
+    """
+    A model detecting one box per image, failing after a given number of batches.
+    """
+    def __init__(self, fail_after=None):
+        self.fail_after = fail_after
+        self.batches = 0
+
+    def detect_batch(self, images, confidence_threshold):
+        if self.fail_after is not None and self.batches >= self.fail_after:
+            raise KeyboardInterrupt
+        self.batches += 1
+        return [Detections(np.array([[0, 0, 10, 10]], np.float32), np.array([0.9], np.float32),
+                           np.array([1]), ['a', 'b']) for _ in images]
+
+
+def write_images(directory, count):
+    os.makedirs(directory)
+    image = cv2.imencode('.png', np.zeros((32, 32, 3), np.uint8))[1].tobytes()
+    for i in range(count):
+        with open(os.path.join(directory, f'{i:03d}.png'), 'wb') as f:
+            f.write(image)
+    with open(os.path.join(directory, 'broken.jpg'), 'wb') as f:
+        f.write(b'not an image')
+
+
+def test_run_bulk_writes_every_image_in_order(tmp_path):
+    """
+    Test that every image of a directory and a zip archive gets one line, failed images included.
+
+    Raises
+    ------
+    AssertionError
+        If lines are missing, out of order, or the failed image has no error.
+    """
+    source = str(tmp_path / 'images')
+    write_images(source, 5)
+    archive = str(tmp_path / 'images.zip')
+    with zipfile.ZipFile(archive, 'w') as f:
+        for name in sorted(os.listdir(source)):
+            f.write(os.path.join(source, name), name)
+
+    for path in (source, archive):
+        output = path + '.jsonl'
+        counts = run_bulk(CountingModel(), path, output, batch_size=2, threads=2)
+        with open(output) as f:
+            lines = [json.loads(line) for line in f]
+
+        assert counts == {'images': 6, 'errors': 1, 'skipped': 0}
+        assert [line['image'] for line in lines] == [f'{i:03d}.png' for i in range(5)] + ['broken.jpg']
+        assert lines[0]['objects'][0]['class'] == 1
+        assert 'error' in lines[-1]
+
+
+def test_run_bulk_resumes_after_checkpoint(tmp_path):
+    """
+    Test that an interrupted run resumes after its last checkpoint without duplicating lines.
+
+    Raises
+    ------
+    AssertionError
+        If images are processed again or the output has duplicate lines.
+    """
+    source = str(tmp_path / 'images')
+    write_images(source, 9)
+    output = str(tmp_path / 'out.jsonl')
+
+    with pytest.raises(KeyboardInterrupt):
+        run_bulk(CountingModel(fail_after=3), source, output, batch_size=2, checkpoint_every=4)
+    assert os.path.exists(output + '.checkpoint')
+
+    counts = run_bulk(CountingModel(), source, output, batch_size=2, checkpoint_every=4)
+    with open(output) as f:
+        names = [json.loads(line)['image'] for line in f]
+
+    assert counts['skipped'] == 4
+    assert names == sorted(os.listdir(source))
+    assert not os.path.exists(output + '.checkpoint')
+
+
+def test_failed_images_are_returned_without_a_full_batch(monkeypatch):
+    """
+    Test that the results of undecodable images are returned once a batch worth of them is pending.
+
+    Raises
+    ------
+    AssertionError
+        If the failed images are held back until more images are read.
+    """
+    def broken_images(*args):
+        yield '0.jpg', None, None, 'broken'
+        yield '1.jpg', None, None, 'broken'
+        pytest.fail("read past the failed images before returning them")
+
+    monkeypatch.setattr(bulk, 'ImagePrefetcher', broken_images)
+    results = bulk.detect_images(CountingModel(), 'images', batch_size=2)
+    assert [(result.name, result.error) for result in (next(results), next(results))] == [
+        ('0.jpg', 'broken'), ('1.jpg', 'broken')]
@@ -0,0 +1,48 @@
+import re
+
+import pytest
+import torch
+
+import model.loader as loader
+from model.initialize_model import LazyModel
+
+
+def test_lazy_model_loads_on_first_attribute_access():
+    """
+    Test that the proxy only loads the model on the first attribute access, and only once.
+
+    Raises
+    ------
+    AssertionError
+        If the model is loaded early or more than once, or attributes are not forwarded.
+    """
+    class Model:
+        names = ['person']
+
+    calls = []
+    proxy = LazyModel(lambda: calls.append(1) or Model())
+    assert not proxy.loaded and proxy.load_seconds is None and not calls
+
+    assert proxy.names == ['person']
+    assert proxy.loaded and proxy.load_seconds is not None
+    proxy.names
+    assert calls == [1]
+
+
+def test_hub_fallback_is_skipped_when_disabled(tmp_path, monkeypatch):
+    """
+    Test that load_model does not download the model definitions when MODEL_HUB_FALLBACK is off.
+
+    Raises
+    ------
+    AssertionError
+        If torch.hub is used or the missing definitions are not reported.
+    """
+    def hub_load(*args, **kwargs):
+        pytest.fail("torch.hub.load was called")
+
+    monkeypatch.setattr(loader, 'YOLOV5_DIR', str(tmp_path))
+    monkeypatch.setattr(loader, 'MODEL_HUB_FALLBACK', False)
+    monkeypatch.setattr(torch.hub, 'load', hub_load)
+    with pytest.raises(FileNotFoundError, match=re.escape(str(tmp_path))):
+        loader.load_model(str(tmp_path / 'yolov5s.pt'), 'cpu')
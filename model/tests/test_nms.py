@@ -0,0 +1,56 @@
+import pytest
+import torch
+
+from model.nms import InvalidQuery, detection_query, non_max_suppression
+
+
+def prediction(*boxes, classes=3):
+    """
+    Builds a raw prediction of one image from (cx, cy, w, h, objectness, class id) boxes,
+    with a class score of 1 for the given class.
+    """
+    rows = torch.zeros(len(boxes), 5 + classes)
+    for row, (cx, cy, w, h, objectness, class_id) in zip(rows, boxes):
+        row[:5] = torch.tensor([cx, cy, w, h, objectness])
+        row[5 + class_id] = 1.0
+    return rows[None]
+
+
+def test_query_filters_are_applied_in_nms():
+    """
+    Test that the class allow-list, minimum area and maximum detections of a query select the boxes.
+
+    Raises
+    ------
+    AssertionError
+        If boxes of other classes, small boxes or too many boxes are returned.
+    """
+    raw = prediction((100, 100, 40, 40, 0.9, 0), (300, 300, 40, 40, 0.8, 1),
+                     (500, 500, 4, 4, 0.95, 0), (200, 400, 40, 40, 0.7, 0))
+
+    assert len(non_max_suppression(raw, 0.25)[0]) == 4
+
+    output = non_max_suppression(raw, detection_query(0.25, classes=(0,), min_area=100))[0]
+    assert output[:, 5].tolist() == [0, 0]
+    assert output[:, 4].tolist() == pytest.approx([0.9, 0.7])
+
+    output = non_max_suppression(raw, detection_query(0.25, max_det=1))[0]
+    assert output[:, 4].tolist() == pytest.approx([0.95])
+
+
+def test_detection_query_is_validated_and_cached():
+    """
+    Test that repeated parameter sets return the cached query and invalid filters are rejected.
+
+    Raises
+    ------
+    AssertionError
+        If the query is not cached or an invalid filter is accepted.
+    """
+    query = detection_query(0.5, classes=('2', 'car', '2'), iou=0.6)
+    assert query.classes == (2, 'car')
+    assert detection_query(0.5, classes=('2', 'car', '2'), iou=0.6) is query
+
+    for filters in ({'iou': 0}, {'max_det': 0}, {'min_area': -1}, {'classes': ()}):
+        with pytest.raises(InvalidQuery):
+            detection_query(0.5, **filters)
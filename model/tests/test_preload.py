@@ -0,0 +1,48 @@
+import os
+
+import torch
+
+from model.backends import TorchBackend
+from model.preload import share_model_memory
+from util.memory import process_memory
+
+
+class LoadedModel:
+    """
+    A loaded model with the attributes of YOLOv5 that share_model_memory uses.
+    """
+    def __init__(self):
+        self.model = torch.nn.Sequential(torch.nn.Conv2d(3, 8, 3), torch.nn.BatchNorm2d(8))
+        self.backend = TorchBackend(self.model)
+
+
+def test_share_model_memory_moves_weights_to_shared_memory():
+    """
+    Test that every parameter and buffer of the model ends up in shared memory.
+
+    Raises
+    ------
+    AssertionError
+        If a tensor is not shared or the reported size is wrong.
+    """
+    model = LoadedModel()
+    tensors = list(model.model.parameters()) + list(model.model.buffers())
+
+    shared_bytes = share_model_memory(model)
+
+    assert all(tensor.is_shared() for tensor in tensors)
+    assert shared_bytes == sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def test_process_memory_reports_current_process():
+    """
+    Test that the memory of the current process is reported.
+
+    Raises
+    ------
+    AssertionError
+        If the pid or the resident set size are wrong.
+    """
+    memory = process_memory()
+    assert memory["pid"] == os.getpid()
+    assert memory["rss"] > 0
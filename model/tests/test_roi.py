@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from model.detections import Detections
+from model.roi import CameraRegions, InvalidRegion, as_regions, detect_regions
+
+
+class CornerBoxDetector:
+    """
+    A detector returning one box near the top left corner of every image it is given, and one
+    overflowing its bottom right corner.
+    """
+    def __init__(self):
+        self.batches = []
+        self.names = ['corner', 'overflow']
+
+    def detect_batch(self, images, confidence_threshold):
+        self.batches.append([image.copy() for image in images])
+        results = []
+        for image in images:
+            height, width = image.shape[:2]
+            results.append(Detections([[2, 2, 12, 12], [width - 10, height - 10, width + 30, height + 30]],
+                                      [0.9, 0.8], [0, 1], self.names))
+        return results
+
+
+def test_detect_regions_maps_and_clips_boxes():
+    """
+    Test that region crops are run as one batch and their boxes are moved to image coordinates,
+    clipped to the region and filtered by the polygon.
+
+    Raises
+    ------
+    AssertionError
+        If the crops, the box coordinates or the polygon filtering are wrong.
+    """
+    img = np.full((400, 600, 3), 200, dtype=np.uint8)
+    detector = CornerBoxDetector()
+    # the triangle leaves out the top left corner of its 100x100 bounding box
+    regions = [(100, 50, 200, 150), [(300, 300), (400, 200), (400, 300)]]
+    detections = detect_regions(detector, img, regions)
+
+    assert len(detector.batches) == 1
+    rectangle, triangle = detector.batches[0]
+    assert rectangle.shape == (100, 100, 3) and triangle.shape == (100, 100, 3)
+    assert triangle[90, 90].tolist() == [200] * 3 and triangle[5, 5].tolist() == [114] * 3
+    np.testing.assert_array_equal(sorted(detections.boxes.tolist()), [
+        [102, 52, 112, 62], [190, 140, 200, 150], [390, 290, 400, 300]])
+
+
+
+def test_detect_regions_outside_the_image_keeps_class_names():
+    """
+    Test that regions entirely outside the image return no detections, with the class names of the model.
+
+    Raises
+    ------
+    AssertionError
+        If the model is run or the class names are missing.
+    """
+    class Engine:
+        model = CornerBoxDetector()
+
+    engine = Engine()
+    detections = detect_regions(engine, np.zeros((100, 100, 3), dtype=np.uint8), [(200, 200, 300, 300)])
+    assert len(detections) == 0 and not engine.model.batches
+    assert detections.names == ['corner', 'overflow']
+
+
+
+def test_regions_validation_and_camera_cache():
+    """
+    Test that invalid regions are rejected and camera regions are kept by id.
+
+    Raises
+    ------
+    AssertionError
+        If an invalid region is accepted or a camera loses its regions.
+    """
+    with pytest.raises(InvalidRegion):
+        as_regions([(10, 10, 5, 20)])
+    with pytest.raises(InvalidRegion):
+        as_regions([[(0, 0), (10, 10)]])
+
+    cameras = CameraRegions(capacity=1, configured={'gate': [(0, 0, 10, 10)]})
+    cameras.put('lobby', as_regions([(1, 2, 3, 4)]))
+    cameras.put('yard', as_regions([(5, 6, 7, 8)]))
+    assert cameras.get('lobby') is None
+    assert cameras.get('yard')[0].box == (5, 6, 7, 8)
+    assert cameras.get('gate')[0].box == (0, 0, 10, 10)
@@ -0,0 +1,63 @@
+import numpy as np
+
+from model.detections import Detections
+from model.tiling import detect_tiled, iter_tiles, tile_offsets
+
+
+class ShiftedBoxDetector:
+    """
+    A detector returning one box at the same position in every image it is given.
+    """
+    def __init__(self):
+        self.calls = 0
+
+    def detect_batch(self, images, confidence_threshold):
+        self.calls += 1
+        return [Detections([[10, 10, 50, 50]], [0.9], [0]) for _ in images]
+
+
+def test_tile_offsets_cover_the_image():
+    """
+    Test that tiles overlap and the last tile is aligned to the end of the image.
+
+    Raises
+    ------
+    AssertionError
+        If the offsets are wrong.
+    """
+    assert tile_offsets(500, 640, 512) == [0]
+    assert tile_offsets(1500, 640, 512) == [0, 512, 860]
+
+
+def test_iter_tiles_yields_views():
+    """
+    Test that tiles are views of the image and cover every pixel.
+
+    Raises
+    ------
+    AssertionError
+        If a tile is a copy or a pixel is not covered.
+    """
+    img = np.zeros((1000, 1500, 3), dtype=np.uint8)
+    covered = np.zeros(img.shape[:2], dtype=bool)
+    for x, y, tile in iter_tiles(img, tile_size=640, overlap=0.2):
+        assert np.shares_memory(tile, img)
+        covered[y:y + tile.shape[0], x:x + tile.shape[1]] = True
+    assert covered.all()
+
+
+def test_detect_tiled_offsets_and_batches():
+    """
+    Test that tile detections are moved to image coordinates and tiles are run in batches.
+
+    Raises
+    ------
+    AssertionError
+        If a tile box is not offset or the tiles are not batched.
+    """
+    detector = ShiftedBoxDetector()
+    img = np.zeros((640, 1500, 3), dtype=np.uint8)
+
+    detections = detect_tiled(detector, img, tile_size=640, overlap=0.2, batch_size=8, include_full=False)
+    assert detector.calls == 1
+    assert sorted(detections.boxes[:, 0].tolist()) == [10, 522, 870]
@@ -0,0 +1,91 @@
+import threading
+import time
+
+import numpy as np
+
+from model.detections import Detections
+from model.video import detect_video
+
+
+class FrameValueModel:
+    """
+    A model detecting one box at the pixel value of every frame it is given, recording its batches.
+    """
+    def __init__(self):
+        self.batches = []
+
+    def detect_batch(self, images, confidence_threshold):
+        values = [int(image[0, 0, 0]) for image in images]
+        self.batches.append(values)
+        return [Detections([[value, value, value + 10, value + 10]], [0.9], [0]) for value in values]
+
+
+def frames(*values):
+    # BGR frames with only the red channel set, the model sees the value in the first RGB channel
+    source = [np.zeros((36, 64, 3), dtype=np.uint8) for _ in values]
+    for frame, value in zip(source, values):
+        frame[..., 2] = value
+    return source
+
+
+def test_unchanged_frames_reuse_detections_in_order():
+    """
+    Test that frames barely differing from the last inferred one reuse its detections, that frames
+    come back in order, and that the caller's frames are not modified.
+
+    Raises
+    ------
+    AssertionError
+        If an unchanged frame is inferred, the order or the reused detections are wrong, or a frame changed.
+    """
+    model = FrameValueModel()
+    source = frames(30, 30, 100, 101, 10, 10)
+    originals = [frame.copy() for frame in source]
+    results = list(detect_video(model, source, batch_size=2, change_threshold=0.02, track=False))
+
+    assert [frame.index for frame in results] == list(range(6))
+    assert [frame.inferred for frame in results] == [True, False, True, False, True, False]
+    assert [frame.detections.boxes[0, 0] for frame in results] == [30, 30, 100, 100, 10, 10]
+    assert model.batches == [[30, 100], [10]]
+    for frame, original in zip(source, originals):
+        np.testing.assert_array_equal(frame, original)
+
+
+def test_max_skip_forces_inference():
+    """
+    Test that no more than max_skip consecutive frames reuse detections.
+
+    Raises
+    ------
+    AssertionError
+        If a frame past max_skip is not inferred.
+    """
+    model = FrameValueModel()
+    results = list(detect_video(model, frames(*[50] * 7), batch_size=8, max_skip=2, track=False))
+    assert [frame.index for frame in results if frame.inferred] == [0, 3, 6]
+
+
+def test_partial_batch_is_run_after_max_wait():
+    """
+    Test that a frame is not held back waiting for its batch to fill up when the source stalls.
+
+    Raises
+    ------
+    AssertionError
+        If the first frame is only returned once the source resumes.
+    """
+    resume = threading.Event()
+
+    def stream():
+        yield from frames(10)
+        resume.wait(5)
+        yield from frames(200)
+
+    model = FrameValueModel()
+    results = detect_video(model, stream(), batch_size=8, max_wait_ms=20, track=False)
+    started = time.monotonic()
+    first = next(results)
+    assert first.index == 0 and first.inferred and time.monotonic() - started < 2
+    resume.set()
+    assert [frame.index for frame in results] == [1]
+    assert model.batches == [[10], [200]]
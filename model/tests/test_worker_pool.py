@@ -0,0 +1,166 @@
+import itertools
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from model.admission import DeadlineExceeded, QueueFull
+from model.detections import Detections
+from model.worker_pool import WorkerPool, _process
+
+# Pixel value of the images the stub model fails on
+BROKEN = 255
+
+
+class PixelValueModel:
+    """
+    A model detecting one box at the pixel value of every image, failing batches with a broken image.
+    """
+    def __init__(self):
+        self.batches = []
+
+    def detect_batch(self, images, confidence_threshold):
+        values = [int(image[0, 0, 0]) for image in images]
+        self.batches.append(values)
+        if BROKEN in values:
+            raise ValueError("Broken image")
+        return [Detections([[value, value, value + 1, value + 1]], [threshold], [0])
+                for value, threshold in zip(values, confidence_threshold)]
+
+
+@pytest.fixture
+def segments():
+    created = []
+
+    def image_segment(value, shape=(8, 8, 3)):
+        segment = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+        np.ndarray(shape, dtype=np.uint8, buffer=segment.buf)[...] = value
+        created.append(segment)
+        return segment.name, shape
+
+    yield image_segment
+    for segment in created:
+        segment.close()
+        segment.unlink()
+
+
+def drain(results):
+    items = {}
+    while not results.empty():
+        task_id, ok, payload, batch_size, seconds = results.get_nowait()
+        items[task_id] = (ok, payload, batch_size, seconds)
+    return items
+
+
+def test_process_reads_images_from_shared_memory(segments):
+    """
+    Test that a worker runs the images handed over in shared memory as one batch, with their thresholds.
+
+    Raises
+    ------
+    AssertionError
+        If the pixels, thresholds or batch sizes of the results are wrong.
+    """
+    model, results = PixelValueModel(), queue.Queue()
+    _process(model, [(1, *segments(10), 0.25, None), (2, *segments(20), 0.5, None)], results)
+    items = drain(results)
+    assert model.batches == [[10, 20]]
+    assert items[1][0] and items[1][1].boxes[0, 0] == 10 and items[1][1].confidence[0] == 0.25
+    assert items[2][0] and items[2][1].boxes[0, 0] == 20 and items[2][1].confidence[0] == 0.5
+    assert items[1][2] == items[2][2] == 2 and items[1][3] == items[2][3] >= 0
+
+
+def test_process_isolates_failing_images_and_drops_expired_ones(segments):
+    """
+    Test that a failing image only fails its own task and that expired tasks are not run.
+
+    Raises
+    ------
+    AssertionError
+        If a good image fails with the broken one or an expired image reaches the model.
+    """
+    model, results = PixelValueModel(), queue.Queue()
+    expired = time.monotonic() - 1
+    _process(model, [(1, *segments(10), 0.25, None), (2, *segments(BROKEN), 0.25, None),
+                     (3, *segments(30), 0.25, expired)], results)
+    items = drain(results)
+    assert model.batches == [[10, BROKEN], [10], [BROKEN]]
+    assert items[1][0] and items[1][1].boxes[0, 0] == 10
+    assert not items[2][0] and isinstance(items[2][1], ValueError)
+    assert not items[3][0] and isinstance(items[3][1], DeadlineExceeded) and items[3][3] is None
+
+
+class AliveProcess:
+    def is_alive(self):
+        return True
+
+
+def collecting_pool(max_queue=0):
+    """
+    Returns a WorkerPool without worker processes whose collector thread reads the results put in _results.
+    """
+    pool = WorkerPool.__new__(WorkerPool)
+    pool.workers, pool.threads_per_worker, pool.max_batch_size, pool.max_queue = 1, 1, 2, max_queue
+    pool._ids, pool._tasks, pool._results = itertools.count(), queue.Queue(), queue.Queue()
+    pool._processes = [AliveProcess()]
+    pool._pending, pool._lock = {}, threading.Lock()
+    pool._batch_sizes, pool._images_total, pool._errors_total = Counter(), 0, 0
+    pool._service_seconds, pool._rejected, pool._expired_total = 0.0, Counter(), 0
+    threading.Thread(target=pool._collect, daemon=True).start()
+    return pool
+
+
+def test_collector_skips_cancelled_futures():
+    """
+    Test that the result of a cancelled task frees its shared memory without stopping the collector.
+
+    Raises
+    ------
+    AssertionError
+        If a later result is not delivered or the segment of the cancelled task is kept.
+    """
+    pool = collecting_pool()
+    cancelled, live = Future(), Future()
+    segments = [shared_memory.SharedMemory(create=True, size=1) for _ in range(2)]
+    pool._pending = {0: (cancelled, segments[0]), 1: (live, segments[1])}
+    cancelled.cancel()
+    pool._results.put((0, True, 'cancelled', 1, 0.1))
+    pool._results.put((1, True, 'live', 1, 0.1))
+    assert live.result(5) == 'live'
+    for segment in segments:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=segment.name)
+
+
+def test_pool_sheds_when_full_or_too_slow():
+    """
+    Test that the pool rejects images beyond max_queue and images whose deadline the estimated
+    wait would miss, and cancels the queued images of a rejected batch.
+
+    Raises
+    ------
+    AssertionError
+        If an image is queued past the limit, the wait estimate is wrong or a batch keeps its queued images.
+    """
+    pool = collecting_pool(max_queue=3)
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    with pytest.raises(QueueFull):
+        pool.detect_batch([image] * 4)
+    assert len(pool._tasks.queue) == 3
+    assert all(future.cancelled() for future, _ in pool._pending.values())
+
+    for task_id, *_ in list(pool._tasks.queue):
+        pool._results.put((task_id, True, None, 2, 0.5))
+    while pool._pending:
+        time.sleep(0.001)
+    assert pool._service_seconds == pytest.approx(0.5)
+    pool._pending = dict.fromkeys(range(2))
+    assert pool.estimated_wait() == pytest.approx(1.0)
+    with pytest.raises(DeadlineExceeded):
+        pool.submit(image, deadline=time.monotonic() + 0.5)
+    assert pool.metrics()['rejected_total'] == {'queue_full': 1, 'deadline': 1}
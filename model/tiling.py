@@ -0,0 +1,140 @@
+from concurrent.futures import ThreadPoolExecutor
+from model.detections import Detections
+from model.nms import DetectionQuery, merge_detections
+from util.image_utils import load_image
+from settings import DETECT_THRESHOLD, BATCH_MAX_SIZE, TILE_SIZE, TILE_OVERLAP, TILE_WORKERS
+
+
+def tile_offsets(length, tile_size, stride):
+    """
+    Computes the start positions of overlapping tiles along one axis, with the last tile
+    aligned to the end so that every pixel is covered.
+
+    Parameters
+    ----------
+    length : int
+        the size of the image along the axis
+    tile_size : int
+        the size of a tile
+    stride : int
+        the distance between the starts of consecutive tiles
+
+    Returns
+    -------
+    offsets : list of int
+    """
+    if length <= tile_size:
+        return [0]
+    offsets = list(range(0, length - tile_size, stride))
+    offsets.append(length - tile_size)
+    return offsets
+
+
+def iter_tiles(img, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    """
+    Yields overlapping tiles of an image as views of its pixel array, without copying them.
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        the RGB pixels of the image
+    tile_size : int, optional
+        the width and height of a tile in pixels (default from settings.py)
+    overlap : float, optional
+        the fraction of a tile shared with its neighbours (default from settings.py)
+
+    Returns
+    -------
+    tiles : generator of (int, int, numpy.ndarray)
+    the left and top offsets of every tile and its pixels
+    """
+    stride = max(1, int(tile_size * (1 - overlap)))
+    height, width = img.shape[:2]
+    for y in tile_offsets(height, tile_size, stride):
+        for x in tile_offsets(width, tile_size, stride):
+            yield x, y, img[y:y + tile_size, x:x + tile_size]
+
+
+def _batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def detect_tiled(detector, image, confidence_threshold=DETECT_THRESHOLD, tile_size=TILE_SIZE,
+                 overlap=TILE_OVERLAP, batch_size=BATCH_MAX_SIZE, workers=TILE_WORKERS, include_full=True):
+    """
+    Detects objects in a large image by running overlapping tiles through the model in batches and
+    merging their detections with non-maximum suppression across tiles.
+
+    Tiles are streamed as views of the image, so at most workers batches of tiles are letterboxed
+    at once, whatever the size of the image.
+
+    Parameters
+    ----------
+    detector : object
+        a YOLOv5 model or inference engine with a detect_batch method
+    image : str, PIL.Image or numpy.ndarray
+        the image to detect objects in
+    confidence_threshold : float or DetectionQuery, optional
+        the confidence threshold for object detection, or a query with further filters (default from settings.py)
+    tile_size : int, optional
+        the width and height of a tile in pixels (default from settings.py)
+    overlap : float, optional
+        the fraction of a tile shared with its neighbours (default from settings.py)
+    batch_size : int, optional
+        the number of tiles in one forward pass (default from settings.py)
+    workers : int, optional
+        the number of batches run concurrently, 1 runs them one after another (default from settings.py)
+    include_full : bool, optional
+        whether to also detect on the whole downscaled image, for objects larger than a tile (default is True)
+
+    Returns
+    -------
+    result : Detections
+    the merged detections in image coordinates
+    """
+    img = load_image(image)
+    height, width = img.shape[:2]
+    if height <= tile_size and width <= tile_size:
+        return detector.detect_batch([img], confidence_threshold)[0]
+
+    regions = iter_tiles(img, tile_size, overlap)
+    if include_full:
+        regions = _prepend((0, 0, img), regions)
+
+    def run(batch):
+        results = detector.detect_batch([tile for _, _, tile in batch], confidence_threshold)
+        return [_offset(detections, x, y) for (x, y, _), detections in zip(batch, results)]
+
+    detections = []
+    if workers <= 1:
+        for batch in _batches(regions, batch_size):
+            detections.extend(run(batch))
+    else:
+        with ThreadPoolExecutor(workers) as executor:
+            in_flight = []
+            for batch in _batches(regions, batch_size):
+                in_flight.append(executor.submit(run, batch))
+                if len(in_flight) >= workers:
+                    detections.extend(in_flight.pop(0).result())
+            for future in in_flight:
+                detections.extend(future.result())
+    if isinstance(confidence_threshold, DetectionQuery):
+        return merge_detections(detections, confidence_threshold.iou, confidence_threshold.max_det)
+    return merge_detections(detections)
+
+
+def _prepend(first, items):
+    yield first
+    yield from items
+
+
+def _offset(detections, x, y):
+    boxes = detections.boxes + [x, y, x, y]
+    return Detections(boxes, detections.confidence, detections.class_ids, detections.names)
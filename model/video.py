@@ -0,0 +1,221 @@
+import queue
+import threading
+import time
+from collections import namedtuple
+import cv2
+import numpy as np
+from model.detections import Detections
+from util.df_to_json import detections_to_json
+from settings import (DETECT_THRESHOLD, BATCH_MAX_SIZE, VIDEO_CHANGE_THRESHOLD, VIDEO_MAX_SKIP, VIDEO_QUEUE_SIZE,
+                      VIDEO_TRACK_BOXES, VIDEO_MAX_WAIT_MS)
+
+# Size of the grayscale thumbnails frames are compared and tracked on
+THUMBNAIL_SIZE = (64, 36)
+
+VideoFrame = namedtuple('VideoFrame', ['index', 'timestamp_ms', 'detections', 'inferred'])
+VideoFrame.__doc__ = """
+The detections of one video frame. 'inferred' is False when the detections were reused
+from an earlier frame because the content barely changed.
+"""
+
+_END = object()
+
+
+class FrameReader:
+    """
+    Reads and decodes frames on a background thread into a bounded queue, so decoding
+    overlaps with inference. Frames of an iterable source are converted to RGB copies,
+    the caller's arrays are left untouched.
+
+    Parameters
+    ----------
+    source : str, int or iterable of numpy.ndarray
+        a video file, stream URL or camera index opened with OpenCV, or an iterable of BGR frames
+    queue_size : int, optional
+        the maximum number of decoded frames waiting for inference (default from settings.py)
+    timeout : float, optional
+        the time in seconds iterating waits for a frame before yielding None instead, None waits
+        indefinitely; it may be changed while iterating (default is None)
+    """
+    def __init__(self, source, queue_size=VIDEO_QUEUE_SIZE, timeout=None):
+        self.source = source
+        self.fps = None
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="video-reader", daemon=True)
+
+    def __iter__(self):
+        self._thread.start()
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=self.timeout)
+                except queue.Empty:
+                    yield None
+                    continue
+                if item is _END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self._stopped.set()
+
+    def _frames(self):
+        if not isinstance(self.source, (str, int)):
+            for index, frame in enumerate(self.source):
+                yield index, None, frame
+            return
+        capture = cv2.VideoCapture(self.source)
+        if not capture.isOpened():
+            raise IOError(f"Could not open video source {self.source!r}")
+        self.fps = capture.get(cv2.CAP_PROP_FPS) or None
+        try:
+            index = 0
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    return
+                yield index, capture.get(cv2.CAP_PROP_POS_MSEC), frame
+                index += 1
+        finally:
+            capture.release()
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        # only the frames decoded by OpenCV belong to the reader and are converted in place
+        captured = isinstance(self.source, (str, int))
+        try:
+            for index, timestamp_ms, frame in self._frames():
+                rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame if captured else None)
+                if not self._put((index, timestamp_ms, rgb)):
+                    return
+        except Exception as exc:
+            self._put(exc)
+        self._put(_END)
+
+
+def frame_to_json(frame):
+    """
+    Serializes the detections of a video frame into one JSON line.
+
+    Parameters
+    ----------
+    frame : VideoFrame
+        the detections of the frame
+
+    Returns
+    -------
+    json_text : str
+    """
+    timestamp = 'null' if frame.timestamp_ms is None else repr(float(frame.timestamp_ms))
+    prefix = '{"frame": %d, "timestamp_ms": %s, "inferred": %s, ' % (
+        frame.index, timestamp, 'true' if frame.inferred else 'false')
+    return prefix + detections_to_json(frame.detections)[1:]
+
+
+def _thumbnail(frame):
+    gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+    return cv2.resize(gray, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+def _shift(detections, thumbnail, reference, frame_shape):
+    """
+    Moves the boxes of a keyframe by the global motion between its thumbnail and the current one.
+    """
+    (dx, dy), _ = cv2.phaseCorrelate(reference, thumbnail)
+    height, width = frame_shape[:2]
+    offset = np.array([dx * width / THUMBNAIL_SIZE[0], dy * height / THUMBNAIL_SIZE[1]] * 2, dtype=np.float32)
+    limit = np.array([width, height, width, height], dtype=np.float32)
+    boxes = np.clip(detections.boxes + offset, 0, limit)
+    return Detections(boxes, detections.confidence, detections.class_ids, detections.names)
+
+
+def detect_video(model, source, confidence_threshold=DETECT_THRESHOLD, batch_size=BATCH_MAX_SIZE,
+                 change_threshold=VIDEO_CHANGE_THRESHOLD, max_skip=VIDEO_MAX_SKIP, track=VIDEO_TRACK_BOXES,
+                 max_wait_ms=VIDEO_MAX_WAIT_MS):
+    """
+    Detects objects in the frames of a video or frame stream.
+
+    Frames are decoded on a background thread and batched to the model. A frame whose content differs
+    from the last inferred frame by less than change_threshold reuses its detections, moved by the
+    global motion between the frames when track is enabled, instead of running inference. A batch
+    is run when it is full or its first frame waited max_wait_ms, and frames reusing the detections
+    of an inferred frame are returned without waiting.
+
+    Parameters
+    ----------
+    model : YOLOv5
+        the model used to run batched detection
+    source : str, int or iterable of numpy.ndarray
+        a video file, stream URL or camera index opened with OpenCV, or an iterable of BGR frames
+    confidence_threshold : float, optional
+        the confidence threshold for object detection (default from settings.py)
+    batch_size : int, optional
+        the number of inferred frames in one forward pass (default from settings.py)
+    change_threshold : float, optional
+        the mean absolute difference of the frame thumbnails, as a fraction of the full intensity range,
+        below which detections are reused; 0 runs inference on every frame (default from settings.py)
+    max_skip : int, optional
+        the maximum number of consecutive frames reusing detections (default from settings.py)
+    track : bool, optional
+        whether to move reused boxes by the global motion of the frame (default from settings.py)
+    max_wait_ms : float, optional
+        the maximum time in milliseconds a frame waits for its batch to fill up (default from settings.py)
+
+    Returns
+    -------
+    frames : generator of VideoFrame
+    the detections of every frame, in order
+    """
+    pending = []
+    batch = []
+    keyframes = {}
+    reference = None
+    key = None
+    skipped = 0
+    deadline = None
+
+    def flush():
+        results = model.detect_batch([frame for _, frame, _ in batch], confidence_threshold) if batch else []
+        for (index, _, thumbnail), detections in zip(batch, results):
+            keyframes[index] = (detections, thumbnail)
+        batch.clear()
+        for index, timestamp_ms, frame_key, thumbnail, shape in pending:
+            detections, key_thumbnail = keyframes[frame_key]
+            if frame_key != index and track and len(detections):
+                detections = _shift(detections, thumbnail, key_thumbnail, shape)
+            yield VideoFrame(index, timestamp_ms, detections, frame_key == index)
+        pending.clear()
+        # later frames can only reuse the detections of the last keyframe
+        for index in sorted(keyframes)[:-1]:
+            del keyframes[index]
+
+    reader = FrameReader(source)
+    for item in reader:
+        if item is not None:
+            index, timestamp_ms, frame = item
+            thumbnail = _thumbnail(frame)
+            if reference is None or skipped >= max_skip or \
+                    np.abs(thumbnail - reference).mean() / 255.0 >= change_threshold:
+                key, reference, skipped = index, thumbnail, 0
+                if not batch:
+                    deadline = time.monotonic() + max_wait_ms / 1000
+                batch.append((index, frame, thumbnail))
+            else:
+                skipped += 1
+            pending.append((index, timestamp_ms, key, thumbnail, frame.shape))
+        if len(batch) >= batch_size or (pending and not batch) or (batch and time.monotonic() >= deadline):
+            yield from flush()
+        # wakes up when the batch is due even if no frame arrives
+        reader.timeout = max(0.0, deadline - time.monotonic()) if batch else None
+    yield from flush()
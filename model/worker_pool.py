@@ -0,0 +1,346 @@
+import itertools
+import multiprocessing as mp
+import os
+import pickle
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+import numpy as np
+from util.image_utils import load_image
+from model.admission import DeadlineExceeded, QueueFull, current_admission
+from model.nms import per_image
+from settings import BATCH_MAX_SIZE, DETECT_THRESHOLD, LANE_MAX_QUEUE, SERVICE_TIME_SMOOTHING
+
+
+def _pin_threads(worker_index, threads_per_worker):
+    import torch
+
+    torch.set_num_threads(threads_per_worker)
+    torch.set_num_interop_threads(1)
+    if hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        start = (worker_index * threads_per_worker) % len(cores)
+        os.sched_setaffinity(0, cores[start:start + threads_per_worker] or cores)
+
+
+def _worker_main(worker_index, threads_per_worker, max_batch_size, tasks, results):
+    _pin_threads(worker_index, threads_per_worker)
+    from model.initialize_model import warm_up
+
+    model = warm_up()
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        batch = [task]
+        while len(batch) < max_batch_size:
+            try:
+                task = tasks.get_nowait()
+            except queue.Empty:
+                break
+            if task is None:
+                tasks.put(None)
+                break
+            batch.append(task)
+        _process(model, batch, results)
+
+
+def _process(model, batch, results):
+    # time.monotonic() is system-wide, the deadlines set in the server process hold in the workers
+    now = time.monotonic()
+    live = []
+    for task in batch:
+        if task[4] is not None and now > task[4]:
+            results.put((task[0], False, DeadlineExceeded("The request deadline passed before inference"), 1, None))
+        else:
+            live.append(task)
+    if not live:
+        return
+    batch = live
+    segments = [shared_memory.SharedMemory(name=name) for _, name, _, _, _ in batch]
+    try:
+        images = [np.ndarray(shape, dtype=np.uint8, buffer=segment.buf)
+                  for segment, (_, _, shape, _, _) in zip(segments, batch)]
+        thresholds = [threshold for _, _, _, threshold, _ in batch]
+        started = time.monotonic()
+        try:
+            outputs = [(True, detections) for detections in model.detect_batch(images, thresholds)]
+        except Exception as exc:
+            if len(batch) > 1:
+                # isolate the failing image instead of failing every caller in the batch
+                del images
+                for task in batch:
+                    _process(model, [task], results)
+                return
+            outputs = [(False, _picklable(exc))]
+        seconds = time.monotonic() - started
+        del images
+    finally:
+        for segment in segments:
+            segment.close()
+    for (task_id, _, _, _, _), (ok, payload) in zip(batch, outputs):
+        results.put((task_id, ok, payload, len(batch), seconds))
+
+
+def _picklable(exc):
+    # exceptions are sent back to the caller, so that errors such as InvalidQuery keep their type
+    try:
+        pickle.loads(pickle.dumps(exc))
+        return exc
+    except Exception:
+        return RuntimeError(f"{type(exc).__name__}: {exc}")
+
+
+class WorkerPool:
+    """
+    Runs detection in a pool of model worker processes. Decoded pixels are handed to the workers
+    through shared memory, only the small detection arrays are pickled back. The workers share one
+    queue without priority lanes. Images are shed instead of queued when the pool already holds
+    max_queue images, or when the wait estimated from the measured batch service time would miss
+    their deadline, and the workers drop the images whose deadline has passed.
+
+    Attributes
+    ----------
+    workers : int
+        the number of model worker processes
+    threads_per_worker : int
+        the number of torch intra-op threads, and pinned cores, of every worker
+
+    Parameters
+    ----------
+    workers : int
+        the number of model worker processes
+    threads_per_worker : int, optional
+        the number of torch intra-op threads of every worker (default is the available cores divided by workers)
+    max_batch_size : int, optional
+        the maximum number of queued images a worker runs in one forward pass (default from settings.py)
+    max_queue : int, optional
+        the maximum number of images queued or running in the pool, 0 for no limit (default from settings.py)
+    """
+    def __init__(self, workers, threads_per_worker=None, max_batch_size=BATCH_MAX_SIZE, max_queue=LANE_MAX_QUEUE):
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        self.workers = max(1, int(workers))
+        self.threads_per_worker = threads_per_worker or max(1, cores // self.workers)
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_queue = max_queue
+
+        ctx = mp.get_context('spawn')
+        self._tasks = ctx.Queue()
+        self._results = ctx.Queue()
+        self._processes = [
+            ctx.Process(target=_worker_main, name=f"yolo-worker-{i}", daemon=True,
+                        args=(i, self.threads_per_worker, self.max_batch_size, self._tasks, self._results))
+            for i in range(self.workers)
+        ]
+        for process in self._processes:
+            process.start()
+
+        self._ids = itertools.count()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._images_total = 0
+        self._errors_total = 0
+        self._service_seconds = 0.0
+        self._rejected = Counter()
+        self._expired_total = 0
+        self._collector = threading.Thread(target=self._collect, name="yolo-worker-results", daemon=True)
+        self._collector.start()
+
+    def submit(self, image, confidence_threshold=DETECT_THRESHOLD, lane=None, deadline=None):
+        """
+        Copies the pixels of an image into shared memory and queues it for a worker.
+
+        Parameters
+        ----------
+        image : str, PIL.Image or numpy.ndarray
+            the image to detect objects in
+        confidence_threshold : float or DetectionQuery, optional
+            the confidence threshold for object detection, or a query with further filters (default from settings.py)
+        lane : str, optional
+            the priority lane, accepted for compatibility with BatchingEngine and ignored
+        deadline : float, optional
+            the time.monotonic() time the result is useless after (default is the deadline of the current request)
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+        a future resolved with the detections of the image, or failed with DeadlineExceeded when
+        the deadline passes before a worker takes the image
+
+        Raises
+        ------
+        QueueFull
+            if the pool already holds max_queue images
+        DeadlineExceeded
+            if the estimated wait for a worker would miss the deadline
+        """
+        deadline = current_admission().deadline if deadline is None else deadline
+        if self.max_queue and len(self._pending) >= self.max_queue:
+            self._reject('queue_full')
+            raise QueueFull("The inference queue is full", self.estimated_wait())
+        if deadline is not None:
+            wait = self.estimated_wait()
+            if time.monotonic() + wait > deadline:
+                self._reject('deadline')
+                raise DeadlineExceeded("The request deadline cannot be met", wait)
+        img = load_image(image)
+        segment = shared_memory.SharedMemory(create=True, size=max(1, img.nbytes))
+        np.ndarray(img.shape, dtype=np.uint8, buffer=segment.buf)[...] = img
+
+        future = Future()
+        task_id = next(self._ids)
+        with self._lock:
+            self._pending[task_id] = (future, segment)
+        self._tasks.put((task_id, segment.name, img.shape, confidence_threshold, deadline))
+        return future
+
+    def detect(self, image, confidence_threshold=DETECT_THRESHOLD):
+        """
+        Detects objects in an image in one of the worker processes.
+
+        Parameters
+        ----------
+        image : str, PIL.Image or numpy.ndarray
+            the image to detect objects in
+        confidence_threshold : float or DetectionQuery, optional
+            the confidence threshold for object detection, or a query with further filters (default from settings.py)
+
+        Returns
+        -------
+        result : Detections
+        the detections of the image, as returned by YOLOv5.detect
+        """
+        return self.submit(image, confidence_threshold).result()
+
+    def detect_batch(self, images, confidence_threshold=DETECT_THRESHOLD):
+        """
+        Detects objects in several images, spread over the worker processes.
+
+        Parameters
+        ----------
+        images : list of str, PIL.Image or numpy.ndarray
+            the images to detect objects in
+        confidence_threshold : float, DetectionQuery or list, optional
+            the confidence threshold, either shared by all images or one per image (default from settings.py)
+
+        Returns
+        -------
+        results : list of Detections
+        the detections of every image
+
+        Raises
+        ------
+        DeadlineExceeded
+            if an image is rejected, the images queued before it are cancelled
+        """
+        thresholds = per_image(confidence_threshold, len(images))
+        futures = []
+        try:
+            for image, threshold in zip(images, thresholds):
+                futures.append(self.submit(image, threshold))
+        except Exception:
+            # the images queued so far are not waited for when a later one is rejected
+            for future in futures:
+                future.cancel()
+            raise
+        return [future.result() for future in futures]
+
+    def estimated_wait(self, lane=None):
+        """
+        Estimates the time until a new image is detected, from the images queued or running in the pool
+        and the moving average of the batch service time.
+
+        Parameters
+        ----------
+        lane : str, optional
+            the priority lane, accepted for compatibility with BatchingEngine and ignored
+
+        Returns
+        -------
+        seconds : float
+        """
+        return (len(self._pending) // (self.max_batch_size * self.workers) + 1) * self._service_seconds
+
+    def metrics(self):
+        """
+        Returns queue depth and batch size metrics of the worker pool.
+
+        Returns
+        -------
+        metrics : dict
+        a dictionary with the number of pending images and cumulative counters
+        """
+        with self._lock:
+            batches = sum(count / size for size, count in self._batch_sizes.items())
+            return {
+                "queue_depth": len(self._pending),
+                "workers": self.workers,
+                "workers_alive": sum(process.is_alive() for process in self._processes),
+                "threads_per_worker": self.threads_per_worker,
+                "images_total": self._images_total,
+                "errors_total": self._errors_total,
+                "mean_batch_size": self._images_total / batches if batches else 0.0,
+                "batch_size_histogram": {str(size): int(count / size)
+                                         for size, count in sorted(self._batch_sizes.items())},
+                "service_ms": 1000.0 * self._service_seconds,
+                "rejected_total": dict(self._rejected),
+                "expired_total": self._expired_total,
+            }
+
+    def close(self):
+        """
+        Stops the worker processes.
+        """
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+
+    def _collect(self):
+        while True:
+            try:
+                task_id, ok, payload, batch_size, seconds = self._results.get(timeout=1.0)
+            except queue.Empty:
+                if not any(process.is_alive() for process in self._processes):
+                    self._fail_pending(RuntimeError("All model worker processes have exited"))
+                continue
+            with self._lock:
+                future, segment = self._pending.pop(task_id)
+                self._images_total += 1
+                self._batch_sizes[batch_size] += 1
+                if not ok:
+                    self._errors_total += 1
+                if seconds is None:
+                    self._expired_total += 1
+                elif self._images_total > batch_size:
+                    # every image of a batch reports the batch time, together they move the average once
+                    self._service_seconds += SERVICE_TIME_SMOOTHING / batch_size * (seconds - self._service_seconds)
+                else:
+                    self._service_seconds = seconds
+            segment.close()
+            segment.unlink()
+            # the future of a caller that gave up, such as a disconnected ASGI client, is cancelled
+            if not future.set_running_or_notify_cancel():
+                continue
+            if ok:
+                future.set_result(payload)
+            else:
+                future.set_exception(payload)
+
+    def _reject(self, reason):
+        with self._lock:
+            self._rejected[reason] += 1
+
+    def _fail_pending(self, exc):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._errors_total += len(pending)
+        for future, segment in pending.values():
+            segment.close()
+            segment.unlink()
+            if future.set_running_or_notify_cancel():
+                future.set_exception(exc)
@@ -1,10 +1,30 @@
 import os
+import threading
 import torch
 import base64
-from io import BytesIO
-from util.draw_bbox import draw_boxes_on_image
-from util.image_utils import preprocess_image
-from settings import MODEL_LINK, MODEL_NAME, DETECT_THRESHOLD
+from functools import lru_cache
+from model.backends import create_backend
+from model.detections import Detections, match_detections
+from model.loader import load_model
+from model.nms import DetectionQuery, InvalidQuery, detection_query, non_max_suppression, per_image
+from model.roi import detect_regions
+from model.tiling import detect_tiled
+from util.draw_bbox import draw_boxes
+from util.image_utils import (LetterboxBuffer, encode_image, letterbox_boxes, letterbox_image, load_image,
+                              perceptual_hash, unletterbox_boxes)
+from util.metrics import timed
+from settings import (MODEL_LINK, MODEL_NAME, MODEL_BACKEND, DETECT_THRESHOLD, INPUT_SIZE, RENDER_JPEG_QUALITY, RENDER_LABELS,
+                      RENDER_CLASS_COLORS, MAX_DETECTIONS, NMS_IOU_THRESHOLD)
+
+
+def _letterbox(detections, letterbox):
+    return Detections(letterbox_boxes(detections.boxes, letterbox), detections.confidence, detections.class_ids,
+                      detections.names)
+
+
+def _unletterbox(detections, letterbox):
+    return Detections(unletterbox_boxes(detections.boxes, letterbox), detections.confidence, detections.class_ids,
+                      detections.names)
 
 
 class YOLOv5:
@@ -15,6 +35,14 @@ class YOLOv5:
         the device used to run the model (default 'cuda')
     model : torch.nn.Module
         the YOLOv5 model loaded from file
+    backend : callable
+        the inference backend running the model
+    similarity_cache : SimilarityCache or None
+        the index of near-duplicate images whose detections are reused, None runs every image (default is None)
+    channels_last : bool
+        whether inputs are passed to the network in channels-last memory format (default is False)
+    precision : str
+        'float32', or 'bfloat16' to run the network under CPU autocast (default is 'float32')
         Parameters
     ----------
     device : str, optional
@@ -25,8 +53,12 @@ class YOLOv5:
         the URL to download the model file (default is from settings.py)
     model_name : str, optional
         the name of the model file (default is from settings.py)
+    backend : str, optional
+        the inference backend, see model.backends.BACKENDS (default is from settings.py)
+    network : torch.nn.Module, optional
+        an already loaded network used instead of the model file, for example a stub in benchmarks
     """
-    def __init__(self, device='cuda', model_path=None, model_link=None, model_name=None):
+    def __init__(self, device='cuda', model_path=None, model_link=None, model_name=None, backend=None, network=None):
         self.device = device
         if model_path is None:
             model_path = os.path.abspath(os.path.dirname(__file__))
@@ -34,64 +66,269 @@ class YOLOv5:
             model_name = MODEL_NAME
         model_file_path = os.path.join(model_path, model_name)
 
-        if not os.path.exists(model_file_path):
-            if model_link is None:
-                model_link = MODEL_LINK
-            torch.hub.download_url_to_file(model_link, model_file_path)
+        if network is None:
+            if not os.path.exists(model_file_path):
+                if model_link is None:
+                    model_link = MODEL_LINK
+                torch.hub.download_url_to_file(model_link, model_file_path)
+            network = load_model(model_file_path, self.device)
 
-        self.model = torch.hub.load('ultralytics/yolov5', 'custom',
-                                    path=os.path.join(model_path, model_name),
-                                    force_reload=True)
+        self.model = network
         self.model.to(self.device).eval()
+        self.input_size = (INPUT_SIZE, INPUT_SIZE)
+        self.weights_path = model_file_path
+        self.backend = create_backend(backend or MODEL_BACKEND, self.model, self.device, self.input_size,
+                                      model_file_path)
+        self.similarity_cache = None
+        self.channels_last = False
+        self.precision = 'float32'
+        self._buffers = threading.local()
+        self.resolve_query = lru_cache(maxsize=256)(self._resolve_query)
 
-    def detect(self, image, confidence_threshold=DETECT_THRESHOLD):
+    def detect(self, image, confidence_threshold=DETECT_THRESHOLD, tiled=False, classes=None,
+               max_det=MAX_DETECTIONS, iou=NMS_IOU_THRESHOLD, min_area=0.0, regions=None):
         """
         Detects objects in an image using the YOLOv5 model.
 
         Parameters
         ----------
-        image : PIL.Image
+        image : str, PIL.Image or numpy.ndarray
             the image to detect objects in
         confidence_threshold : float, optional
             the confidence threshold for object detection (default from settings.py)
+        tiled : bool, optional
+            whether to detect on overlapping full-resolution tiles, for large images
+            with small objects (default is False)
+        classes : list of int or str, optional
+            the class ids or names to detect, None detects every class (default is None)
+        max_det : int, optional
+            the maximum number of detections (default from settings.py)
+        iou : float, optional
+            the IoU threshold of the non-maximum suppression (default from settings.py)
+        min_area : float, optional
+            the minimum box area in image pixels (default is 0)
+        regions : sequence, optional
+            regions of interest, 'xmin', 'ymin', 'xmax', 'ymax' rectangles or lists of (x, y) polygon
+            vertices; only their crops are run through the model, in one batch, and tiled is ignored
+            (default is None, the whole image)
+
+        Returns
+        -------
+        result : Detections
+        the detected objects with their boxes, confidences and class ids;
+        use Detections.to_pandas to get a DataFrame
+        """
+        if (classes, max_det, iou, min_area) != (None, MAX_DETECTIONS, NMS_IOU_THRESHOLD, 0.0):
+            if isinstance(classes, (str, int)):
+                classes = [classes]
+            confidence_threshold = detection_query(confidence_threshold, None if classes is None else tuple(classes),
+                                                   max_det, iou, min_area)
+        if regions is not None:
+            return detect_regions(self, image, regions, confidence_threshold)
+        if tiled:
+            return detect_tiled(self, image, confidence_threshold)
+        return self.detect_batch([image], confidence_threshold)[0]
+
+    def detect_batch(self, images, confidence_threshold=DETECT_THRESHOLD):
+        """
+        Detects objects in several images with a single forward pass of the YOLOv5 model.
+
+        Parameters
+        ----------
+        images : list of str, PIL.Image or numpy.ndarray
+            the images to detect objects in
+        confidence_threshold : float, DetectionQuery or list, optional
+            the confidence threshold for object detection, or a query with further filters,
+            either shared by all images or one per image (default from settings.py)
 
         Returns
         -------
-        result : pandas.DataFrame
-        a DataFrame containing the detected objects with columns 'class', 'confidence', 'xmin', 'ymin', 'xmax', 'ymax'
+        results : list of Detections
+        the detections of every image, in the same format as returned by detect
+
+        Raises
+        ------
+        InvalidQuery
+            if a query filters on class names the model does not know
+        """
+        thresholds = per_image(confidence_threshold, len(images))
+        if len(thresholds) != len(images):
+            raise ValueError("confidence_threshold must be a float or have one value per image")
+        thresholds = [self.resolve_query(t) if isinstance(t, DetectionQuery) else t for t in thresholds]
+
+        batch, letterboxes = self.preprocess(images)
+        if self.similarity_cache is not None:
+            return self._detect_similar(batch, letterboxes, thresholds)
+        with torch.no_grad():
+            prediction = self.forward(batch)
+        return self.postprocess(prediction, letterboxes, thresholds)
+
+    def _detect_similar(self, batch, letterboxes, thresholds):
+        """
+        Reuses the detections of near-duplicate images from the similarity cache and runs only the
+        other images, and the audited hits, through the model. Detections are stored in model input
+        coordinates, so they are rescaled to every copy of an image whatever its size.
         """
+        cache = self.similarity_cache
+        with timed('similarity'):
+            hashes = [perceptual_hash(pixels) for pixels in self._input_buffer().batch(len(letterboxes))]
+            results, audited = [], {}
+            for i, (image_hash, threshold, letterbox) in enumerate(zip(hashes, thresholds, letterboxes)):
+                stored, audit = cache.get(image_hash, threshold)
+                results.append(None if stored is None else _unletterbox(stored, letterbox))
+                if audit:
+                    audited[i] = results[i]
 
-        img_resized, scale_x, scale_y = preprocess_image(image)
+        missing = [i for i, result in enumerate(results) if result is None or i in audited]
+        if not missing:
+            return results
+        if len(missing) < len(results):
+            batch = batch[torch.tensor(missing, device=batch.device)]
+        with torch.no_grad():
+            prediction = self.forward(batch)
+        fresh = self.postprocess(prediction, [letterboxes[i] for i in missing], [thresholds[i] for i in missing])
+
+        for i, detections in zip(missing, fresh):
+            if i in audited:
+                match = match_detections(detections, audited[i])
+                false_match = not match['matched'] == match['reference'] == match['candidate']
+                cache.record_audit(false_match)
+                if not false_match:
+                    continue
+            cache.put(hashes[i], _letterbox(detections, letterboxes[i]), thresholds[i])
+            results[i] = detections
+        return results
+
+    @timed('preprocess')
+    def preprocess(self, images):
+        """
+        Letterboxes images into the reusable input buffer of the calling thread.
+
+        Parameters
+        ----------
+        images : list of str, PIL.Image or numpy.ndarray
+            the images to detect objects in
 
-        results = self.model(img_resized)
-        detections = results.pandas().xyxy[0]
-        detections = detections[detections['confidence'] > confidence_threshold]
+        Returns
+        -------
+        batch : torch.Tensor
+            the input batch on the model device, sharing memory with the buffer on the CPU
+        letterboxes : list of Letterbox
+        the transforms mapping boxes back to every image
+        """
+        batch = self._input_buffer().batch(len(images))
+        letterboxes = [letterbox_image(load_image(image), out) for image, out in zip(images, batch)]
+        return torch.from_numpy(batch).to(self.device), letterboxes
+
+    @timed('postprocess')
+    def postprocess(self, prediction, letterboxes, thresholds):
+        """
+        Filters the raw predictions with non-maximum suppression and maps the boxes back to the images.
+
+        Parameters
+        ----------
+        prediction : torch.Tensor
+            the raw predictions of shape (batch, boxes, 5 + classes)
+        letterboxes : list of Letterbox
+            the transforms returned by preprocess
+        thresholds : list of float or DetectionQuery
+            the confidence threshold or query of every image, with class ids
+
+        Returns
+        -------
+        results : list of Detections
+        the detections of every image
+        """
+        # minimum areas are given in image pixels, NMS compares them with boxes in input pixels
+        thresholds = [t._replace(min_area=t.min_area * lb.ratio_x * lb.ratio_y)
+                      if isinstance(t, DetectionQuery) and t.min_area else t
+                      for t, lb in zip(thresholds, letterboxes)]
+        batch_xyxy = non_max_suppression(prediction, thresholds)
+
+        batch_detections = []
+        for xyxy, letterbox in zip(batch_xyxy, letterboxes):
+            detections = Detections.from_xyxy(xyxy.cpu().numpy(), self.model.names)
+            detections.boxes = unletterbox_boxes(detections.boxes, letterbox)
+            batch_detections.append(detections)
+
+        return batch_detections
+
+    @timed('forward')
+    def forward(self, batch):
+        """
+        Runs the network on a batch of letterboxed images.
+
+        Parameters
+        ----------
+        batch : torch.Tensor
+            a float tensor of shape (batch, 3, height, width) with values in [0, 1]
+
+        Returns
+        -------
+        prediction : torch.Tensor
+        the raw predictions of shape (batch, boxes, 5 + classes)
+        """
+        if self.channels_last:
+            batch = batch.contiguous(memory_format=torch.channels_last)
+        if self.precision == 'bfloat16':
+            with torch.autocast('cpu', dtype=torch.bfloat16):
+                return self.backend(batch).float()
+        return self.backend(batch)
 
-        detections[['xmin', 'xmax']] *= scale_x
-        detections[['ymin', 'ymax']] *= scale_y
+    def _resolve_query(self, query):
+        if query.classes is None or all(isinstance(c, int) for c in query.classes):
+            return query
+        names = self.model.names
+        ids = {name: i for i, name in (names.items() if isinstance(names, dict) else enumerate(names))}
+        try:
+            classes = tuple(dict.fromkeys(c if isinstance(c, int) else ids[c] for c in query.classes))
+        except KeyError as exc:
+            raise InvalidQuery(f"Unknown class {exc.args[0]!r}") from None
+        return query._replace(classes=classes)
 
-        return detections
+    def _input_buffer(self):
+        buffer = getattr(self._buffers, 'letterbox', None)
+        if buffer is None:
+            buffer = self._buffers.letterbox = LetterboxBuffer(self.input_size)
+        return buffer
 
-    def render(self, image, confidence_threshold=DETECT_THRESHOLD):
+    def render(self, image, confidence_threshold=DETECT_THRESHOLD, output='base64', format='JPEG',
+               quality=RENDER_JPEG_QUALITY, labels=RENDER_LABELS, per_class_colors=RENDER_CLASS_COLORS):
         """
         Renders an image with bounding boxes around detected objects using the YOLOv5 model.
 
         Parameters
         ----------
-        image : PIL.Image
+        image : str, PIL.Image or numpy.ndarray
             the image to detect objects in and draw bounding boxes on images
         confidence_threshold : float, optional
             the confidence threshold for object detection (default from settings.py)
+        output : str, optional
+            'base64' for a base64-encoded string, 'bytes' for the encoded image file or
+            'array' for the RGB pixels (default is 'base64')
+        format : str, optional
+            the file format of the encoded image, 'JPEG' or 'WEBP' (default is 'JPEG')
+        quality : int, optional
+            the encoding quality from 1 to 100 (default from settings.py)
+        labels : bool, optional
+            whether to write the class name and confidence above every box (default from settings.py)
+        per_class_colors : bool, optional
+            whether to colour the boxes by class (default from settings.py)
 
         Returns
         -------
-        encoded_image : str
-        a base64-encoded string of the rendered image
+        rendered : str, bytes or numpy.ndarray
+        the rendered image, in the requested output type
         """
-        detections = self.detect(image, confidence_threshold)
-        bbox_im = draw_boxes_on_image(image, detections)
+        img = load_image(image)
+        detections = self.detect(img, confidence_threshold)
+        if img is image or not img.flags.writeable:
+            img = img.copy()
+        draw_boxes(img, detections, labels=labels, per_class_colors=per_class_colors)
+        if output == 'array':
+            return img
 
-        io_buf = BytesIO()
-        bbox_im.save(io_buf, format='JPEG')
-        encoded_image = base64.b64encode(io_buf.getvalue()).decode("utf-8")
-        return encoded_image
+        encoded = encode_image(img, format, quality, overwrite=True)
+        if output == 'bytes':
+            return encoded
+        return base64.b64encode(encoded).decode("utf-8")
@@ -1,18 +1,51 @@
 import argparse
-from api.app import run_server_api
-from gradio_app import run_server
-from settings import DEFAULT_PORT
+from settings import DEFAULT_PORT, INFERENCE_WORKERS, SERVER_PROCESSES, BATCH_MAX_SIZE, BULK_DECODE_THREADS
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run YOLOv5 API or Gradio Demo')
     parser.add_argument('--api', action='store_true', default=False, help='Run the YOLOv5 Object Detection API')
+    parser.add_argument('--asgi', action='store_true', default=False,
+                        help='Run the YOLOv5 Object Detection API on the asyncio server')
     parser.add_argument('--demo', action='store_true', default=False, help='Run the YOLOv5 Object Detection Gradio Demo')
+    parser.add_argument('--video', type=str, default=None,
+                        help='Detect objects in a video file or stream and print one JSON line per frame')
+    parser.add_argument('--batch', type=str, default=None,
+                        help='Detect objects in every image of a directory, tar or zip archive and write the results')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Output of --batch, a .jsonl file or a .parquet directory (default is next to the input)')
+    parser.add_argument('--batch-size', type=int, default=BATCH_MAX_SIZE, help='Number of images in one forward pass of --batch')
+    parser.add_argument('--threads', type=int, default=BULK_DECODE_THREADS, help='Number of decoding threads of --batch')
     parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port number to run the API or demo on')
+    parser.add_argument('--workers', type=int, default=INFERENCE_WORKERS,
+                        help='Number of model worker processes of the API, 0 runs the model in the server process')
+    parser.add_argument('--processes', type=int, default=SERVER_PROCESSES,
+                        help='Number of API server processes forked after loading the model once')
     args = parser.parse_args()
 
-    if args.api:
-        run_server_api(port=args.port)
+    if args.asgi:
+        from api.asgi_app import run_server_asgi
+        run_server_asgi(port=args.port, workers=args.workers)
+    elif args.api and args.processes > 1:
+        from api.prefork import run_server_prefork
+        run_server_prefork(port=args.port, processes=args.processes)
+    elif args.api:
+        from api.app import run_server_api
+        run_server_api(port=args.port, workers=args.workers)
+    elif args.video:
+        from model.initialize_model import yolo
+        from model.video import detect_video, frame_to_json
+        for frame in detect_video(yolo, int(args.video) if args.video.isdigit() else args.video):
+            print(frame_to_json(frame), flush=True)
+    elif args.batch:
+        from model.initialize_model import yolo
+        from model.bulk import run_bulk
+        output = args.output or args.batch.rstrip('/\\') + '.jsonl'
+        counts = run_bulk(yolo.load(), args.batch, output, 'parquet' if output.endswith('.parquet') else 'jsonl',
+                          batch_size=args.batch_size, threads=args.threads)
+        print(f"Processed {counts['images']} images ({counts['errors']} failed, {counts['skipped']} done earlier) "
+              f"into {output}")
     elif args.demo:
+        from gradio_app import run_server
         run_server(port=args.port)
     else:
         print(parser.print_help())
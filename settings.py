@@ -9,9 +9,37 @@ TEST_IMAGE_PATH = os.path.join(basedir, 'api/tests/data/test.jpeg')
 MODEL_LINK = 'https://github.com/ultralytics/yolov5/releases/download/v5.0/yolov5s.pt'
 #Model name
 MODEL_NAME = 'yolov5s.pt'
+# Directory with the YOLOv5 model definitions, a checkout or the torch.hub cache
+YOLOV5_DIR = os.environ.get('YOLOV5_DIR', os.path.join(
+    os.environ.get('TORCH_HOME', os.path.join(os.path.expanduser('~'), '.cache', 'torch')),
+    'hub', 'ultralytics_yolov5_master'))
+# Fetch the model definitions with torch.hub when YOLOV5_DIR does not exist
+MODEL_HUB_FALLBACK = True
+# Load the model and run a warm-up inference before the servers start
+MODEL_WARMUP = True
+# Inference backend: 'torch', 'torchscript', 'int8' (quantized torch), 'onnx' or 'onnx-int8' (ONNX Runtime),
+# exports are made from MODEL_NAME on first use and stored next to it; 'int8' and the ONNX backends run on the CPU
+MODEL_BACKEND = os.environ.get('MODEL_BACKEND', 'torch')
+# Images the static INT8 quantization is calibrated on, None uses the test image
+QUANT_CALIBRATION_IMAGES = None
+# ONNX opset of the ONNX Runtime export
+ONNX_OPSET = 17
+# Number of threads of an ONNX Runtime inference, 0 lets ONNX Runtime decide
+BACKEND_THREADS = 0
+# Benchmark torch thread counts, channels-last and bf16 on the CPU at warm-up and apply the fastest configuration;
+# model worker and forked server processes warm up at once, so tune with a single process before starting several
+AUTOTUNE = os.environ.get('AUTOTUNE', '0') == '1'
+# File the tuned configurations are stored in, per CPU model, core budget and model, for reuse on the next start
+AUTOTUNE_PROFILE = os.environ.get('AUTOTUNE_PROFILE', os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+    'object-detection-api', 'autotune_profile.json'))
+# Number of timed forward passes per configuration measured by the autotuner
+AUTOTUNE_RUNS = 3
 
 # Detect endpoint
 DETECT_ENDPOINT = '/detect'
+# Batch detect endpoint
+DETECT_BATCH_ENDPOINT = '/detect/batch'
 # Render endpoint
 RENDER_ENDPOINT = '/render'
 # Default host address
@@ -21,3 +49,133 @@ DEFAULT_PORT = 5000
 
 #Filter for prediction confidence
 DETECT_THRESHOLD = 0.25
+
+# Maximum number of images in one batched forward pass
+BATCH_MAX_SIZE = 8
+# Maximum time in milliseconds a request waits for its batch to fill up
+BATCH_MAX_WAIT_MS = 10
+# Batching metrics endpoint
+STATS_ENDPOINT = '/stats'
+# Prometheus metrics endpoint
+METRICS_ENDPOINT = '/metrics'
+# Record per-stage latency histograms, request counts and payload sizes
+METRICS_ENABLED = True
+# Add a Server-Timing header with the stage latencies to every response, otherwise only to
+# requests sending the 'X-Timing: 1' header
+TIMING_HEADERS = False
+# Sampling profiler endpoint, POST ?enabled=1 starts and ?enabled=0 stops it, GET returns the collapsed stacks
+PROFILE_ENDPOINT = '/profile'
+# Time in milliseconds between two samples of the sampling profiler
+PROFILER_INTERVAL_MS = 10
+
+# Priority lanes of the inference queue, lower values are served first: one per endpoint, and optionally
+# one per tenant, requests of tenants without a lane use the lane of their endpoint
+PRIORITY_LANES = {'detect': 0, 'render': 1, 'batch': 2}
+# Priority lane of the requests of every endpoint
+ENDPOINT_LANES = {DETECT_ENDPOINT: 'detect', RENDER_ENDPOINT: 'render', DETECT_BATCH_ENDPOINT: 'batch'}
+# Header naming the tenant of a request
+TENANT_HEADER = 'X-Tenant'
+# Maximum number of images waiting in one priority lane, further requests are rejected with 429, 0 for no limit
+LANE_MAX_QUEUE = 64
+# Header with the time budget of a request in milliseconds; requests the model cannot serve within it
+# are rejected with 503 and queued images whose budget ran out are dropped before inference
+DEADLINE_HEADER = 'X-Deadline-Ms'
+# Time budget in milliseconds of requests without the deadline header, 0 for none
+DEFAULT_DEADLINE_MS = 0
+# Weight of the last batch in the moving average of the batch service time used to estimate queue waits
+SERVICE_TIME_SMOOTHING = 0.2
+
+# Width and height of the letterboxed model input
+INPUT_SIZE = 640
+# Maximum size in bytes of an uploaded image, larger uploads are rejected with 413
+MAX_UPLOAD_BYTES = 32 * 1024 * 1024
+# Maximum number of pixels of an uploaded image, checked before the pixels are decoded
+MAX_IMAGE_PIXELS = 50_000_000
+# Decode large JPEG files for detection at a reduced resolution close to INPUT_SIZE
+REDUCED_DECODE = True
+# IoU threshold of the non-maximum suppression
+NMS_IOU_THRESHOLD = 0.45
+# Maximum number of detections per image
+MAX_DETECTIONS = 1000
+
+# Number of model worker processes of the API server, 0 runs the model in the server process
+INFERENCE_WORKERS = 0
+# Number of API server processes forked after loading the model once, sharing its weights
+SERVER_PROCESSES = 1
+
+# Maximum number of requests the asyncio server handles at once, the rest is rejected with 503
+ASGI_MAX_CONCURRENCY = 64
+# Number of threads the asyncio server runs image decoding and encoding on
+ASGI_EXECUTOR_THREADS = 4
+
+# Cache detection and render results of identical requests
+CACHE_ENABLED = True
+# Maximum memory used by the in-memory result cache, in bytes
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Time in seconds a cached result stays valid, 0 keeps results until they are evicted
+CACHE_TTL_SECONDS = 3600
+# Directory of the on-disk result cache that survives restarts, None disables it
+CACHE_DIR = os.environ.get('CACHE_DIR')
+# Reuse the detections of near-duplicate images, such as re-encoded or resized copies, found by a
+# perceptual hash of the letterboxed model input
+SIMILARITY_CACHE_ENABLED = os.environ.get('SIMILARITY_CACHE') == '1'
+# Maximum number of images in the near-duplicate index
+SIMILARITY_CACHE_SIZE = 4096
+# Maximum number of differing bits of the 64-bit perceptual hashes of near-duplicate images
+SIMILARITY_MAX_DISTANCE = 4
+# Fraction of near-duplicate hits still run through the model to audit the reused detections
+SIMILARITY_AUDIT_RATE = 0.01
+
+# Default encoding quality of rendered JPEG images
+RENDER_JPEG_QUALITY = 75
+# Default encoding quality of rendered WebP images
+RENDER_WEBP_QUALITY = 80
+# Write the class name and confidence above rendered boxes by default, requests opt in with 'labels=1'
+RENDER_LABELS = False
+# Colour rendered boxes by class by default instead of in green, requests opt in with 'colors=1'
+RENDER_CLASS_COLORS = False
+
+# Maximum number of images of a batch request decoded and waiting for the model at once
+BATCH_STREAM_WINDOW = 16
+
+# Mean absolute difference of consecutive video frames, as a fraction of the intensity range,
+# below which the detections of the last inferred frame are reused
+VIDEO_CHANGE_THRESHOLD = 0.02
+# Maximum number of consecutive video frames reusing detections
+VIDEO_MAX_SKIP = 25
+# Move reused boxes by the global motion between video frames
+VIDEO_TRACK_BOXES = True
+# Maximum number of decoded video frames waiting for inference
+VIDEO_QUEUE_SIZE = 32
+# Maximum time in milliseconds a video frame waits for its inference batch to fill up, so streams
+# slower than a batch of changed frames still get their detections in time
+VIDEO_MAX_WAIT_MS = 100
+
+# Width and height in pixels of the tiles of tiled detection
+TILE_SIZE = 640
+# Fraction of a tile shared with its neighbours
+TILE_OVERLAP = 0.2
+# Number of tile batches run concurrently
+TILE_WORKERS = 1
+
+# Maximum number of cameras whose regions of interest, sent with the 'camera' query parameter, are kept
+ROI_CACHE_SIZE = 1024
+# Regions of interest of fixed cameras by camera id, as lists of 'xmin', 'ymin', 'xmax', 'ymax' rectangles
+# and lists of (x, y) polygon vertices; available in every server process, unlike the regions sent by requests
+CAMERA_REGIONS = {}
+
+# Number of threads decoding the images of offline batch runs
+BULK_DECODE_THREADS = 4
+# Maximum number of images of offline batch runs read or decoded ahead of the model
+BULK_PREFETCH = 64
+# Number of images between two progress checkpoints of offline batch runs
+BULK_CHECKPOINT_EVERY = 1000
+# File extensions of the images read from directories and archives by offline batch runs
+BULK_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp', '.tif', '.tiff')
+
+# Lowest confidence threshold of the demo slider; the demo detects once at it and filters for higher thresholds
+DEMO_MIN_CONFIDENCE = 0.1
+# Maximum number of uploaded images whose detections the demo keeps per session
+DEMO_CACHE_SIZE = 4
+# Maximum number of demo events processed at once
+DEMO_CONCURRENCY = 4
@@ -0,0 +1,59 @@
+import struct
+
+# Every image of a length-prefixed stream is preceded by its size as a big-endian unsigned 32-bit integer
+LENGTH_PREFIX = struct.Struct('>I')
+
+
+def encode_length_prefixed(images):
+    """
+    This function packs image files into a length-prefixed stream.
+
+    Parameters:
+    images: iterable of bytes. The raw image files.
+
+    Returns:
+    data: bytes. The length-prefixed stream.
+    """
+    return b''.join(LENGTH_PREFIX.pack(len(image)) + image for image in images)
+
+
+def _read_exactly(stream, size):
+    chunks = []
+    while size:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks), size == 0
+
+
+def iter_length_prefixed(stream, max_size=0):
+    """
+    This function reads image files from a length-prefixed stream one at a time,
+    without reading the whole stream into memory.
+
+    Parameters:
+    stream: file-like object. The stream to read from.
+    max_size: int. The maximum size in bytes of an image, 0 disables the limit. Default is 0.
+
+    Returns:
+    images: generator of bytes. The raw image files.
+
+    Raises:
+    ValueError: if the stream ends in the middle of an image or an image is over max_size,
+    checked before the image is read.
+    """
+    while True:
+        header, complete = _read_exactly(stream, LENGTH_PREFIX.size)
+        if not header:
+            return
+        if not complete:
+            raise ValueError("Truncated length prefix")
+        size = LENGTH_PREFIX.unpack(header)[0]
+        if max_size and size > max_size:
+            raise ValueError(f"Image of {size} bytes is over the limit of {max_size} bytes")
+        image, complete = _read_exactly(stream, size)
+        if not complete:
+            raise ValueError("Truncated image")
+        yield image
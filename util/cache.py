@@ -0,0 +1,351 @@
+import hashlib
+import itertools
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+def _sizeof(value):
+    """
+    Estimates the memory used by a cached value: the array buffers of detections,
+    the length of encoded responses.
+    """
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    arrays = [v for v in vars(value).values() if isinstance(v, np.ndarray)] if hasattr(value, '__dict__') else []
+    return sum(array.nbytes for array in arrays) + 256
+
+
+class DetectionCache:
+    """
+    A content-addressed cache of detection results with a memory-bounded LRU tier and
+    an optional on-disk tier that survives restarts.
+
+    Parameters
+    ----------
+    max_bytes : int
+        the maximum memory used by the values of the in-memory tier
+    ttl : float, optional
+        the time in seconds an entry stays valid, 0 keeps entries until they are evicted (default is 0)
+    disk_dir : str, optional
+        the directory of the on-disk tier, None disables it (default is None)
+    """
+    def __init__(self, max_bytes, ttl=0, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits_memory = 0
+        self._hits_disk = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @staticmethod
+    def key(kind, data, *params):
+        """
+        Builds the cache key of a request from a hash of its raw bytes and its parameters.
+
+        Parameters
+        ----------
+        kind : str
+            the kind of result, for example 'detect' or 'render'
+        data : bytes
+            the raw request body
+        *params
+            the parameters that change the result, such as the confidence threshold
+
+        Returns
+        -------
+        key : str
+        """
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        suffix = hashlib.blake2b(repr((kind,) + params).encode(), digest_size=8).hexdigest()
+        return f"{digest}-{suffix}"
+
+    def get(self, key):
+        """
+        Looks a key up in the in-memory tier, then in the on-disk tier.
+
+        Parameters
+        ----------
+        key : str
+            the cache key
+
+        Returns
+        -------
+        value : object or None
+        the cached value, None on a miss
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, size, created = entry
+                if not self.ttl or now - created < self.ttl:
+                    self._entries.move_to_end(key)
+                    self._hits_memory += 1
+                    return value
+                self._remove(key)
+
+        value = self._read_disk(key)
+        with self._lock:
+            if value is None:
+                self._misses += 1
+                return None
+            self._hits_disk += 1
+            self._insert(key, value, now)
+        return value
+
+    def put(self, key, value):
+        """
+        Stores a value in the in-memory tier and, when enabled, in the on-disk tier.
+
+        Parameters
+        ----------
+        key : str
+            the cache key
+        value : object
+            the detections or encoded response to cache
+        """
+        with self._lock:
+            self._insert(key, value, time.monotonic())
+        self._write_disk(key, value)
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached value of a key, computing and storing it on a miss.
+
+        Parameters
+        ----------
+        key : str
+            the cache key
+        compute : callable
+            a function without arguments computing the value
+
+        Returns
+        -------
+        value : object
+        """
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def metrics(self):
+        """
+        Returns the hit and miss counters and the size of the cache.
+
+        Returns
+        -------
+        metrics : dict
+        """
+        with self._lock:
+            lookups = self._hits_memory + self._hits_disk + self._misses
+            return {
+                "hits_memory": self._hits_memory,
+                "hits_disk": self._hits_disk,
+                "misses": self._misses,
+                "hit_rate": (self._hits_memory + self._hits_disk) / lookups if lookups else 0.0,
+                "evictions": self._evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _insert(self, key, value, created):
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, size, created)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self._evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + '.pkl')
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            if self.ttl and time.time() - os.path.getmtime(path) >= self.ttl:
+                os.remove(path)
+                return None
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def _write_disk(self, key, value):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+
+# Number of set bits of every byte value, to count the differing bits of hashes
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class SimilarityCache:
+    """
+    A bounded index of 64-bit perceptual image hashes for reusing the results of near-duplicate images,
+    such as re-encoded or resized copies of the same photo. Lookups scan the hashes of all entries
+    for the nearest one by Hamming distance, the least recently used entry is evicted when the
+    index is full. A fraction of the hits is flagged for an audit, so the caller can recompute
+    them and report whether the reused result was a false match.
+
+    Parameters
+    ----------
+    capacity : int
+        the maximum number of entries
+    max_distance : int
+        the maximum number of differing bits of the hashes of near-duplicate images
+    audit_rate : float, optional
+        the fraction of hits flagged for an audit, 0 disables audits (default is 0)
+    """
+    def __init__(self, capacity, max_distance, audit_rate=0.0):
+        self.capacity = capacity
+        self.max_distance = max_distance
+        self.audit_every = round(1 / audit_rate) if audit_rate else 0
+
+        self._hashes = np.zeros(capacity, dtype='>u8')
+        self._params = np.full(capacity, -1, dtype=np.int64)
+        self._used = np.zeros(capacity, dtype=np.int64)
+        self._values = [None] * capacity
+        self._param_ids = {}
+        self._next_param_id = itertools.count()
+        self._clock = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._audits = 0
+        self._false_matches = 0
+
+    def get(self, image_hash, params=None):
+        """
+        Looks up the entry of the nearest hash within max_distance stored with the same parameters.
+
+        Parameters
+        ----------
+        image_hash : int
+            the 64-bit perceptual hash of the image
+        params : hashable, optional
+            the parameters that change the result, such as the confidence threshold
+
+        Returns
+        -------
+        value : object or None
+            the stored value, None on a miss
+        audit : bool
+            whether the caller should recompute the value and call record_audit
+        """
+        with self._lock:
+            param_id = self._param_ids.get(params)
+            slot = None if param_id is None else self._nearest(image_hash, param_id)
+            if slot is not None:
+                self._hits += 1
+                self._clock += 1
+                self._used[slot] = self._clock
+                audit = bool(self.audit_every) and self._hits % self.audit_every == 0
+                return self._values[slot], audit
+            self._misses += 1
+            return None, False
+
+    def put(self, image_hash, value, params=None):
+        """
+        Stores the value of an image. It replaces the entry of a near-duplicate image, such as
+        a false match found by an audit, or else the least recently used entry when the index is full.
+
+        Parameters
+        ----------
+        image_hash : int
+            the perceptual hash of the image
+        value : object
+            the result to reuse for near-duplicates of the image
+        params : hashable, optional
+            the parameters that change the result
+        """
+        with self._lock:
+            if params not in self._param_ids and len(self._param_ids) >= self.capacity:
+                # forget the parameters no entry is stored with any more
+                live = set(self._params.tolist())
+                self._param_ids = {p: i for p, i in self._param_ids.items() if i in live}
+            param_id = self._param_ids.get(params)
+            if param_id is None:
+                param_id = self._param_ids[params] = next(self._next_param_id)
+            slot = self._nearest(image_hash, param_id)
+            if slot is None:
+                slot = int(self._used.argmin())
+                if self._params[slot] != -1:
+                    self._evictions += 1
+            self._clock += 1
+            self._hashes[slot] = image_hash
+            self._params[slot] = param_id
+            self._used[slot] = self._clock
+            self._values[slot] = value
+
+    def _nearest(self, image_hash, param_id):
+        differing = self._hashes ^ np.array(image_hash, dtype='>u8')
+        distances = _POPCOUNT[differing.view(np.uint8)].reshape(self.capacity, 8).sum(1)
+        distances[self._params != param_id] = 255
+        slot = int(distances.argmin())
+        return slot if distances[slot] <= self.max_distance else None
+
+    def record_audit(self, false_match):
+        """
+        Records the outcome of an audited hit.
+
+        Parameters
+        ----------
+        false_match : bool
+            whether the recomputed result differs from the reused one
+        """
+        with self._lock:
+            self._audits += 1
+            self._false_matches += bool(false_match)
+
+    def metrics(self):
+        """
+        Returns the hit, miss and audit counters and the size of the index.
+
+        Returns
+        -------
+        metrics : dict
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "evictions": self._evictions,
+                "entries": int((self._params != -1).sum()),
+                "capacity": self.capacity,
+                "audits": self._audits,
+                "false_matches": self._false_matches,
+                "false_match_rate": self._false_matches / self._audits if self._audits else 0.0,
+            }
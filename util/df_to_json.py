@@ -1,25 +1,164 @@
+import json
+import struct
+import numpy as np
+from model.detections import Detections
+from util.metrics import timed
+
+OBJECT_TEMPLATE = '{"class": %d, "confidence": %r, "xmin": %d, "ymin": %d, "xmax": %d, "ymax": %d}'
+# Keys of the detection fields, shared by the per-object and the columnar formats
+FIELDS = ("class", "confidence", "xmin", "ymin", "xmax", "ymax")
+COLUMNS_TEMPLATE = '{' + ', '.join('"%s": %%s' % field for field in FIELDS) + '}'
+# MessagePack type bytes of the encoded values: uint 16, float 32
+MSGPACK_UINT16 = 0xcd
+MSGPACK_FLOAT32 = 0xca
+
+
+def _finite(values):
+    """
+    Replaces NaN and infinite values, which JSON cannot represent, with 0.
+    """
+    if np.isfinite(values).all():
+        return values
+    return np.nan_to_num(values, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def _detection_table(detections):
+    """
+    Builds an Nx6 object array of 'class', 'confidence', 'xmin', 'ymin', 'xmax', 'ymax' values
+    holding native Python numbers, converting every column in a single call.
+    """
+    table = np.empty((len(detections), 6), dtype=object)
+    if not len(detections):
+        return table
+    table[:, 0] = detections.class_ids.tolist()
+    table[:, 1] = _finite(detections.confidence).astype(np.float64).tolist()
+    table[:, 2:] = _finite(detections.boxes).astype(np.int64).tolist()
+    return table
+
+
+@timed('format')
 def format_detections(detections):
     """
-    This function takes a Pandas DataFrame containing object detection results and formats it
+    This function takes object detection results and formats them
     into a dictionary with a list of object detections.
 
     Parameters:
-    detections: Pandas DataFrame. The object detection results in a DataFrame format, containing columns for class,
+    detections: Detections. The object detection results, containing arrays for class,
     confidence, xmin, ymin, xmax, and ymax coordinates of the detected objects.
 
     Returns:
     formatted_detections: dict. A dictionary with a list of object detections.
     Each object detection is a dictionary containing keys for class, confidence, xmin, ymin, xmax, and ymax.
     """
-    formatted_detections = {"objects": []}
-    for _, row in detections.iterrows():
-        obj = {
-            "class": row["class"],
-            "confidence": row["confidence"],
-            "xmin": int(row["xmin"]),
-            "ymin": int(row["ymin"]),
-            "xmax": int(row["xmax"]),
-            "ymax": int(row["ymax"]),
-        }
-        formatted_detections["objects"].append(obj)
-    return formatted_detections
+    return {"objects": [dict(zip(FIELDS, row)) for row in _detection_table(detections).tolist()]}
+
+
+@timed('format')
+def detections_to_json(detections):
+    """
+    This function takes object detection results and serializes them straight into the JSON text
+    of the formatted detections, without building a dictionary per detected object.
+
+    Parameters:
+    detections: Detections. The object detection results.
+
+    Returns:
+    json_text: str. The JSON document {"objects": [...]} with the same keys as format_detections.
+    """
+    n = len(detections)
+    if not n:
+        return '{"objects": []}'
+    objects = ", ".join([OBJECT_TEMPLATE] * n) % tuple(_detection_table(detections).ravel())
+    return '{"objects": [' + objects + ']}'
+
+
+@timed('format')
+def detections_to_columns_json(detections):
+    """
+    This function serializes object detection results into columnar JSON: one array per field
+    instead of one object per detection, so the keys are written once.
+
+    Parameters:
+    detections: Detections. The object detection results.
+
+    Returns:
+    json_text: str. The JSON document {"class": [...], "confidence": [...], "xmin": [...], ...}
+    with the same values as detections_to_json.
+    """
+    boxes = _finite(detections.boxes).astype(np.int64).T
+    columns = [detections.class_ids, _finite(detections.confidence).astype(np.float64), *boxes]
+    return COLUMNS_TEMPLATE % tuple(json.dumps(column.tolist()) for column in columns)
+
+
+def _msgpack_str(text):
+    return bytes([0xa0 | len(text)]) + text.encode()
+
+
+def _msgpack_array(values, type_byte, dtype):
+    n = len(values)
+    if n < 16:
+        header = bytes([0x90 | n])
+    elif n < 1 << 16:
+        header = struct.pack('>BH', 0xdc, n)
+    else:
+        header = struct.pack('>BI', 0xdd, n)
+    # every element is its type byte followed by the big-endian value, packed in one array
+    packed = np.empty(n, dtype=[('type', 'u1'), ('value', dtype)])
+    packed['type'] = type_byte
+    packed['value'] = values
+    return header + packed.tobytes()
+
+
+@timed('format')
+def detections_to_msgpack(detections):
+    """
+    This function serializes object detection results into MessagePack, packing every field
+    straight from the detection arrays.
+
+    Parameters:
+    detections: Detections. The object detection results.
+
+    Returns:
+    payload: bytes. A MessagePack map with the keys of detections_to_json, each holding an array:
+    uint16 class ids, float32 confidences and float32 box coordinates.
+    """
+    columns = [(detections.class_ids, MSGPACK_UINT16, '>u2'), (detections.confidence, MSGPACK_FLOAT32, '>f4')]
+    columns += [(column, MSGPACK_FLOAT32, '>f4') for column in detections.boxes.T]
+    return bytes([0x80 | len(FIELDS)]) + b''.join(
+        _msgpack_str(field) + _msgpack_array(*column) for field, column in zip(FIELDS, columns))
+
+
+@timed('format')
+def detections_to_packed(detections):
+    """
+    This function serializes object detection results into a fixed little-endian binary layout:
+    the uint32 number of detections N, then N rows of float32 xmin, ymin, xmax, ymax, N float32
+    confidences and N uint16 class ids. Every array starts aligned to its item size.
+
+    Parameters:
+    detections: Detections. The object detection results.
+
+    Returns:
+    payload: bytes. The packed detections, 4 + 22 * N bytes long.
+    """
+    return b''.join([struct.pack('<I', len(detections)), detections.boxes.astype('<f4').tobytes(),
+                     detections.confidence.astype('<f4').tobytes(), detections.class_ids.astype('<u2').tobytes()])
+
+
+def packed_to_detections(payload, names=None):
+    """
+    This function reads detections from the binary layout of detections_to_packed, viewing the payload
+    as NumPy arrays instead of parsing it.
+
+    Parameters:
+    payload: bytes. The packed detections.
+    names: list or dict, optional. The class names.
+
+    Returns:
+    detections: Detections. The detections, with float32 boxes and confidences.
+    """
+    n, = struct.unpack_from('<I', payload)
+    boxes = np.frombuffer(payload, '<f4', 4 * n, 4).reshape(n, 4)
+    confidence = np.frombuffer(payload, '<f4', n, 4 + 16 * n)
+    class_ids = np.frombuffer(payload, '<u2', n, 4 + 20 * n)
+    return Detections(boxes, confidence, class_ids, names)
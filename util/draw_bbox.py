@@ -1,24 +1,92 @@
 import cv2
 from PIL import Image
 import numpy as np
+from util.metrics import timed
 
+# Box colours in RGB, picked by class id when boxes are drawn with per-class colours
+PALETTE = np.array([
+    (255, 56, 56), (255, 157, 151), (255, 112, 31), (255, 178, 29), (207, 210, 49),
+    (72, 249, 10), (146, 204, 23), (61, 219, 134), (26, 147, 52), (0, 212, 187),
+    (44, 153, 168), (0, 194, 255), (52, 69, 147), (100, 115, 255), (0, 24, 236),
+    (132, 56, 255), (82, 0, 133), (203, 56, 255), (255, 149, 200), (255, 55, 199),
+], dtype=np.uint8)
+DEFAULT_COLOR = (0, 255, 0)
 
-def draw_boxes_on_image(image, detections_df):
+
+def class_colors(class_ids):
+    """
+    This function maps class ids to their box colours.
+
+    Parameters:
+    class_ids: numpy.ndarray. The class ids.
+
+    Returns:
+    colors: numpy.ndarray. An Nx3 uint8 array of RGB colours.
+    """
+    return PALETTE[np.asarray(class_ids) % len(PALETTE)]
+
+
+@timed('draw')
+def draw_boxes(img, detections, labels=False, per_class_colors=False, thickness=2):
+    """
+    This function draws bounding boxes on an RGB pixel array in place. The outlines of all boxes
+    sharing a colour are drawn with a single call, so the boxes are drawn in one pass over the classes.
+
+    Parameters:
+    img: numpy.ndarray. The RGB pixels of the image, modified in place.
+    detections: Detections. The object detection results.
+    labels: bool. Whether to write the class name and confidence above every box. Default is False.
+    per_class_colors: bool. Whether to colour the boxes by class instead of in green. Default is False.
+    thickness: int. The line thickness in pixels. Default is 2.
+
+    Returns:
+    img: numpy.ndarray. The same array, with the bounding boxes drawn on it.
+    """
+    if not len(detections):
+        return img
+    boxes = np.rint(detections.boxes).astype(np.int32)
+    corners = boxes[:, [[0, 1], [2, 1], [2, 3], [0, 3]]]
+
+    if per_class_colors:
+        classes, inverse = np.unique(detections.class_ids, return_inverse=True)
+        colors = class_colors(classes)
+        for index, color in enumerate(colors.tolist()):
+            cv2.polylines(img, corners[inverse == index], True, color, thickness)
+        box_colors = colors[inverse]
+    else:
+        cv2.polylines(img, corners, True, DEFAULT_COLOR, thickness)
+        box_colors = np.tile(np.array(DEFAULT_COLOR, dtype=np.uint8), (len(boxes), 1))
+
+    if labels:
+        _draw_labels(img, boxes, detections, box_colors, thickness)
+    return img
+
+
+def _draw_labels(img, boxes, detections, box_colors, thickness):
+    font, scale, font_thickness = cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1
+    texts = [f"{name} {confidence:.2f}"
+             for name, confidence in zip(detections.class_names.tolist(), detections.confidence.tolist())]
+    for text, (x1, y1, _, _), color in zip(texts, boxes.tolist(), box_colors.tolist()):
+        (w, h), baseline = cv2.getTextSize(text, font, scale, font_thickness)
+        top = y1 - h - baseline - thickness if y1 - h - baseline - thickness >= 0 else y1 + thickness
+        cv2.rectangle(img, (x1, top), (x1 + w, top + h + baseline), color, -1)
+        text_color = (0, 0, 0) if sum(color) > 384 else (255, 255, 255)
+        cv2.putText(img, text, (x1, top + h), font, scale, text_color, font_thickness, cv2.LINE_AA)
+
+
+def draw_boxes_on_image(image, detections):
     """
-    This function takes a PIL Image object and a Pandas DataFrame containing object detection results,
+    This function takes a PIL Image object and object detection results,
     and draws bounding boxes on the image based on the detection results.
 
     Parameters:
     image: PIL Image object. The input image.
-    detections_df: Pandas DataFrame. The object detection results in a DataFrame format,
-    containing columns for xmin, ymin, xmax, and ymax coordinates of the detected objects.
+    detections: Detections. The object detection results, containing an Nx4 array
+    of xmin, ymin, xmax, and ymax coordinates of the detected objects.
 
     Returns:
     pil_image: PIL Image object. The input image with bounding boxes drawn on it.
     """
-    img = np.array(image)
-    for _, row in detections_df.iterrows():
-        x1, y1, x2, y2 = row[['xmin', 'ymin', 'xmax', 'ymax']].astype(int)
-        img = cv2.rectangle(img, (x1, y1), (x2, y2), (0, 255, 0), 2)
+    img = draw_boxes(np.array(image), detections)
     pil_image = Image.fromarray(img)
     return pil_image
@@ -1,39 +1,297 @@
 import io
 import base64
-from PIL import Image
+from collections import namedtuple
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+from util.metrics import timed
+from settings import INPUT_SIZE, MAX_IMAGE_PIXELS
 
+# OpenCV file extensions and quality flags of the formats encoded straight from pixel arrays
+CV2_ENCODERS = {
+    'JPEG': ('.jpg', cv2.IMWRITE_JPEG_QUALITY),
+    'WEBP': ('.webp', cv2.IMWRITE_WEBP_QUALITY),
+}
 
-def preprocess_image(image, size=(640, 640)):
+# OpenCV flags decoding JPEG files at 1/8, 1/4 and 1/2 of their size in the DCT domain
+CV2_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+# EXIF orientations that swap the width and height of the image
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+EXIF_ORIENTATION = 0x0112
+
+Letterbox = namedtuple('Letterbox', ['ratio_x', 'ratio_y', 'pad_x', 'pad_y', 'width', 'height'])
+Letterbox.__doc__ = """
+The parameters of a letterbox transform: the per-axis resize ratios, the left and top padding
+in pixels, and the width and height of the original image.
+"""
+
+
+def load_image(image):
     """
-    This function takes an image file path or a PIL Image object and preprocesses it by resizing
-    it to a specified size, converting it to RGB mode, and calculating the scaling factors.
-    It returns the resized image, along with the scaling factors.
+    This function takes an image file path, a PIL Image object or a NumPy array and returns
+    its pixels as an RGB uint8 array of shape HxWx3.
 
     Parameters:
-    image: str or PIL Image object. The path to the image file or a PIL Image object.
-    size: tuple. The target size of the image. Default is (640, 640).
+    image: str, PIL Image object or numpy.ndarray. The path to the image file, a PIL Image object
+    or an RGB pixel array.
 
     Returns:
-    img_resized: PIL Image object. The resized image in RGB mode.
-    scale_x: float. The scaling factor along the x-axis.
-    scale_y: float. The scaling factor along the y-axis.
+    img: numpy.ndarray. The RGB pixels of the image.
     """
     if isinstance(image, str):
         with open(image, 'rb') as f:
             img_data = f.read()
-        img = Image.open(io.BytesIO(img_data)).convert('RGB')
-    elif isinstance(image, Image.Image):
-        img = image.convert('RGB')
-    else:
-        raise TypeError("image must be a file path, or PIL image")
+        image = ImageOps.exif_transpose(Image.open(io.BytesIO(img_data)))
+    if isinstance(image, Image.Image):
+        return np.array(image if image.mode == 'RGB' else image.convert('RGB'))
+    if isinstance(image, np.ndarray) and image.ndim == 3 and image.shape[2] == 3 and image.dtype == np.uint8:
+        return image
+    raise TypeError("image must be a file path, PIL image or RGB uint8 array")
+
+
+class ImageTooLarge(ValueError):
+    """
+    Raised for images over the pixel limit, before their pixels are decoded.
+    """
+
+
+def read_image_header(data, max_pixels=MAX_IMAGE_PIXELS):
+    """
+    This function reads the size of an image file from its header, without decoding the pixels,
+    and rejects images over the pixel limit, such as decompression bombs.
+
+    Parameters:
+    data: bytes. The raw image file.
+    max_pixels: int. The maximum number of pixels, 0 disables the limit. Default from settings.py.
+
+    Returns:
+    width: int. The width of the image, after applying its EXIF orientation.
+    height: int. The height of the image, after applying its EXIF orientation.
+    is_jpeg: bool. Whether the image is a JPEG file.
+
+    Raises:
+    ImageTooLarge: if the image has more pixels than max_pixels.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+            is_jpeg = image.format == 'JPEG'
+            orientation = image.getexif().get(EXIF_ORIENTATION, 1) if is_jpeg else 1
+    except Image.DecompressionBombError as exc:
+        raise ImageTooLarge(str(exc)) from exc
+    if max_pixels and width * height > max_pixels:
+        raise ImageTooLarge(f"Image has {width * height} pixels, the limit is {max_pixels}")
+    if orientation in TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+    return width, height, is_jpeg
+
+
+@timed('decode')
+def decode_image(data, max_pixels=MAX_IMAGE_PIXELS):
+    """
+    This function decodes an image file into an RGB uint8 array, decoding the pixels only once.
+    EXIF orientation is applied.
+
+    Parameters:
+    data: bytes. The raw image file.
+    max_pixels: int. The maximum number of pixels, 0 disables the limit. Default from settings.py.
 
-    w, h = img.size
-    img_resized = img.resize(size, resample=Image.BILINEAR)
+    Returns:
+    img: numpy.ndarray. The RGB pixels of the image, of shape HxWx3.
+
+    Raises:
+    ImageTooLarge: if the image has more pixels than max_pixels.
+    """
+    if max_pixels:
+        read_image_header(data, max_pixels)
+    return _decode(data, cv2.IMREAD_COLOR)
+
+
+@timed('decode')
+def decode_image_scaled(data, target_size=INPUT_SIZE, max_pixels=MAX_IMAGE_PIXELS):
+    """
+    This function decodes an image file for detection at a resolution close to the model input.
+    JPEG files are downscaled by 2, 4 or 8 while they are decoded, in the DCT domain, as long as
+    their longer side stays at least target_size pixels, so large photos are never held in memory
+    at full resolution. EXIF orientation is applied.
 
-    scale_x = w / size[0]
-    scale_y = h / size[1]
+    Parameters:
+    data: bytes. The raw image file.
+    target_size: int. The size of the model input. Default from settings.py.
+    max_pixels: int. The maximum number of pixels, 0 disables the limit. Default from settings.py.
+
+    Returns:
+    img: numpy.ndarray. The RGB pixels of the image, of shape HxWx3.
+    scale: tuple. The x and y factors mapping coordinates in img back to the full-size image.
+
+    Raises:
+    ImageTooLarge: if the image has more pixels than max_pixels.
+    """
+    width, height, is_jpeg = read_image_header(data, max_pixels)
+    flag = cv2.IMREAD_COLOR
+    if is_jpeg:
+        flag = next((flag for factor, flag in CV2_REDUCED_FLAGS if max(width, height) >= target_size * factor),
+                    cv2.IMREAD_COLOR)
+    img = _decode(data, flag)
+    return img, (width / img.shape[1], height / img.shape[0])
+
+
+def _decode(data, flag):
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+    if img is None:
+        # formats OpenCV cannot decode, such as GIF
+        return load_image(ImageOps.exif_transpose(Image.open(io.BytesIO(data))))
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=img)
+
+
+def letterbox_image(img, out, pad_value=114):
+    """
+    This function resizes an RGB image preserving its aspect ratio, pads it to the size of the
+    output buffer and writes it, normalized to [0, 1], straight into a CHW float32 buffer.
+
+    Parameters:
+    img: numpy.ndarray. The RGB pixels of the image, of shape HxWx3.
+    out: numpy.ndarray. The float32 buffer of shape 3xHxW the image is written into.
+    pad_value: int. The pixel value of the padding. Default is 114.
+
+    Returns:
+    letterbox: Letterbox. The parameters of the transform, used to map boxes back to the image.
+    """
+    _, out_h, out_w = out.shape
+    h, w = img.shape[:2]
+    ratio = min(out_w / w, out_h / h)
+    new_w = min(out_w, max(1, int(round(w * ratio))))
+    new_h = min(out_h, max(1, int(round(h * ratio))))
+    pad_x = (out_w - new_w) // 2
+    pad_y = (out_h - new_h) // 2
 
-    return img_resized, scale_x, scale_y
+    if (new_w, new_h) != (w, h):
+        img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+
+    out.fill(pad_value / 255.0)
+    np.multiply(img.transpose(2, 0, 1), np.float32(1 / 255.0),
+                out=out[:, pad_y:pad_y + new_h, pad_x:pad_x + new_w])
+    return Letterbox(new_w / w, new_h / h, pad_x, pad_y, w, h)
+
+
+def perceptual_hash(img, hash_size=8):
+    """
+    This function computes a perceptual hash of a letterboxed image: the signs of the lowest
+    frequencies of the discrete cosine transform of its grayscale thumbnail, relative to their median.
+    Re-encoded and resized copies of an image have hashes a few bits apart.
+
+    Parameters:
+    img: numpy.ndarray. The float32 CHW pixels of the image, as written by letterbox_image.
+    hash_size: int. The number of frequencies per axis, the hash has hash_size ** 2 bits. Default is 8.
+
+    Returns:
+    hash: int. The hash, with hash_size ** 2 bits.
+    """
+    size = hash_size * 4
+    gray = sum(weight * cv2.resize(channel, (size, size), interpolation=cv2.INTER_AREA)
+               for weight, channel in zip((0.299, 0.587, 0.114), img))
+    low = cv2.dct(gray)[:hash_size, :hash_size]
+    return int.from_bytes(np.packbits(low > np.median(low)).tobytes(), 'big')
+
+
+def unletterbox_boxes(boxes, letterbox):
+    """
+    This function maps boxes from letterboxed model input coordinates back to the original image,
+    applying the exact inverse of letterbox_image and clipping the boxes to the image.
+
+    Parameters:
+    boxes: numpy.ndarray. An Nx4 array of xmin, ymin, xmax, ymax coordinates in the model input.
+    letterbox: Letterbox. The parameters returned by letterbox_image.
+
+    Returns:
+    boxes: numpy.ndarray. An Nx4 float32 array of coordinates in the original image.
+    """
+    offset = np.array([letterbox.pad_x, letterbox.pad_y, letterbox.pad_x, letterbox.pad_y], dtype=np.float32)
+    ratio = np.array([letterbox.ratio_x, letterbox.ratio_y, letterbox.ratio_x, letterbox.ratio_y],
+                     dtype=np.float32)
+    limit = np.array([letterbox.width, letterbox.height, letterbox.width, letterbox.height], dtype=np.float32)
+    return np.clip((boxes - offset) / ratio, 0, limit)
+
+
+def letterbox_boxes(boxes, letterbox):
+    """
+    This function maps boxes from original image coordinates to letterboxed model input coordinates,
+    the inverse of unletterbox_boxes.
+
+    Parameters:
+    boxes: numpy.ndarray. An Nx4 array of xmin, ymin, xmax, ymax coordinates in the original image.
+    letterbox: Letterbox. The parameters returned by letterbox_image.
+
+    Returns:
+    boxes: numpy.ndarray. An Nx4 float32 array of coordinates in the model input.
+    """
+    offset = np.array([letterbox.pad_x, letterbox.pad_y, letterbox.pad_x, letterbox.pad_y], dtype=np.float32)
+    ratio = np.array([letterbox.ratio_x, letterbox.ratio_y, letterbox.ratio_x, letterbox.ratio_y],
+                     dtype=np.float32)
+    return boxes * ratio + offset
+
+
+class LetterboxBuffer:
+    """
+    A preallocated, reusable NCHW float32 buffer the images of a batch are letterboxed into.
+    The buffer only grows when a larger batch is requested.
+
+    Parameters
+    ----------
+    size : tuple, optional
+        the width and height of the model input (default is (640, 640))
+    """
+    def __init__(self, size=(640, 640)):
+        self.size = size
+        self._buffer = np.empty((0, 3, size[1], size[0]), dtype=np.float32)
+
+    def batch(self, n):
+        """
+        Returns a contiguous view of the buffer for a batch of n images.
+
+        Parameters
+        ----------
+        n : int
+            the number of images in the batch
+
+        Returns
+        -------
+        batch : numpy.ndarray
+        a float32 array of shape (n, 3, height, width)
+        """
+        if n > len(self._buffer):
+            self._buffer = np.empty((n, 3, self.size[1], self.size[0]), dtype=np.float32)
+        return self._buffer[:n]
+
+
+@timed('encode')
+def encode_image(image, format='JPEG', quality=75, overwrite=False):
+    """
+    This function takes an image and encodes it into an image file. Pixel arrays are encoded
+    directly with OpenCV.
+
+    Parameters:
+    image: PIL Image object or numpy.ndarray. The image, or its RGB pixels.
+    format: str. The file format, 'JPEG' or 'WEBP'. Default is 'JPEG'.
+    quality: int. The encoding quality from 1 to 100. Default is 75.
+    overwrite: bool. Whether the pixel array may be converted to BGR in place instead of copied,
+    leaving it unusable for the caller. Default is False.
+
+    Returns:
+    data: bytes. The encoded image file.
+    """
+    if isinstance(image, np.ndarray) and format in CV2_ENCODERS:
+        extension, quality_flag = CV2_ENCODERS[format]
+        bgr = cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=image if overwrite else None)
+        ok, encoded = cv2.imencode(extension, bgr, [quality_flag, int(quality)])
+        if not ok:
+            raise ValueError(f"Could not encode image as {format}")
+        return encoded.tobytes()
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    io_buf = io.BytesIO()
+    image.save(io_buf, format=format, quality=quality)
+    return io_buf.getvalue()
 
 
 def decode_img(msg):
@@ -0,0 +1,46 @@
+import os
+import psutil
+
+
+def process_memory(pid=None):
+    """
+    This function reports the memory of a process. The proportional set size (PSS) splits shared
+    pages between the processes sharing them, so the PSS of all workers adds up to their real use.
+
+    Parameters:
+    pid: int or None. The process id, None for the current process.
+
+    Returns:
+    memory: dict. The pid, and the resident (rss), proportional (pss) and unique (uss) set sizes in bytes;
+    pss and uss are None where the platform does not report them.
+    """
+    process = psutil.Process(pid or os.getpid())
+    try:
+        info = process.memory_full_info()
+    except psutil.AccessDenied:
+        info = process.memory_info()
+    return {
+        "pid": process.pid,
+        "rss": info.rss,
+        "pss": getattr(info, 'pss', None),
+        "uss": getattr(info, 'uss', None),
+    }
+
+
+def worker_memory(supervisor_pid):
+    """
+    This function reports the memory of a supervisor process and of every worker it forked.
+
+    Parameters:
+    supervisor_pid: int. The process id of the supervisor.
+
+    Returns:
+    memory: dict. The memory of the supervisor and a list with the memory of every worker, see process_memory.
+    """
+    workers = []
+    for child in psutil.Process(supervisor_pid).children():
+        try:
+            workers.append(process_memory(child.pid))
+        except psutil.NoSuchProcess:
+            continue
+    return {"supervisor": process_memory(supervisor_pid), "workers": workers}
@@ -0,0 +1,258 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from settings import METRICS_ENABLED
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds in bytes of the payload size histogram buckets
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))
+
+_request_timings = ContextVar('request_timings', default=None)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    A monotonically increasing count, per combination of label values.
+
+    Parameters
+    ----------
+    name : str
+        the metric name
+    documentation : str
+        the help text of the metric
+    labels : tuple of str, optional
+        the label names (default is no labels)
+    """
+    type = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        """
+        Increments the count of the given label values.
+
+        Parameters
+        ----------
+        *label_values
+            one value per label name
+        amount : int or float, optional
+            the increment (default is 1)
+        """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [(self.name + '_total', _format_labels(self.labels, key), value) for key, value in values.items()]
+
+
+class Histogram:
+    """
+    A distribution of observed values in cumulative buckets, per combination of label values.
+
+    Parameters
+    ----------
+    name : str
+        the metric name
+    documentation : str
+        the help text of the metric
+    buckets : tuple of float
+        the increasing upper bounds of the buckets, an infinite bucket is added
+    labels : tuple of str, optional
+        the label names (default is no labels)
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """
+        Records a value.
+
+        Parameters
+        ----------
+        value : float
+            the observed value
+        *label_values
+            one value per label name
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+        samples = []
+        for key, (counts, total, count) in values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                samples.append((self.name + '_bucket',
+                                _format_labels(self.labels, key, [('le', _format_value(bound))]), cumulative))
+            samples.append((self.name + '_sum', _format_labels(self.labels, key), total))
+            samples.append((self.name + '_count', _format_labels(self.labels, key), count))
+        return samples
+
+
+class Registry:
+    """
+    The metrics of the process, rendered in the Prometheus text format. Besides the metrics it
+    owns, it calls collectors at scrape time for values that are already counted elsewhere,
+    such as the queue depth of the inference engine.
+    """
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        """
+        Adds a metric to the registry.
+
+        Parameters
+        ----------
+        metric : Counter or Histogram
+            the metric
+
+        Returns
+        -------
+        metric : Counter or Histogram
+        the same metric
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """
+        Adds a function called at scrape time.
+
+        Parameters
+        ----------
+        collector : callable
+            a function without arguments returning a list of (name, type, help, value) tuples,
+            where type is 'gauge' or 'counter'
+        """
+        self._collectors.append(collector)
+
+    def render(self):
+        """
+        Renders every metric in the Prometheus text exposition format.
+
+        Returns
+        -------
+        text : str
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(f'{name}{labels} {_format_value(value)}' for name, labels, value in metric.samples())
+        for collector in self._collectors:
+            for name, metric_type, documentation, value in collector():
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                lines.append(f'{name} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'yolo_stage_seconds', 'Latency of the stages of the detect and render pipeline.', LATENCY_BUCKETS, ('stage',)))
+
+
+@contextmanager
+def timed(stage):
+    """
+    Records the latency of a pipeline stage in the stage histogram, and in the timings of the
+    current request when they are collected. Works as a context manager and as a decorator.
+
+    Parameters:
+    stage: str. The name of the stage, for example 'decode'.
+    """
+    if not METRICS_ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+def start_request_timings():
+    """
+    Starts collecting the stage latencies of the current request.
+
+    Returns:
+    token: contextvars.Token. The token passed to finish_request_timings.
+    """
+    return _request_timings.set({})
+
+
+def finish_request_timings(token):
+    """
+    Stops collecting the stage latencies of the current request.
+
+    Parameters:
+    token: contextvars.Token. The token returned by start_request_timings.
+
+    Returns:
+    timings: dict. The total latency in seconds of every stage run by the request.
+    """
+    timings = _request_timings.get() or {}
+    _request_timings.reset(token)
+    return timings
+
+
+def server_timing(timings, total=None):
+    """
+    Formats stage latencies as the value of a Server-Timing header.
+
+    Parameters:
+    timings: dict. The latency in seconds of every stage.
+    total: float or None. The latency in seconds of the whole request.
+
+    Returns:
+    header: str. For example 'decode;dur=1.20, inference;dur=31.05, total;dur=33.40'.
+    """
+    if total is not None:
+        timings = dict(timings, total=total)
+    return ', '.join('%s;dur=%.2f' % (stage, seconds * 1000) for stage, seconds in timings.items())
@@ -0,0 +1,90 @@
+import sys
+import threading
+from collections import Counter
+
+
+class SamplingProfiler:
+    """
+    A statistical profiler that samples the Python stacks of every thread of the process at a fixed
+    interval. It can be started and stopped at runtime and costs nothing while it is stopped.
+    The samples are reported as collapsed stacks, the input format of flame graph tools.
+
+    Parameters
+    ----------
+    interval : float
+        the time in seconds between samples
+    max_depth : int, optional
+        the maximum number of frames kept per stack, innermost first (default is 64)
+    """
+    def __init__(self, interval, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self._stacks = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Starts sampling, if it is not running already.
+        """
+        with self._lock:
+            if self.running:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stops sampling, keeping the samples taken so far.
+        """
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def reset(self):
+        """
+        Drops the samples taken so far.
+        """
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+
+    def collapsed(self):
+        """
+        Returns the sampled stacks in collapsed format.
+
+        Returns
+        -------
+        text : str
+        one line per distinct stack, the frames from outermost to innermost separated by ';'
+        followed by the number of samples of the stack
+        """
+        with self._lock:
+            stacks = self._stacks.most_common()
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None and len(frames) < self.max_depth:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stacks.append(';'.join(reversed(frames)))
+            with self._lock:
+                self._stacks.update(stacks)
+                self.samples += 1
+
@@ -0,0 +1,88 @@
+from util.cache import DetectionCache, SimilarityCache
+
+
+def test_cache_key_depends_on_bytes_and_params():
+    """
+    Test that the cache key changes with the request bytes and parameters only.
+
+    Raises
+    ------
+    AssertionError
+        If identical requests get different keys or different requests share a key.
+    """
+    key = DetectionCache.key('detect', b'image', 0.25)
+    assert key == DetectionCache.key('detect', b'image', 0.25)
+    assert key != DetectionCache.key('detect', b'image', 0.5)
+    assert key != DetectionCache.key('render', b'image', 0.25)
+    assert key != DetectionCache.key('detect', b'other', 0.25)
+
+
+def test_cache_evicts_least_recently_used():
+    """
+    Test that the in-memory tier stays within its memory bound by evicting the least recently used entry.
+
+    Raises
+    ------
+    AssertionError
+        If the recently used entry is evicted or the counters are wrong.
+    """
+    cache = DetectionCache(max_bytes=25)
+    cache.put('a', 'x' * 10)
+    cache.put('b', 'y' * 10)
+    assert cache.get('a') == 'x' * 10
+    cache.put('c', 'z' * 10)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 'x' * 10
+    metrics = cache.metrics()
+    assert metrics["evictions"] == 1
+    assert metrics["hits_memory"] == 2
+    assert metrics["misses"] == 1
+    assert metrics["bytes"] == 20
+
+
+def test_cache_disk_tier_survives_restart(tmp_path):
+    """
+    Test that results stored in the on-disk tier are found by a new cache instance.
+
+    Raises
+    ------
+    AssertionError
+        If the new cache instance does not return the stored value from disk.
+    """
+    DetectionCache(max_bytes=1024, disk_dir=str(tmp_path)).put('key', 'value')
+
+    cache = DetectionCache(max_bytes=1024, disk_dir=str(tmp_path))
+    assert cache.get('key') == 'value'
+    assert cache.metrics()["hits_disk"] == 1
+    assert cache.get('key') == 'value'
+    assert cache.metrics()["hits_memory"] == 1
+
+
+def test_similarity_cache_matches_near_duplicate_hashes():
+    """
+    Test that hashes within the tolerance and with the same parameters hit, that the least recently
+    used entry is evicted and that every other hit is flagged for an audit at an audit rate of 0.5.
+
+    Raises
+    ------
+    AssertionError
+        If a near-duplicate misses, a distant hash or other parameters hit, or the counters are wrong.
+    """
+    cache = SimilarityCache(capacity=2, max_distance=2, audit_rate=0.5)
+    cache.put(0b1111, 'a', 0.25)
+    cache.put(0xFF00, 'b', 0.25)
+
+    assert cache.get(0b0111, 0.25) == ('a', False)
+    assert cache.get(0b0011, 0.25) == ('a', True)
+    assert cache.get(0b0001, 0.25) == (None, False)
+    assert cache.get(0b1111, 0.5) == (None, False)
+
+    cache.put(0xF0F0F0, 'c', 0.25)
+    assert cache.get(0xFF00, 0.25) == (None, False)
+    assert cache.get(0b1111, 0.25)[0] == 'a'
+
+    cache.record_audit(false_match=True)
+    metrics = cache.metrics()
+    assert (metrics['hits'], metrics['misses'], metrics['evictions'], metrics['entries']) == (3, 3, 1, 2)
+    assert (metrics['audits'], metrics['false_matches']) == (1, 1)
@@ -0,0 +1,134 @@
+import json
+
+import numpy as np
+import pytest
+
+from model.detections import Detections
+from util.df_to_json import (format_detections, detections_to_json, detections_to_columns_json, detections_to_msgpack,
+                             detections_to_packed, packed_to_detections)
+
+
+@pytest.fixture(scope="module")
+def detections():
+    boxes = np.array([[10.7, 20.2, 110.9, 220.5], [0.0, 5.5, 40.1, 60.9]], dtype=np.float32)
+    return Detections(boxes, [0.91, 0.42], [0, 2], {0: "person", 1: "bicycle", 2: "car"})
+
+
+def test_detections_to_json_matches_format_detections(detections):
+    """
+    Test that the direct JSON serialization produces the same document as format_detections.
+
+    Raises
+    ------
+    AssertionError
+        If the parsed JSON text differs from the formatted dictionary.
+    """
+    assert json.loads(detections_to_json(detections)) == format_detections(detections)
+
+
+def test_format_detections_keys(detections):
+    """
+    Test that every formatted object has the expected keys and integer box coordinates.
+
+    Raises
+    ------
+    AssertionError
+        If an object misses a key or a box coordinate is not an integer.
+    """
+    objects = format_detections(detections)["objects"]
+    assert len(objects) == 2
+    assert objects[0] == {"class": 0, "confidence": float(np.float32(0.91)),
+                          "xmin": 10, "ymin": 20, "xmax": 110, "ymax": 220}
+
+
+def test_detections_to_json_empty():
+    """
+    Test that empty detections serialize to an empty object list.
+
+    Raises
+    ------
+    AssertionError
+        If the JSON document is not an empty object list.
+    """
+    assert json.loads(detections_to_json(Detections.empty())) == {"objects": []}
+    assert format_detections(Detections.empty()) == {"objects": []}
+
+
+def test_compact_formats_match_objects(detections):
+    """
+    Test that the columnar JSON, packed binary and MessagePack formats hold the values of the object list.
+
+    Raises
+    ------
+    AssertionError
+        If a compact format differs from the object list or has the wrong size.
+    """
+    objects = format_detections(detections)["objects"]
+    columns = json.loads(detections_to_columns_json(detections))
+    assert columns == {key: [obj[key] for obj in objects] for key in objects[0]}
+    assert json.loads(detections_to_columns_json(Detections.empty()))["class"] == []
+
+    payload = detections_to_packed(detections)
+    assert len(payload) == 4 + 22 * len(detections)
+    unpacked = packed_to_detections(payload)
+    np.testing.assert_array_equal(unpacked.boxes, detections.boxes)
+    np.testing.assert_array_equal(unpacked.confidence, detections.confidence)
+    np.testing.assert_array_equal(unpacked.class_ids, detections.class_ids)
+
+
+@pytest.mark.parametrize("repeat", [0, 1, 20, 40000])
+def test_msgpack_round_trips_through_reference_decoder(detections, repeat):
+    """
+    Test that the MessagePack encoding is read back by the msgpack package, for every array header size.
+
+    Raises
+    ------
+    AssertionError
+        If the decoded columns differ from the detections.
+    """
+    msgpack = pytest.importorskip("msgpack")
+    dets = Detections(np.tile(detections.boxes, (repeat, 1)), np.tile(detections.confidence, repeat),
+                      np.tile(detections.class_ids, repeat))
+    decoded = msgpack.unpackb(detections_to_msgpack(dets))
+    assert list(decoded) == ["class", "confidence", "xmin", "ymin", "xmax", "ymax"]
+    assert decoded["class"] == dets.class_ids.tolist()
+    np.testing.assert_array_equal(np.float32(decoded["confidence"]), dets.confidence)
+    boxes = np.float32([decoded[key] for key in ("xmin", "ymin", "xmax", "ymax")]).reshape(4, -1).T
+    np.testing.assert_array_equal(boxes, dets.boxes)
+
+
+def test_json_formats_replace_non_finite_values():
+    """
+    Test that NaN and infinite values do not make the JSON documents invalid.
+
+    Raises
+    ------
+    AssertionError
+        If a JSON document cannot be parsed strictly.
+    """
+    dets = Detections([[np.nan, 1, np.inf, 4]], [np.nan], [0])
+
+    def strict(text):
+        return json.loads(text, parse_constant=lambda name: pytest.fail(f"{name} in JSON"))
+
+    assert strict(detections_to_json(dets))["objects"] == [
+        {"class": 0, "confidence": 0.0, "xmin": 0, "ymin": 1, "xmax": 0, "ymax": 4}]
+    assert strict(detections_to_columns_json(dets))["confidence"] == [0.0]
+
+
+def test_threshold_scale_and_pandas(detections):
+    """
+    Test vectorized thresholding, scaling and the DataFrame conversion.
+
+    Raises
+    ------
+    AssertionError
+        If the filtered, scaled detections or the DataFrame columns are wrong.
+    """
+    result = detections.threshold(0.5).scale(2.0, 0.5)
+    assert len(result) == 1
+    np.testing.assert_allclose(result.boxes[0], [21.4, 10.1, 221.8, 110.25], rtol=1e-5)
+
+    df = result.to_pandas()
+    assert list(df.columns) == ["xmin", "ymin", "xmax", "ymax", "confidence", "class", "name"]
+    assert df["name"].tolist() == ["person"]
@@ -0,0 +1,40 @@
+import numpy as np
+
+from model.detections import Detections
+from util.draw_bbox import DEFAULT_COLOR, class_colors, draw_boxes
+
+
+def test_draw_boxes_in_place():
+    """
+    Test that box outlines are drawn in place on the pixel array, with the inside left untouched.
+
+    Raises
+    ------
+    AssertionError
+        If the array is copied, the outline is missing or the inside of the box is painted.
+    """
+    img = np.zeros((100, 100, 3), dtype=np.uint8)
+    detections = Detections([[10, 20, 60, 80]], [0.9], [0])
+
+    assert draw_boxes(img, detections, thickness=1) is img
+    assert tuple(img[20, 30]) == DEFAULT_COLOR
+    assert tuple(img[50, 10]) == DEFAULT_COLOR
+    assert not img[50, 30].any()
+
+
+def test_draw_boxes_per_class_colors_and_labels():
+    """
+    Test that boxes are coloured by class and labels are drawn above the boxes.
+
+    Raises
+    ------
+    AssertionError
+        If a box does not have the colour of its class or no label is drawn.
+    """
+    img = np.zeros((200, 200, 3), dtype=np.uint8)
+    detections = Detections([[10, 40, 90, 90], [100, 120, 190, 190]], [0.9, 0.5], [0, 3], ["a", "b", "c", "d"])
+
+    draw_boxes(img, detections, labels=True, per_class_colors=True, thickness=1)
+    assert tuple(img[60, 10]) == tuple(class_colors([0])[0])
+    assert tuple(img[150, 190]) == tuple(class_colors([3])[0])
+    assert img[20:40, 10:40].any()
@@ -0,0 +1,138 @@
+import io
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+from util.image_utils import (ImageTooLarge, LetterboxBuffer, decode_image, decode_image_scaled, letterbox_image,
+                              perceptual_hash, unletterbox_boxes)
+
+
+def _jpeg(width, height, orientation=1):
+    img = np.zeros((height, width, 3), dtype=np.uint8)
+    img[:, :width // 4] = 255
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    buf = io.BytesIO()
+    Image.fromarray(img).save(buf, 'JPEG', exif=exif.tobytes())
+    return buf.getvalue()
+
+
+def test_letterbox_preserves_aspect_ratio():
+    """
+    Test that a wide image is resized without distortion and padded vertically.
+
+    Raises
+    ------
+    AssertionError
+        If the transform parameters or the padding of the buffer are wrong.
+    """
+    img = np.full((480, 1280, 3), 255, dtype=np.uint8)
+    out = LetterboxBuffer((640, 640)).batch(1)[0]
+
+    letterbox = letterbox_image(img, out)
+    assert letterbox.ratio_x == letterbox.ratio_y == 0.5
+    assert (letterbox.pad_x, letterbox.pad_y) == (0, 200)
+    assert np.allclose(out[:, :200], 114 / 255.0)
+    assert np.allclose(out[:, 200:440], 1.0)
+    assert np.allclose(out[:, 440:], 114 / 255.0)
+
+
+def test_unletterbox_is_inverse():
+    """
+    Test that boxes mapped into the model input are mapped back to the original coordinates.
+
+    Raises
+    ------
+    AssertionError
+        If the inverse transform does not restore the original boxes.
+    """
+    img = np.zeros((333, 517, 3), dtype=np.uint8)
+    out = np.empty((3, 640, 640), dtype=np.float32)
+    letterbox = letterbox_image(img, out)
+
+    boxes = np.array([[10, 20, 300, 330], [0, 0, 517, 333]], dtype=np.float32)
+    ratio = np.array([letterbox.ratio_x, letterbox.ratio_y] * 2, dtype=np.float32)
+    offset = np.array([letterbox.pad_x, letterbox.pad_y] * 2, dtype=np.float32)
+    np.testing.assert_allclose(unletterbox_boxes(boxes * ratio + offset, letterbox), boxes, atol=1e-3)
+
+
+def test_letterbox_buffer_is_reused():
+    """
+    Test that the buffer is only reallocated for a larger batch.
+
+    Raises
+    ------
+    AssertionError
+        If a smaller batch does not share memory with the preallocated buffer.
+    """
+    buffer = LetterboxBuffer((64, 64))
+    first = buffer.batch(4)
+    assert first.shape == (4, 3, 64, 64)
+    assert np.shares_memory(buffer.batch(2), first)
+
+
+def test_decode_image_scaled_reduces_large_jpeg():
+    """
+    Test that a large JPEG is decoded at a reduced resolution no smaller than the model input,
+    with EXIF orientation applied and a scale mapping back to the full-size image.
+
+    Raises
+    ------
+    AssertionError
+        If the decoded size, the orientation or the scale are wrong.
+    """
+    img, scale = decode_image_scaled(_jpeg(4000, 3000), 640)
+    assert img.shape == (750, 1000, 3)
+    assert scale == (4.0, 4.0)
+
+    img, scale = decode_image_scaled(_jpeg(2000, 1000, orientation=6), 640)
+    assert img.shape == (1000, 500, 3)
+    assert scale == (2.0, 2.0)
+    assert img[:100].mean() > 200 and img[-100:].mean() < 50
+
+    img, scale = decode_image_scaled(_jpeg(800, 600), 640)
+    assert img.shape == (600, 800, 3) and scale == (1.0, 1.0)
+
+
+def test_decode_image_rejects_too_many_pixels():
+    """
+    Test that images over the pixel limit are rejected before they are decoded.
+
+    Raises
+    ------
+    AssertionError
+        If an image over the limit is decoded.
+    """
+    data = _jpeg(1000, 1000)
+    with pytest.raises(ImageTooLarge):
+        decode_image(data, max_pixels=999_999)
+    with pytest.raises(ImageTooLarge):
+        decode_image_scaled(data, max_pixels=999_999)
+    assert decode_image(data, max_pixels=1_000_000).shape == (1000, 1000, 3)
+
+
+def test_perceptual_hash_matches_reencoded_and_resized_copies():
+    """
+    Test that re-encoded and resized copies of an image hash a few bits apart and a different image does not.
+
+    Raises
+    ------
+    AssertionError
+        If a copy hashes far from the original or a different image hashes close to it.
+    """
+    def hash_of(img):
+        out = np.empty((3, 640, 640), dtype=np.float32)
+        letterbox_image(img, out)
+        return perceptual_hash(out)
+
+    rng = np.random.default_rng(0)
+    img = cv2.GaussianBlur(rng.integers(0, 255, (480, 640, 3), dtype=np.uint8), (31, 31), 0)
+    reencoded = cv2.imdecode(cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 30])[1], cv2.IMREAD_COLOR)
+    resized = cv2.resize(img, (320, 240), interpolation=cv2.INTER_AREA)
+
+    original = hash_of(img)
+    assert bin(original ^ hash_of(reencoded)).count('1') <= 4
+    assert bin(original ^ hash_of(resized)).count('1') <= 4
+    assert bin(original ^ hash_of(np.ascontiguousarray(img[::-1]))).count('1') > 16
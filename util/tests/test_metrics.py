@@ -0,0 +1,55 @@
+from util.metrics import (Counter, Histogram, Registry, finish_request_timings, server_timing,
+                          start_request_timings, timed)
+
+
+def test_registry_renders_prometheus_text():
+    """
+    Test that counters and cumulative histogram buckets are rendered in the Prometheus text format.
+
+    Raises
+    ------
+    AssertionError
+        If a sample line is missing or wrong.
+    """
+    registry = Registry()
+    requests = registry.register(Counter('requests', 'Requests.', ('endpoint',)))
+    latency = registry.register(Histogram('latency_seconds', 'Latency.', (0.1, 1.0)))
+    registry.add_collector(lambda: [('queue_depth', 'gauge', 'Queue depth.', 3)])
+    requests.inc('/detect')
+    requests.inc('/detect')
+    latency.observe(0.05)
+    latency.observe(0.5)
+
+    lines = registry.render().splitlines()
+
+    assert 'requests_total{endpoint="/detect"} 2' in lines
+    assert 'latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 2' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 2' in lines
+    assert 'latency_seconds_count 2' in lines
+    assert '# TYPE queue_depth gauge' in lines and 'queue_depth 3' in lines
+
+
+def test_timed_collects_request_timings():
+    """
+    Test that stages run while request timings are collected are summed per stage.
+
+    Raises
+    ------
+    AssertionError
+        If a stage is missing or the header is malformed.
+    """
+    @timed('decode')
+    def decode():
+        return 1
+
+    token = start_request_timings()
+    decode()
+    decode()
+    with timed('encode'):
+        pass
+    timings = finish_request_timings(token)
+
+    assert set(timings) == {'decode', 'encode'}
+    header = server_timing(timings, 0.002)
+    assert header.startswith('decode;dur=') and header.endswith('total;dur=2.00')